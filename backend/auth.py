@@ -4,16 +4,15 @@ from jose import JWTError, jwt
 import bcrypt
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
-import os
-from dotenv import load_dotenv
 from database import users_collection
 from models import TokenData, User
+from settings import get_settings
+from utils.tracing import span
 
-load_dotenv()
-
-SECRET_KEY = os.getenv("SECRET_KEY")
-ALGORITHM = os.getenv("ALGORITHM", "HS256")
-ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES", 30))
+settings = get_settings()
+SECRET_KEY = settings.secret_key
+ALGORITHM = settings.algorithm
+ACCESS_TOKEN_EXPIRE_MINUTES = settings.access_token_expire_minutes
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
@@ -34,6 +33,12 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     return encoded_jwt
 
 async def get_current_user(token: str = Depends(oauth2_scheme)):
+    with span("auth.get_current_user") as auth_span:
+        user = _resolve_user(token)
+        auth_span.set_attribute("username", user.username)
+        return user
+
+def _resolve_user(token: str):
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
@@ -61,6 +66,18 @@ async def get_current_user(token: str = Depends(oauth2_scheme)):
     
     return User(**user_dict)
 
+def user_for_token(token: str) -> Optional[User]:
+    """Resolve a bearer token to its user, or None. For code that can't use Depends (middlewares, streams)."""
+    try:
+        return _resolve_user(token)
+    except HTTPException:
+        return None
+
+def admin_username_for_token(token: str) -> Optional[str]:
+    """Resolve a bearer token to an admin's username, or None. For middlewares, which can't use Depends."""
+    user = user_for_token(token)
+    return user.username if user is not None and user.role == "admin" else None
+
 async def get_current_active_user(current_user: User = Depends(get_current_user)):
     # Add active check if needed
     return current_user
@@ -0,0 +1,361 @@
+"""
+Reproducible load / latency benchmark for the PolyThink Studio API.
+
+Runs the real FastAPI app in-process (TestClient) against a throwaway git
+dataset repository and either an in-memory Mongo stand-in (mongomock, the
+default) or a local mongod, then measures throughput and p50/p99 latency for
+the hot paths: login, list endpoints, dataset load, fork save, PR diff and
+PR process.
+
+Usage (from backend/):
+    pip install -r benchmarks/requirements.txt
+    python benchmarks/bench_api.py --sizes 1000,10000
+    python benchmarks/bench_api.py --sizes 1000 --mongo-url mongodb://localhost:27017 --output base.json
+    python benchmarks/bench_api.py --sizes 1000 --compare base.json
+    FORK_FLUSH_SECONDS=5 python benchmarks/bench_api.py --sizes 1000   # buffered fork saves
+
+Results are written as JSON (one entry per operation and dataset) so two runs
+can be compared between commits with --compare.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+
+WORDS = (
+    "the model should reason about each step before answering and verify "
+    "intermediate results against the constraints given in the prompt while "
+    "keeping the final response concise accurate and well structured"
+).split()
+
+
+def make_text(rng, min_words, max_words):
+    return " ".join(rng.choice(WORDS) for _ in range(rng.randint(min_words, max_words)))
+
+
+def make_item(rng, turn_type):
+    """Build one synthetic item in the same shape the editor produces."""
+    turns = 1 if turn_type == "single-turn" else rng.randint(2, 6)
+    messages = [{"role": "system", "content": make_text(rng, 5, 15), "thinking": None}]
+    for _ in range(turns):
+        messages.append({"role": "user", "content": make_text(rng, 10, 40), "thinking": None})
+        messages.append({
+            "role": "assistant",
+            "content": make_text(rng, 20, 80),
+            "thinking": make_text(rng, 20, 120),
+        })
+    return {"messages": messages}
+
+
+def generate_dataset(path: Path, size: int, turn_type: str, seed: int):
+    rng = random.Random(seed)
+    content = [make_item(rng, turn_type) for _ in range(size)]
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(content, f, ensure_ascii=False, indent=2)
+    return content
+
+
+def edit_items(content, count, rng):
+    """Return a copy of `content` with `count` items modified, plus their indices."""
+    edited = list(content)
+    indices = sorted(rng.sample(range(len(content)), min(count, len(content))))
+    for i in indices:
+        item = json.loads(json.dumps(content[i]))
+        item["messages"][-1]["content"] += " (revised)"
+        edited[i] = item
+    return edited, indices
+
+
+def percentile(samples, pct):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    k = (len(ordered) - 1) * pct / 100
+    lo = int(k)
+    hi = min(lo + 1, len(ordered) - 1)
+    return ordered[lo] + (ordered[hi] - ordered[lo]) * (k - lo)
+
+
+class Recorder:
+    def __init__(self):
+        self.results = []
+
+    def measure(self, name, fn, iterations, dataset=None, items=None, settle=None):
+        """
+        Time `fn` `iterations` times and record the resulting samples. `settle`
+        runs untimed after each call, to wait for the background work it started.
+        """
+        samples = []
+        for _ in range(iterations):
+            t0 = time.perf_counter()
+            response = fn()
+            samples.append((time.perf_counter() - t0, response))
+            if settle is not None:
+                settle()
+        return self.record(name, samples, dataset, items)
+
+    def record(self, name, samples, dataset=None, items=None):
+        """Record a list of (seconds, response) samples as one result entry."""
+        seconds = [s for s, _ in samples]
+        responses = [r for _, r in samples if r is not None]
+        total = sum(seconds)
+        entry = {
+            "operation": name,
+            "dataset": dataset,
+            "items": items,
+            "iterations": len(seconds),
+            "errors": sum(1 for r in responses if r.status_code >= 400),
+            "throughput_per_s": round(len(seconds) / total, 3) if total else None,
+            "mean_ms": round(statistics.mean(seconds) * 1000, 3),
+            "p50_ms": round(percentile(seconds, 50) * 1000, 3),
+            "p99_ms": round(percentile(seconds, 99) * 1000, 3),
+            "min_ms": round(min(seconds) * 1000, 3),
+            "max_ms": round(max(seconds) * 1000, 3),
+            "avg_response_bytes": sum(len(r.content) for r in responses) // len(responses) if responses else 0,
+        }
+        self.results.append(entry)
+        label = f"{name} [{dataset}]" if dataset else name
+        print(
+            f"{label:<50} p50={entry['p50_ms']:>10.2f}ms p99={entry['p99_ms']:>10.2f}ms "
+            f"{entry['throughput_per_s'] or 0:>9.2f}/s errors={entry['errors']}"
+        )
+        return entry
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=str(BACKEND_DIR), capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except Exception:
+        return None
+
+
+def setup_environment(args, workdir: Path):
+    """Point the app at a throwaway dataset repo and the selected Mongo before import."""
+    repo = workdir / "dataset"
+    (repo / "dataset" / "single-turn").mkdir(parents=True)
+    (repo / "dataset" / "multi-turn").mkdir(parents=True)
+    subprocess.run(["git", "init", "-q"], cwd=str(repo), check=True)
+
+    os.environ["DATASET_REPO_DIR"] = str(repo)
+    os.environ["MONGODB_URL"] = args.mongo_url
+    os.environ["DB_NAME"] = args.db_name
+    os.environ.setdefault("SECRET_KEY", "benchmark-secret")
+    os.environ.setdefault("ALLOWED_EMAIL_DOMAINS", "polythink.studio")
+    # Never talk to a real SMTP server from a benchmark
+    os.environ["SMTP_SERVER"] = ""
+    sys.path.insert(0, str(BACKEND_DIR))
+    return repo / "dataset"
+
+
+def seed_users(db, annotators):
+    from auth import get_password_hash
+
+    db.users.delete_many({})
+    db.pull_requests.delete_many({})
+    db.user_datasets.delete_many({})
+    db.invitation_codes.delete_many({})
+    db.users.insert_one({
+        "username": "admin", "email": "admin@polythink.studio", "full_name": "Bench Admin",
+        "role": "admin", "is_active": True, "email_verified": True,
+        "hashed_password": get_password_hash("admin123"),
+    })
+    db.users.insert_many([
+        {
+            "username": f"annotator{i}", "email": f"annotator{i}@polythink.studio",
+            "full_name": f"Annotator {i}", "role": "user", "is_active": True,
+            "email_verified": True, "allowed_datasets": [],
+        }
+        for i in range(annotators)
+    ])
+
+
+def login(client, db, email):
+    """Full OTP login round trip; the OTP is read back from the database."""
+    response = client.post("/auth/login-request", json={"email": email})
+    code = db.users.find_one({"email": email})["otp_code"]
+    verified = client.post("/auth/login-verify", json={"email": email, "code": code})
+    verified.raise_for_status()
+    return response, verified.json()["access_token"]
+
+
+def run(args):
+    workdir = Path(tempfile.mkdtemp(prefix="polythink-bench-"))
+    try:
+        base_dir = setup_environment(args, workdir)
+
+        from fastapi.testclient import TestClient
+        import database
+        from main import app
+        from utils.write_behind import fork_buffer, fork_writes
+
+        db = database.db
+        seed_users(db, args.annotators)
+        rng = random.Random(args.seed)
+        recorder = Recorder()
+
+        with TestClient(app) as client:
+            recorder.measure(
+                "login (otp request + verify)",
+                lambda: login(client, db, "admin@polythink.studio")[0],
+                args.iterations,
+            )
+            _, admin_token = login(client, db, "admin@polythink.studio")
+            _, user_token = login(client, db, "annotator0@polythink.studio")
+            admin = {"Authorization": f"Bearer {admin_token}"}
+            user = {"Authorization": f"Bearer {user_token}"}
+
+            for size in args.sizes:
+                for turn_type in args.turn_types:
+                    filename = f"bench_{size}.json"
+                    dataset_path = f"{turn_type}/{filename}"
+                    label = f"{turn_type}/{size}"
+                    print(f"\n== {label}: generating {size} items")
+                    content = generate_dataset(base_dir / turn_type / filename, size, turn_type, args.seed + size)
+                    db.users.update_many({}, {"$addToSet": {"allowed_datasets": dataset_path}})
+
+                    url = f"/datasets/{dataset_path}"
+                    recorder.measure("dataset load (main)", lambda: client.get(url, headers=user),
+                                     args.iterations, label, size)
+
+                    edited, _ = edit_items(content, args.edits, rng)
+                    payload = {"content": edited}
+                    # Fork save listeners (change index, validation) run on a background thread.
+                    # mongomock isn't thread-safe, so each timed call waits for them before the next
+                    fork_buffer.flush_all()  # Saves buffered by earlier steps aren't counted here
+                    written = fork_writes.value(outcome="written")
+                    saved = recorder.measure("fork save", lambda: client.post(url, json=payload, headers=user),
+                                             args.iterations, label, size, settle=fork_buffer.wait_listeners)
+                    # Mongo writes behind those saves (buffered ones are flushed first)
+                    fork_buffer.flush_all()
+                    fork_buffer.wait_listeners()
+                    saved["mongo_writes"] = fork_writes.value(outcome="written") - written
+                    print(f"{'':<50} {saved['mongo_writes']} fork write(s) for {saved['iterations']} saves")
+                    recorder.measure("dataset load (fork)", lambda: client.get(url, params={"fork": True}, headers=user),
+                                     args.iterations, label, size)
+
+                    diff_samples = []
+                    process_samples = []
+                    for _ in range(args.iterations):
+                        pr = client.post("/workflow/pr", params={"dataset_path": dataset_path}, headers=user)
+                        pr.raise_for_status()
+                        pr_id = pr.json()["_id"]
+                        t0 = time.perf_counter()
+                        diff = client.get(f"/workflow/prs/{pr_id}/diff", headers=admin)
+                        diff_samples.append((time.perf_counter() - t0, diff))
+                        accepted = [d["index"] for d in diff.json().get("diffs", [])]
+                        t0 = time.perf_counter()
+                        processed = client.post(f"/workflow/prs/{pr_id}/process",
+                                                json={"accepted_indices": accepted}, headers=admin)
+                        process_samples.append((time.perf_counter() - t0, processed))
+                        # Edit again so the next iteration has something to diff. Processing moves the
+                        # fork's base forward, so items merged above may be edited again; a 409 here
+                        # would show up as errors in the "pr process" row.
+                        edited, _ = edit_items(edited, args.edits, rng)
+                        client.post(url, json={"content": edited}, headers=user)
+                        fork_buffer.wait_listeners()
+
+                    recorder.record("pr diff", diff_samples, label, size)
+                    recorder.record("pr process", process_samples, label, size)
+
+            for name, path, headers in (
+                ("list datasets", "/datasets", user),
+                ("list pull requests", "/workflow/prs", admin),
+                ("list users", "/users", admin),
+                ("list invites", "/admin/invites", admin),
+            ):
+                recorder.measure(name, lambda: client.get(path, headers=headers), args.iterations)
+
+        report = {
+            "benchmark": "api",
+            "revision": git_revision(),
+            "timestamp": datetime.utcnow().isoformat() + "Z",
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "mongo_url": args.mongo_url.split("@")[-1],
+            "config": {
+                "sizes": args.sizes,
+                "turn_types": args.turn_types,
+                "iterations": args.iterations,
+                "edits": args.edits,
+                "seed": args.seed,
+                "fork_flush_seconds": fork_buffer.interval,
+            },
+            "results": recorder.results,
+        }
+        output = Path(args.output)
+        output.parent.mkdir(parents=True, exist_ok=True)
+        output.write_text(json.dumps(report, indent=2))
+        print(f"\nResults written to {output}")
+
+        if args.compare:
+            return compare(report, json.loads(Path(args.compare).read_text()), args.threshold)
+        return 0
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def compare(current, baseline, threshold):
+    """Print p50/p99 deltas against a previous run; non-zero exit on regressions."""
+    def key(entry):
+        return (entry["operation"], entry["dataset"])
+
+    previous = {key(e): e for e in baseline.get("results", [])}
+    regressions = 0
+    print(f"\nComparison against {baseline.get('revision')} (threshold {threshold:.0%})")
+    for entry in current["results"]:
+        old = previous.get(key(entry))
+        if not old or not old["p50_ms"]:
+            continue
+        p50_delta = entry["p50_ms"] / old["p50_ms"] - 1
+        p99_delta = entry["p99_ms"] / old["p99_ms"] - 1 if old["p99_ms"] else 0.0
+        flag = ""
+        if p50_delta > threshold:
+            flag = "  <-- REGRESSION"
+            regressions += 1
+        label = f"{entry['operation']} [{entry['dataset']}]" if entry["dataset"] else entry["operation"]
+        print(f"{label:<50} p50 {p50_delta:+8.1%}  p99 {p99_delta:+8.1%}{flag}")
+    return 1 if regressions else 0
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="1000,10000",
+                        help="Comma separated dataset sizes in items (e.g. 1000,100000,1000000)")
+    parser.add_argument("--turn-types", default="single-turn,multi-turn")
+    parser.add_argument("--iterations", type=int, default=5, help="Samples per operation")
+    parser.add_argument("--edits", type=int, default=25, help="Items edited per fork save")
+    parser.add_argument("--annotators", type=int, default=50, help="Extra users seeded for list endpoints")
+    parser.add_argument("--seed", type=int, default=1337)
+    parser.add_argument("--mongo-url", default="mongomock://",
+                        help="mongomock:// for the in-memory stand-in, or a mongodb:// URL")
+    parser.add_argument("--db-name", default="polythink_bench")
+    parser.add_argument("--output", default=None,
+                        help="Result file (default: benchmarks/results/api-<revision>.json)")
+    parser.add_argument("--compare", default=None, help="Previous result file to compare against")
+    parser.add_argument("--threshold", type=float, default=0.10,
+                        help="Relative p50 slowdown reported as a regression")
+    args = parser.parse_args(argv)
+    args.sizes = [int(s) for s in args.sizes.split(",") if s]
+    args.turn_types = [t for t in args.turn_types.split(",") if t]
+    if args.output is None:
+        args.output = str(BACKEND_DIR / "benchmarks" / "results" / f"api-{git_revision() or 'local'}.json")
+    return args
+
+
+if __name__ == "__main__":
+    sys.exit(run(parse_args()))
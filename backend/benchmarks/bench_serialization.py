@@ -0,0 +1,197 @@
+"""
+Per-row serialization cost of the admin list endpoints.
+
+Seeds users, pull requests and invitation codes (10k rows each by default),
+then times each list two ways, in-process and without HTTP:
+
+    model   the previous path: whole documents, a Pydantic model per row,
+            then FastAPI's jsonable_encoder and json.dumps
+    lean    the route handler itself: projected rows dumped straight to JSON
+
+The model path leaves out read_users' old per-user PR count queries (two per
+user), so the comparison isolates serialization; the lean path includes the
+single aggregation that replaced them. "encode" entries time serialization
+alone over rows fetched up front, since with mongomock the fetch dominates.
+
+Usage (from backend/):
+    pip install -r benchmarks/requirements.txt
+    python benchmarks/bench_serialization.py --rows 10000
+    python benchmarks/bench_serialization.py --rows 10000 --mongo-url mongodb://localhost:27017
+"""
+import argparse
+import asyncio
+import json
+import platform
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+
+from bench_api import BACKEND_DIR, git_revision, percentile, setup_environment
+
+
+def seed(db, rows, rng):
+    db.users.delete_many({})
+    db.pull_requests.delete_many({})
+    db.invitation_codes.delete_many({})
+    now = datetime.utcnow()
+    db.users.insert_many([
+        {
+            "username": f"annotator{i}", "email": f"annotator{i}@polythink.studio",
+            "full_name": f"Annotator {i}", "role": "user", "is_active": True, "email_verified": True,
+            "allowed_datasets": [f"single-turn/set_{j}.json" for j in range(rng.randint(0, 5))],
+            # Fields the list view must not fetch
+            "hashed_password": "$2b$12$" + "x" * 53, "otp_code": "123456", "otp_created_at": now,
+            "verification_code": "ABCDEF", "reset_code": None,
+        }
+        for i in range(rows)
+    ])
+    db.pull_requests.insert_many([
+        {
+            "username": f"annotator{rng.randrange(rows)}", "dataset_path": "single-turn/set_0.json",
+            "status": rng.choice(("open", "merged", "rejected")), "created_at": now - timedelta(minutes=i),
+            "description": "Fix reasoning steps in several items", "accepted_count": rng.randint(0, 20),
+            "rejected_count": rng.randint(0, 5),
+        }
+        for i in range(rows)
+    ])
+    db.invitation_codes.insert_many([
+        {
+            "code": f"{i:08X}", "created_by": "admin", "is_used": False,
+            "created_at": now - timedelta(seconds=i), "expires_at": now + timedelta(minutes=15),
+        }
+        for i in range(rows)
+    ])
+
+
+def model_encode(docs, model):
+    from fastapi.encoders import jsonable_encoder
+
+    items = []
+    for doc in docs:
+        doc = dict(doc, _id=str(doc["_id"]))
+        items.append(model(**doc))
+    return json.dumps(jsonable_encoder(items)).encode("utf-8")
+
+
+def model_path(collection, model, sort=None):
+    """What the list endpoints did before: full documents through Pydantic."""
+    cursor = collection.find()
+    if sort:
+        cursor = cursor.sort(sort, -1)
+    return model_encode(cursor, model)
+
+
+def lean_encode(docs, fields):
+    from utils.serialization import lean_rows, lean_response
+
+    return lean_response(lean_rows(docs, fields)).body
+
+
+def measure(name, fn, rows, iterations, results):
+    seconds = []
+    size = 0
+    for _ in range(iterations):
+        t0 = time.perf_counter()
+        body = fn()
+        seconds.append(time.perf_counter() - t0)
+        size = len(body)
+    mean = statistics.mean(seconds)
+    entry = {
+        "operation": name,
+        "rows": rows,
+        "iterations": iterations,
+        "mean_ms": round(mean * 1000, 3),
+        "p50_ms": round(percentile(seconds, 50) * 1000, 3),
+        "p99_ms": round(percentile(seconds, 99) * 1000, 3),
+        "per_row_us": round(mean / rows * 1_000_000, 3),
+        "response_bytes": size,
+    }
+    results.append(entry)
+    print(f"{name:<32} mean={entry['mean_ms']:>9.2f}ms  per row={entry['per_row_us']:>7.2f}us  "
+          f"bytes={size}")
+    return entry
+
+
+def run(args):
+    workdir = Path(tempfile.mkdtemp(prefix="polythink-bench-"))
+    try:
+        setup_environment(args, workdir)
+        import database
+        from models import User, PullRequest, InvitationCode
+        from routers.users import read_users, list_invites, USER_LIST_FIELDS, INVITE_LIST_FIELDS
+        from routers.workflow import list_pull_requests, PR_LIST_FIELDS
+        from utils.serialization import projection
+
+        db = database.db
+        seed(db, args.rows, random.Random(args.seed))
+        admin = User(username="admin", role="admin", is_active=True)
+
+        def lean(handler, **kwargs):
+            return lambda: asyncio.run(handler(current_user=admin, **kwargs)).body
+
+        results = []
+        print(f"== {args.rows} rows, {args.iterations} iterations")
+        for label, collection, model, fields, handler, sort, kwargs in (
+            ("users", db.users, User, USER_LIST_FIELDS, read_users, None, {}),
+            ("pull requests", db.pull_requests, PullRequest, PR_LIST_FIELDS, list_pull_requests, "created_at", {}),
+            # The whole list, as before pagination
+            ("invites", db.invitation_codes, InvitationCode, INVITE_LIST_FIELDS, list_invites, "created_at",
+             {"offset": 0, "limit": args.rows}),
+        ):
+            full_docs = list(collection.find())
+            projected_docs = list(collection.find({}, projection(fields)))
+            pairs = (
+                (measure(f"{label} (model)", lambda: model_path(collection, model, sort), args.rows,
+                         args.iterations, results),
+                 measure(f"{label} (lean)", lean(handler, **kwargs), args.rows, args.iterations, results)),
+                (measure(f"{label} encode (model)", lambda: model_encode(full_docs, model), args.rows,
+                         args.iterations, results),
+                 measure(f"{label} encode (lean)", lambda: lean_encode(projected_docs, fields), args.rows,
+                         args.iterations, results)),
+            )
+            for before, after in pairs:
+                print(f"{'':<30} {after['operation']}: {before['mean_ms'] / after['mean_ms']:.1f}x faster, "
+                      f"{1 - after['response_bytes'] / before['response_bytes']:.0%} smaller")
+
+        report = {
+            "benchmark": "serialization",
+            "revision": git_revision(),
+            "timestamp": datetime.utcnow().isoformat() + "Z",
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "mongo_url": args.mongo_url.split("@")[-1],
+            "config": {"rows": args.rows, "iterations": args.iterations, "seed": args.seed},
+            "results": results,
+        }
+        output = Path(args.output)
+        output.parent.mkdir(parents=True, exist_ok=True)
+        output.write_text(json.dumps(report, indent=2))
+        print(f"\nResults written to {output}")
+        return 0
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=10000, help="Rows seeded per collection")
+    parser.add_argument("--iterations", type=int, default=5, help="Samples per operation")
+    parser.add_argument("--seed", type=int, default=1337)
+    parser.add_argument("--mongo-url", default="mongomock://",
+                        help="mongomock:// for the in-memory stand-in, or a mongodb:// URL")
+    parser.add_argument("--db-name", default="polythink_bench")
+    parser.add_argument("--output", default=None,
+                        help="Result file (default: benchmarks/results/serialization-<revision>.json)")
+    args = parser.parse_args(argv)
+    if args.output is None:
+        args.output = str(BACKEND_DIR / "benchmarks" / "results" / f"serialization-{git_revision() or 'local'}.json")
+    return args
+
+
+if __name__ == "__main__":
+    sys.exit(run(parse_args()))
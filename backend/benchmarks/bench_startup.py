@@ -0,0 +1,142 @@
+"""
+Cold start time of the API.
+
+Starts the app in a fresh interpreter for every sample, against a throwaway
+dataset repository and an empty database, and times each phase:
+
+    import           importing main (modules, routers), excluding create_app
+    create_app       building the application object
+    startup          the startup steps (indexes, default admin, git repo)
+    first response   the first request served (GET /metrics)
+    ready            all of the above, from the first line of the child process
+    process          wall time of the whole child, interpreter start and exit included
+
+Exits non-zero when the median "ready" time is over --budget-ms, or, with
+--compare, when a phase's p50 regressed by more than --threshold.
+
+Usage (from backend/):
+    pip install -r benchmarks/requirements.txt
+    python benchmarks/bench_startup.py --samples 10
+    python benchmarks/bench_startup.py --samples 10 --compare benchmarks/results/startup-abc1234.json
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+
+from bench_api import BACKEND_DIR, Recorder, compare, git_revision, setup_environment
+
+# Runs in the child; prints one JSON line of phase timings in seconds
+CHILD = """
+import json, sys, time
+started = time.perf_counter()
+import main
+imported = time.perf_counter()
+from fastapi.testclient import TestClient
+create_app = main.startup_duration._values[("create_app",)]
+client = TestClient(main.app)
+t0 = time.perf_counter()
+client.__enter__()
+t1 = time.perf_counter()
+client.get("/metrics").raise_for_status()
+t2 = time.perf_counter()
+client.__exit__(None, None, None)
+print(json.dumps({
+    "import": imported - started - create_app,
+    "create_app": create_app,
+    "startup": t1 - t0,
+    "first response": t2 - t1,
+    "ready": (imported - started) + (t2 - t0),
+}))
+"""
+
+PHASES = ("import", "create_app", "startup", "first response", "ready", "process")
+
+
+class Timing:
+    """Stands in for a response in Recorder samples."""
+    status_code = 200
+    content = b""
+
+
+def sample(env):
+    t0 = time.perf_counter()
+    result = subprocess.run([sys.executable, "-c", CHILD], cwd=str(BACKEND_DIR), env=env,
+                            capture_output=True, text=True)
+    elapsed = time.perf_counter() - t0
+    if result.returncode != 0:
+        raise RuntimeError(f"App failed to start:\n{result.stderr}")
+    timings = json.loads(result.stdout.strip().splitlines()[-1])
+    timings["process"] = elapsed
+    return timings
+
+
+def run(args):
+    workdir = Path(tempfile.mkdtemp(prefix="polythink-bench-"))
+    try:
+        setup_environment(args, workdir)
+        env = dict(os.environ, LOCK_DIR=str(workdir / "locks"), DATASET_CACHE_DIR=str(workdir / "cache"))
+
+        sample(env)  # Warm the OS file cache and .pyc files
+        samples = [sample(env) for _ in range(args.samples)]
+
+        recorder = Recorder()
+        print(f"== {args.samples} cold starts")
+        for phase in PHASES:
+            recorder.record(phase, [(s[phase], Timing) for s in samples])
+
+        ready = next(e for e in recorder.results if e["operation"] == "ready")
+        report = {
+            "benchmark": "startup",
+            "revision": git_revision(),
+            "timestamp": datetime.utcnow().isoformat() + "Z",
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "mongo_url": args.mongo_url.split("@")[-1],
+            "config": {"samples": args.samples, "budget_ms": args.budget_ms},
+            "results": recorder.results,
+        }
+        output = Path(args.output)
+        output.parent.mkdir(parents=True, exist_ok=True)
+        output.write_text(json.dumps(report, indent=2))
+        print(f"\nResults written to {output}")
+
+        status = 0
+        if ready["p50_ms"] > args.budget_ms:
+            print(f"\nStartup p50 {ready['p50_ms']:.0f}ms is over the {args.budget_ms:.0f}ms budget")
+            status = 1
+        if args.compare:
+            status = compare(report, json.loads(Path(args.compare).read_text()), args.threshold) or status
+        return status
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--samples", type=int, default=10, help="Cold starts to time")
+    parser.add_argument("--budget-ms", type=float, default=1000,
+                        help="Maximum median time until the first response")
+    parser.add_argument("--mongo-url", default="mongomock://",
+                        help="mongomock:// for the in-memory stand-in, or a mongodb:// URL")
+    parser.add_argument("--db-name", default="polythink_bench")
+    parser.add_argument("--output", default=None,
+                        help="Result file (default: benchmarks/results/startup-<revision>.json)")
+    parser.add_argument("--compare", default=None, help="Previous result file to compare against")
+    parser.add_argument("--threshold", type=float, default=0.10,
+                        help="Relative p50 slowdown reported as a regression")
+    args = parser.parse_args(argv)
+    if args.output is None:
+        args.output = str(BACKEND_DIR / "benchmarks" / "results" / f"startup-{git_revision() or 'local'}.json")
+    return args
+
+
+if __name__ == "__main__":
+    sys.exit(run(parse_args()))
@@ -1,16 +1,169 @@
-from pymongo import MongoClient
-import os
-from dotenv import load_dotenv
+"""
+Mongo client and collections.
 
-load_dotenv()
+Nothing connects at import time: the client is created on first use, and the
+module-level collections are stand-ins that resolve to the real collection
+the first time one of their methods is called. `db` and `client` are
+resolved the same way.
+"""
+import threading
+from pymongo import MongoClient, errors, monitoring
+from settings import get_settings
+from utils.metrics import mongo_command_duration
+from utils import tracing
 
-MONGODB_URL = os.getenv("MONGODB_URL", "mongodb://localhost:27017")
-DB_NAME = os.getenv("DB_NAME", "polythink_studio")
+MONGODB_URL = get_settings().mongodb_url
+DB_NAME = get_settings().db_name
 
-client = MongoClient(MONGODB_URL)
-db = client[DB_NAME]
-users_collection = db["users"]
-pull_requests_collection = db["pull_requests"]
-user_datasets_collection = db["user_datasets"]
-invitation_codes_collection = db["invitation_codes"]
+class CommandTimingListener(monitoring.CommandListener):
+    """Feeds pymongo command monitoring events into the metrics registry and tracing."""
+
+    def __init__(self):
+        self._inflight = {}
+
+    def started(self, event):
+        # The collection name is only available on the started event
+        collection = event.command.get(event.command_name)
+        collection = collection if isinstance(collection, str) else ""
+        mongo_span = tracing.start_span(f"mongo {event.command_name}", collection=collection)
+        self._inflight[event.request_id] = (collection, mongo_span)
+
+    def succeeded(self, event):
+        self._record(event, "ok")
+
+    def failed(self, event):
+        self._record(event, "error")
+
+    def _record(self, event, outcome):
+        collection, mongo_span = self._inflight.pop(event.request_id, ("", tracing.NOOP_SPAN))
+        if outcome == "error":
+            mongo_span.set_attribute("error", str(getattr(event, "failure", "")))
+        mongo_span.end()
+        mongo_command_duration.observe(
+            event.duration_micros / 1_000_000,
+            command=event.command_name, collection=collection, outcome=outcome
+        )
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    global _client
+    with _client_lock:
+        if _client is None:
+            if MONGODB_URL.startswith("mongomock://"):
+                # In-memory stand-in, used by the benchmark suite (pip install mongomock)
+                import mongomock
+                _client = mongomock.MongoClient()
+            else:
+                _client = MongoClient(MONGODB_URL, event_listeners=[CommandTimingListener()])
+        return _client
+
+
+def get_db():
+    return get_client()[DB_NAME]
+
+
+class _LazyCollection:
+    """A collection that is looked up on the first attribute access."""
+
+    def __init__(self, name):
+        self._name = name
+        self._collection = None
+
+    def __getattr__(self, attr):
+        if self._collection is None:
+            self._collection = get_db()[self._name]
+        return getattr(self._collection, attr)
+
+    def __repr__(self):
+        return f"<lazy collection {self._name!r}>"
+
+
+def __getattr__(name):
+    if name == "client":
+        return get_client()
+    if name == "db":
+        return get_db()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+users_collection = _LazyCollection("users")
+pull_requests_collection = _LazyCollection("pull_requests")
+user_datasets_collection = _LazyCollection("user_datasets")
+invitation_codes_collection = _LazyCollection("invitation_codes")
+validation_reports_collection = _LazyCollection("validation_reports")
+fork_archive_collection = _LazyCollection("fork_archive")
+gc_runs_collection = _LazyCollection("gc_runs")
+scheduled_jobs_collection = _LazyCollection("scheduled_jobs")
+contribution_daily_collection = _LazyCollection("contribution_daily")
+contribution_windows_collection = _LazyCollection("contribution_windows")
+deleted_users_collection = _LazyCollection("deleted_users")
+email_outbox_collection = _LazyCollection("email_outbox")
+
+
+def ensure_indexes():
+    """
+    Create the indexes the app relies on. create_index is idempotent, so every
+    worker can run this at startup.
+    """
+    try:
+        # Makes default admin creation race free across workers
+        users_collection.create_index("username", unique=True)
+    except errors.PyMongoError as e:
+        # e.g. pre-existing duplicates; the app still works, just without the guarantee
+        print(f"Could not create unique index on users.username: {e}")
+    try:
+        # One fork per user and dataset; lets conditional fork writes detect newer data
+        user_datasets_collection.create_index([("username", 1), ("original_path", 1)], unique=True)
+    except errors.PyMongoError as e:
+        print(f"Could not create unique index on user_datasets: {e}")
+    try:
+        # Fork GC scans forks by last save
+        user_datasets_collection.create_index([("updated_at", 1)])
+    except errors.PyMongoError as e:
+        print(f"Could not create user_datasets.updated_at index: {e}")
+    try:
+        # Bulk invite generation relies on this to detect (rare) random code collisions
+        invitation_codes_collection.create_index("code", unique=True)
+    except errors.PyMongoError as e:
+        print(f"Could not create unique index on invitation_codes.code: {e}")
+    try:
+        # Mongo deletes codes once expires_at passes; redeemed codes have no expires_at
+        invitation_codes_collection.create_index("expires_at", expireAfterSeconds=0)
+        invitation_codes_collection.create_index([("created_at", -1)])
+    except errors.PyMongoError as e:
+        print(f"Could not create invitation_codes indexes: {e}")
+    try:
+        # Open PRs per dataset, for the review queue
+        pull_requests_collection.create_index([("status", 1), ("dataset_path", 1), ("created_at", 1)])
+    except errors.PyMongoError as e:
+        print(f"Could not create pull_requests index: {e}")
+    try:
+        # PRs of a fork, for fork GC and user deletion
+        pull_requests_collection.create_index([("username", 1), ("dataset_path", 1)])
+        fork_archive_collection.create_index([("username", 1), ("original_path", 1)])
+        gc_runs_collection.create_index([("started_at", -1)])
+        deleted_users_collection.create_index([("claimed_until", 1), ("deleted_at", 1)])
+    except errors.PyMongoError as e:
+        print(f"Could not create fork GC indexes: {e}")
+    try:
+        # Leaderboards sort contribution_windows by one window's metric (see utils/leaderboard.py)
+        contribution_daily_collection.create_index([("username", 1), ("day", 1)], unique=True)
+        contribution_windows_collection.create_index("as_of")
+        for window in (7, 30, 90):
+            for metric in ("accepted", "rejected", "merged_prs"):
+                contribution_windows_collection.create_index([(f"d{window}.{metric}", -1), ("_id", 1)])
+    except errors.PyMongoError as e:
+        print(f"Could not create leaderboard indexes: {e}")
+    try:
+        # The email sender claims due messages oldest first
+        email_outbox_collection.create_index([("status", 1), ("due_at", 1)])
+    except errors.PyMongoError as e:
+        print(f"Could not create email_outbox index: {e}")
+    try:
+        validation_reports_collection.create_index("dataset_path", unique=True)
+    except errors.PyMongoError as e:
+        print(f"Could not create unique index on validation_reports: {e}")
 
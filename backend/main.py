@@ -1,46 +1,204 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import JSONResponse, PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-import json
-import os
-from pathlib import Path
-from typing import List, Dict, Any, Optional
-from dotenv import load_dotenv
-from routers import users, datasets, workflow
-from database import users_collection
-from auth import get_password_hash
-
-load_dotenv()
-
-app = FastAPI()
-
-# Configure CORS
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],  # Allow all origins for development
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+from fastapi.middleware.gzip import GZipMiddleware
+import time
+from routers import users, datasets, workflow, admin, events
+from database import users_collection, ensure_indexes
+from pymongo.errors import DuplicateKeyError
+from auth import admin_username_for_token
+from settings import get_settings
+from utils import git_utils, leaderboard
+from utils.fork_gc import collector as fork_gc
+from utils.email_outbox import outbox
+from utils.write_behind import fork_buffer
+from utils.dataset_io import clean_staging, DatasetReadError
+from utils import validation
+from utils.metrics import registry, http_request_duration
+from utils.tracing import start_trace, exporter as trace_exporter
+from utils.profiling import RequestProfile
+
+METRICS_TOKEN = get_settings().metrics_token
+
+# bcrypt hash of "admin123", the documented default admin password. Hashing it
+# on every start against an empty database took most of the startup time.
+DEFAULT_ADMIN_PASSWORD_HASH = "$2b$12$E9ZeklWcqP5P3tcojL7iN.tYeFphV5DzPqW6jkdiuLMlDbfchUdUG"
+
+startup_duration = registry.gauge(
+    "app_startup_step_seconds", "Duration of each startup step of this worker.", ("step",)
 )
 
-app.include_router(users.router)
-app.include_router(datasets.router)
-app.include_router(workflow.router)
-
-@app.on_event("startup")
-async def startup_db_client():
-    # Create default admin if not exists
-    if not users_collection.find_one({"role": "admin"}):
-        admin_user = {
-            "username": "admin",
-            "full_name": "System Administrator",
-            "email": "admin@example.com",
-            "role": "admin",
-            "hashed_password": get_password_hash("admin123")
-        }
-        users_collection.insert_one(admin_user)
+async def record_request_metrics(request: Request, call_next):
+    started = time.perf_counter()
+    status_code = 500
+    try:
+        response = await call_next(request)
+        status_code = response.status_code
+        return response
+    finally:
+        # Label by route template (/workflow/prs/{pr_id}/diff), not the raw path,
+        # so that label cardinality stays bounded
+        route = request.scope.get("route")
+        http_request_duration.observe(
+            time.perf_counter() - started,
+            method=request.method,
+            route=getattr(route, "path", "unmatched"),
+            status=status_code,
+        )
+
+def _admin_of(request: Request):
+    """The username of the admin whose bearer token the request carries, or None."""
+    authorization = request.headers.get("Authorization", "")
+    return admin_username_for_token(authorization[7:].strip()) if authorization.startswith("Bearer ") else None
+
+async def trace_requests(request: Request, call_next):
+    # Admins can force a trace with `X-Trace: 1`, regardless of TRACE_SAMPLE_RATE.
+    # Anyone else would be able to fill the trace exporter.
+    force = request.headers.get("X-Trace") == "1" and _admin_of(request) is not None
+    with start_trace(f"{request.method} {request.url.path}", force=force, method=request.method) as root:
+        response = await call_next(request)
+        if root.span_id is not None:
+            route = request.scope.get("route")
+            if route is not None:
+                root.name = f"{request.method} {route.path}"
+            root.set_attributes(path=request.url.path, status_code=response.status_code)
+            response.headers["X-Trace-Id"] = root.trace.trace_id
+        return response
+
+async def profile_requests(request: Request, call_next):
+    # Admins can profile a single request with `X-Profile: 1` or `?__profile=1`.
+    # "cpu" instead of "1" skips the (expensive) tracemalloc allocation snapshot.
+    mode = request.headers.get("X-Profile") or request.query_params.get("__profile")
+    if mode not in ("1", "cpu"):
+        return await call_next(request)
+
+    username = _admin_of(request)
+    if username is None:
+        return await call_next(request)
+
+    profile = RequestProfile(request.method, request.url.path, username, memory=(mode == "1")).start()
+    try:
+        response = await call_next(request)
+    except Exception:
+        profile.finish(status_code=500)
+        raise
+    profile.finish(status_code=response.status_code)
+    response.headers["X-Profile-Id"] = profile.id
+    return response
+
+async def metrics(request: Request):
+    if METRICS_TOKEN and request.headers.get("Authorization") != f"Bearer {METRICS_TOKEN}":
+        raise HTTPException(status_code=401, detail="Invalid metrics token")
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
+
+def create_default_admin():
+    # Every worker runs this; the unique username index makes sure only one
+    # of them actually inserts.
+    if users_collection.find_one({"role": "admin"}, {"_id": 1}):
+        return
+    admin_user = {
+        "username": "admin",
+        "full_name": "System Administrator",
+        "email": "admin@example.com",
+        "role": "admin",
+        "hashed_password": DEFAULT_ADMIN_PASSWORD_HASH
+    }
+    try:
+        result = users_collection.update_one(
+            {"username": "admin"}, {"$setOnInsert": admin_user}, upsert=True
+        )
+    except DuplicateKeyError:
+        result = None  # another worker inserted it first
+    if result is not None and result.upserted_id is not None:
         print("Default admin user created: admin / admin123")
 
+# Run in order when a worker starts; each step's duration is exported as
+# app_startup_step_seconds. Steps must be cheap and idempotent.
+STARTUP_STEPS = (
+    ("indexes", ensure_indexes),
+    ("default_admin", create_default_admin),
+    ("git_repo", git_utils.init_repo_if_needed),
+    ("dataset_staging", lambda: clean_staging(workflow.BASE_DIR)),
+    ("git_maintenance", git_utils.start_maintenance_scheduler),
+    ("fork_gc", lambda: fork_gc.start(workflow.BASE_DIR)),
+    ("leaderboard_backfill", leaderboard.start_backfill),
+    ("leaderboard_roller", leaderboard.start_roller),
+    ("email_outbox", outbox.start),
+)
+
+def run_startup_steps(steps=STARTUP_STEPS):
+    """Run the startup steps, returning {step: seconds}."""
+    timings = {}
+    for step, fn in steps:
+        started = time.perf_counter()
+        fn()
+        timings[step] = time.perf_counter() - started
+        startup_duration.set(timings[step], step=step)
+    summary = ", ".join(f"{step} {seconds * 1000:.0f}ms" for step, seconds in timings.items())
+    print(f"Startup took {sum(timings.values()) * 1000:.0f}ms ({summary})")
+    return timings
+
+async def dataset_read_failed(request: Request, exc: DatasetReadError):
+    # Nothing is saved over a dataset that was only partly read
+    print(exc)
+    return JSONResponse(status_code=500, content={"detail": "Failed to read dataset"})
+
+
+def create_app() -> FastAPI:
+    """
+    Build the application. Importing and building it does no I/O: Mongo is
+    connected on first use and the startup steps run when the server starts.
+    """
+    started = time.perf_counter()
+    app = FastAPI()
+
+    # Configure CORS
+    app.add_middleware(
+        CORSMiddleware,
+        allow_origins=["*"],  # Allow all origins for development
+        allow_credentials=True,
+        allow_methods=["*"],
+        allow_headers=["*"],
+        expose_headers=["ETag", "X-Total-Count", "X-Trace-Id", "X-Profile-Id"],
+    )
+    # Dataset and diff payloads are large, highly compressible JSON
+    app.add_middleware(GZipMiddleware, minimum_size=1024, compresslevel=5)
+    app.middleware("http")(record_request_metrics)
+    app.middleware("http")(trace_requests)
+    app.middleware("http")(profile_requests)
+
+    app.add_api_route("/metrics", metrics, methods=["GET"], include_in_schema=False)
+    app.add_exception_handler(DatasetReadError, dataset_read_failed)
+    app.include_router(users.router)
+    app.include_router(datasets.router)
+    app.include_router(workflow.router)
+    app.include_router(admin.router)
+    app.include_router(events.router)
+
+    @app.on_event("startup")
+    async def run_startup():
+        run_startup_steps()
+
+    @app.on_event("shutdown")
+    async def flush_fork_saves():
+        # Buffered autosaves only live in memory until written
+        fork_buffer.stop()
+
+    @app.on_event("shutdown")
+    async def shutdown_validation_pool():
+        validation.shutdown_pool()
+
+    @app.on_event("shutdown")
+    async def shutdown_email_outbox():
+        # Send what is due before exiting; the rest stays queued in Mongo
+        outbox.stop()
+        trace_exporter.flush()
+
+    startup_duration.set(time.perf_counter() - started, step="create_app")
+    return app
+
+app = create_app()
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
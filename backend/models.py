@@ -51,6 +51,19 @@ class User(BaseModel):
             }
         }
 
+class UserSummary(BaseModel):
+    """A row of the admin user list: User without credentials or one-time codes."""
+    id: Optional[str] = Field(None, alias="_id")
+    username: str
+    email: Optional[str] = None
+    full_name: Optional[str] = None
+    role: str = "user"
+    is_active: bool = False
+    email_verified: bool = False
+    allowed_datasets: List[str] = Field(default_factory=list)
+    sample_stats: Optional[dict] = None
+    contribution_stats: Optional[dict] = None
+
 class UserInDB(User):
     hashed_password: str
 
@@ -93,6 +106,7 @@ class PullRequest(BaseModel):
     dataset_path: str
     status: str = "open" # open, merged, rejected
     created_at: datetime = Field(default_factory=datetime.utcnow)
+    closed_at: Optional[datetime] = None
     description: Optional[str] = None
     accepted_count: int = 0
     rejected_count: int = 0
@@ -0,0 +1,55 @@
+from fastapi import APIRouter, HTTPException, Depends, Query
+from fastapi.responses import PlainTextResponse
+from auth import get_current_admin_user
+from database import gc_runs_collection
+from models import User
+from routers import workflow
+from utils import admission, fork_gc, profiling
+from utils.admission import Limiter
+
+router = APIRouter()
+
+# Request Profiles (captured with the X-Profile header, see main.py)
+@router.get("/admin/profiles")
+async def list_profiles(current_user: User = Depends(get_current_admin_user)):
+    return {"profiles": profiling.list_profiles()}
+
+@router.get("/admin/profiles/{profile_id}")
+async def get_profile(
+    profile_id: str,
+    format: str = Query("json", pattern="^(json|collapsed)$"),
+    current_user: User = Depends(get_current_admin_user)
+):
+    profile = profiling.load_profile(profile_id)
+    if not profile:
+        raise HTTPException(status_code=404, detail="Profile not found")
+
+    if format == "collapsed":
+        # Folded stacks, loadable in speedscope or flamegraph.pl
+        return PlainTextResponse(
+            profiling.collapsed_stacks(profile["call_tree"]),
+            headers={"Content-Disposition": f'attachment; filename="profile-{profile_id}.folded"'}
+        )
+    return profile
+
+# Admission control (see utils/admission.py)
+@router.get("/admin/admission")
+async def admission_status(current_user: User = Depends(get_current_admin_user)):
+    """Slots in use and queued requests per limited endpoint."""
+    return admission.pool.snapshot()
+
+# Fork GC (see utils/fork_gc.py)
+@router.get("/admin/gc")
+async def fork_gc_runs(
+    limit: int = Query(20, ge=1, le=200),
+    current_user: User = Depends(get_current_admin_user)
+):
+    """Reports of the latest fork GC runs and user purges, newest first."""
+    runs = list(gc_runs_collection.find({}, {"_id": 0}).sort("started_at", -1).limit(limit))
+    return {"runs": runs, "purges_pending": fork_gc.collector.pending_count()}
+
+@router.post("/admin/gc")
+@Limiter("fork_gc", limit=1, queue_size=0)
+def run_fork_gc(dry_run: bool = False, current_user: User = Depends(get_current_admin_user)):
+    """Run fork GC now; with dry_run, only report what it would remove."""
+    return fork_gc.collect(workflow.BASE_DIR, dry_run=dry_run)
@@ -1,17 +1,37 @@
-from fastapi import APIRouter, HTTPException, Depends, Query
-from typing import List, Dict, Any
+from fastapi import APIRouter, HTTPException, Depends, Query, Request, Response, UploadFile, File, Form
+from starlette.concurrency import run_in_threadpool
+from typing import List, Dict, Any, Optional
+from pydantic import BaseModel
 from pathlib import Path
-import json
 import os
-from auth import get_current_active_user
-from database import user_datasets_collection
+import re
+import time
+from datetime import datetime
+from auth import get_current_active_user, get_current_admin_user
+from database import user_datasets_collection, validation_reports_collection, users_collection
 from models import User, DatasetContent, UserDataset
+from utils.git_utils import DATASET_DIR
+from utils.dataset_io import (
+    load_dataset, open_dataset, dataset_exists, dataset_files, dataset_revision, convert_layout, StagedDataset
+)
+from utils.locks import dataset_lock
+from utils.tracing import annotate
+from utils.write_behind import fork_buffer, ForkWriteError
+from utils.fork_base import capture_base
+from utils.http_cache import make_etag, is_not_modified, not_modified, set_cache_headers
+from utils import validation, item_filter
+from utils.importer import ImportStats, ImportFormatError, open_upload, iter_values, import_items
+from utils.events import bus
+from utils.admission import Limiter, INTERACTIVE, ADMISSION_CAPACITY
 
 router = APIRouter()
 
 def find_dataset_dir():
     # Try to find the directory containing 'multi-turn' or 'single-turn'
     candidates = [
+        # Explicitly configured dataset repository (DATASET_REPO_DIR)
+        DATASET_DIR / "dataset",
+        DATASET_DIR,
         # Standard structure: project/dataset/dataset
         Path(__file__).resolve().parent.parent.parent / "dataset" / "dataset",
         # Flat structure: project/dataset
@@ -23,34 +43,54 @@ def find_dataset_dir():
     
     for path in candidates:
         if path.exists() and ((path / "multi-turn").exists() or (path / "single-turn").exists()):
-            print(f"DEBUG: Found valid dataset dir at {path}")
             return path
             
     # Fallback to standard if nothing found (will likely fail but better than None crash)
-    print("DEBUG: Could not find valid dataset dir with subfolders. Defaulting.")
     return Path(__file__).resolve().parent.parent.parent / "dataset" / "dataset"
 
 BASE_DIR = find_dataset_dir()
 
+def publish_dataset_updated(dataset_path: str):
+    """Tell admins, and the users allowed to open the dataset, that its main content changed."""
+    readers = [user["username"] for user in users_collection.find({"allowed_datasets": dataset_path}, {"username": 1})]
+    bus.publish("dataset.updated", {"dataset_path": dataset_path}, users=readers, roles=["admin"])
+
+def fork_revision(user_dataset: dict):
+    """Revision of a fork document (forks saved before revisions existed fall back to updated_at)."""
+    return user_dataset.get("revision") or user_dataset.get("updated_at")
+
 @router.get("/datasets")
-async def list_datasets(current_user: User = Depends(get_current_active_user)):
+async def list_datasets(
+    request: Request,
+    response: Response,
+    current_user: User = Depends(get_current_active_user)
+):
     print(f"DEBUG: list_datasets called by {current_user.username} (Role: {current_user.role})")
     print(f"DEBUG: Using BASE_DIR: {BASE_DIR}")
     
     datasets = []
+    mtimes = []
     
     for turn_type in ['multi-turn', 'single-turn']:
         dir_path = BASE_DIR / turn_type
         if dir_path.exists():
             files = list(dir_path.glob('*.json'))
+            # Sharded datasets are listed under their logical .json name
+            for shards in dir_path.glob('*.shards'):
+                if shards.with_suffix('.json') not in files:
+                    files.append(shards.with_suffix('.json'))
             print(f"DEBUG: Found {len(files)} files in {turn_type}")
             for f in files:
+                stats = [p.stat() for p in dataset_files(f)]
+                if not stats:
+                    continue
                 datasets.append({
                     "name": f.stem.replace('_', ' ').title(),
                     "path": f"{turn_type}/{f.name}",
                     "type": turn_type,
-                    "size": f.stat().st_size
+                    "size": sum(s.st_size for s in stats)
                 })
+                mtimes.append(max(s.st_mtime_ns for s in stats))
         else:
             print(f"DEBUG: Directory not found: {dir_path}")
     
@@ -64,37 +104,77 @@ async def list_datasets(current_user: User = Depends(get_current_active_user)):
         print(f"DEBUG: Datasets after filtering: {len(datasets)}")
     else:
         print("DEBUG: User is admin. Showing all.")
+
+    # The listing only changes when a file is added, removed or rewritten
+    etag = make_etag("datasets", current_user.role, sorted(current_user.allowed_datasets),
+                     [(d["path"], d["size"]) for d in datasets], sorted(mtimes))
+    if is_not_modified(request, etag):
+        return not_modified(etag)
+    set_cache_headers(response, etag)
         
     return {"datasets": datasets}
 
 @router.get("/datasets/{turn_type}/{filename}")
+@Limiter("dataset_load", limit=ADMISSION_CAPACITY, priority=INTERACTIVE)
 async def get_dataset(
     turn_type: str, 
     filename: str, 
+    request: Request,
+    response: Response,
     fork: bool = Query(False),
+    offset: int = Query(0, ge=0),
+    limit: Optional[int] = Query(None, ge=1),
     current_user: User = Depends(get_current_active_user)
 ):
+    """
+    Full dataset content, or with `limit` a page of it (`offset`..`offset+limit`)
+    plus the total item count. Pages of the main file are decoded lazily from
+    its memory-mapped sidecar, so large files are never materialized in full.
+    """
     dataset_path = f"{turn_type}/{filename}"
+    paged = limit is not None
+    annotate(dataset_path=dataset_path, fork=fork, offset=offset, limit=limit)
+    fork_query = {
+        "username": current_user.username,
+        "original_path": dataset_path
+    }
     
     # If requesting fork, check DB first
     if fork:
-        user_dataset = user_datasets_collection.find_one({
-            "username": current_user.username,
-            "original_path": dataset_path
-        })
-        if user_dataset:
-            return {"content": user_dataset["content"], "is_fork": True}
+        fork_buffer.flush(current_user.username, dataset_path)
+        # Fetch only the revision first so an unchanged fork costs no content transfer
+        fork_meta = user_datasets_collection.find_one(fork_query, {"content": 0})
+        if fork_meta:
+            etag = make_etag("fork", fork_meta["_id"], fork_revision(fork_meta), offset, limit)
+            if is_not_modified(request, etag):
+                return not_modified(etag)
+            if paged:
+                page = user_datasets_collection.find_one(fork_query, {"content": {"$slice": [offset, limit]}})
+                if page:
+                    set_cache_headers(response, etag)
+                    return {"content": page["content"], "is_fork": True,
+                            "total": fork_length(fork_query), "offset": offset, "limit": limit}
+            user_dataset = user_datasets_collection.find_one(fork_query)
+            if user_dataset:
+                set_cache_headers(response, make_etag("fork", user_dataset["_id"], fork_revision(user_dataset), offset, limit))
+                return {"content": user_dataset["content"], "is_fork": True}
     
     # Fallback to disk (Main Repo)
     file_path = BASE_DIR / turn_type / filename
+    etag = make_etag("main", dataset_path, dataset_revision(file_path), offset, limit)
+    exists = dataset_exists(file_path)
+    if exists and is_not_modified(request, etag):
+        return not_modified(etag)
+
+    if paged and exists:
+        view = open_dataset(file_path)
+        if view is None:
+            raise HTTPException(status_code=500, detail="Failed to read dataset")
+        set_cache_headers(response, etag)
+        return {"content": view[offset:offset + limit], "is_fork": False, "has_changes": False,
+                "total": len(view), "offset": offset, "limit": limit}
     
-    main_content = []
-    if file_path.exists():
-        try:
-            with open(file_path, 'r', encoding='utf-8') as f:
-                main_content = json.load(f)
-        except:
-            pass
+    main_content = load_dataset(file_path)
 
     if fork:
         user_dataset = user_datasets_collection.find_one({
@@ -106,35 +186,281 @@ async def get_dataset(
             has_changes = user_dataset["content"] != main_content
             return {"content": user_dataset["content"], "is_fork": True, "has_changes": has_changes}
     
-    if not file_path.exists():
+    if not exists:
         raise HTTPException(status_code=404, detail="Dataset not found")
     
+    set_cache_headers(response, etag)
     return {"content": main_content, "is_fork": False, "has_changes": False}
 
+@router.get("/datasets/{turn_type}/{filename}/query")
+@Limiter("dataset_query")
+def query_dataset(
+    turn_type: str,
+    filename: str,
+    expression: str = Query("", alias="filter", max_length=2000),
+    fork: bool = Query(False),
+    offset: int = Query(0, ge=0),
+    limit: int = Query(50, ge=1, le=500),
+    current_user: User = Depends(get_current_active_user)
+):
+    """
+    Indices and previews of the items matching a filter expression, e.g.
+    `assistant.max_thinking_chars > 4000` or `turns > 6 and first_role != "system"`
+    (see utils/item_filter.py for the columns). An empty filter matches every item.
+    With `fork`, the user's fork is queried if they have one.
+    """
+    dataset_path = f"{turn_type}/{filename}"
+    annotate(dataset_path=dataset_path, fork=fork, filter=expression)
+    items = None
+    is_fork = False
+    if fork:
+        fork_buffer.flush(current_user.username, dataset_path)
+        user_dataset = user_datasets_collection.find_one({
+            "username": current_user.username,
+            "original_path": dataset_path
+        })
+        if user_dataset:
+            items = user_dataset["content"]
+            is_fork = True
+            columns = item_filter.cache.for_content(
+                f"fork:{user_dataset['_id']}", fork_revision(user_dataset), items
+            )
+    if items is None:
+        columns, items = item_filter.cache.for_dataset(BASE_DIR / turn_type / filename)
+        if items is None:
+            raise HTTPException(status_code=404, detail="Dataset not found")
+    try:
+        result = item_filter.run_query(columns, items, expression, offset, limit)
+    except item_filter.FilterError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid filter: {e}")
+    return {**result, "is_fork": is_fork}
+
+class DatasetLayout(BaseModel):
+    layout: str  # "single" | "sharded"
+    shard_size: Optional[int] = None
+
+@router.post("/datasets/{turn_type}/{filename}/layout")
+@Limiter("dataset_layout", limit=1)
+def set_dataset_layout(
+    turn_type: str,
+    filename: str,
+    data: DatasetLayout,
+    current_user: User = Depends(get_current_admin_user)
+):
+    """
+    Store a dataset as one file or as a directory of fixed-size shards.
+    The content and the dataset's path stay the same; commit and push as usual.
+    """
+    if data.layout not in ("single", "sharded"):
+        raise HTTPException(status_code=400, detail="layout must be 'single' or 'sharded'")
+    if data.shard_size is not None and data.shard_size < 1:
+        raise HTTPException(status_code=400, detail="shard_size must be positive")
+    file_path = BASE_DIR / turn_type / filename
+    with dataset_lock(file_path):
+        if not dataset_exists(file_path):
+            raise HTTPException(status_code=404, detail="Dataset not found")
+        convert_layout(file_path, data.layout, data.shard_size)
+    return {"status": "success", "layout": data.layout, "files": len(dataset_files(file_path))}
+
+@router.post("/datasets/{turn_type}/{filename}/audit")
+@Limiter("dataset_audit", limit=1)
+async def audit_dataset(
+    turn_type: str,
+    filename: str,
+    current_user: User = Depends(get_current_admin_user)
+):
+    """Validate every item of the main dataset (in a process pool) and store the report."""
+    dataset_path = f"{turn_type}/{filename}"
+    file_path = BASE_DIR / turn_type / filename
+    if not dataset_exists(file_path):
+        raise HTTPException(status_code=404, detail="Dataset not found")
+    revision = dataset_revision(file_path)
+    started = time.perf_counter()
+    report = await run_in_threadpool(validation.audit_dataset, file_path, dataset_path)
+    report.update({
+        "dataset_path": dataset_path,
+        "revision": revision,
+        "checked_at": datetime.utcnow(),
+        "duration_ms": round((time.perf_counter() - started) * 1000, 1),
+    })
+    validation_reports_collection.replace_one({"dataset_path": dataset_path}, report, upsert=True)
+    report.pop("_id", None)
+    return report
+
+@router.get("/validation/report")
+async def validation_report(
+    dataset_path: Optional[str] = None,
+    forks: bool = True,
+    current_user: User = Depends(get_current_admin_user)
+):
+    """
+    Violations by dataset and item index: the last audit of each main dataset
+    (`stale` once main changed since) and the changed items of each fork.
+    """
+    query = {"dataset_path": dataset_path} if dataset_path else {}
+    datasets = {}
+    for report in validation_reports_collection.find(query, {"_id": 0}):
+        report["stale"] = report["revision"] != dataset_revision(BASE_DIR / report["dataset_path"])
+        datasets[report["dataset_path"]] = {"dataset_path": report["dataset_path"], "main": report, "forks": []}
+    if forks:
+        fork_query = {"validation.violations.0": {"$exists": True}}
+        if dataset_path:
+            fork_query["original_path"] = dataset_path
+        for fork in user_datasets_collection.find(fork_query, {"username": 1, "original_path": 1, "validation": 1}):
+            entry = datasets.setdefault(fork["original_path"],
+                                        {"dataset_path": fork["original_path"], "main": None, "forks": []})
+            entry["forks"].append({
+                "username": fork["username"],
+                "revision": fork["validation"].get("revision"),
+                "violations": fork["validation"]["violations"],
+            })
+    return {"datasets": [datasets[path] for path in sorted(datasets)]}
+
+TURN_TYPES = ("multi-turn", "single-turn")
+
+def _import_filename(name: str) -> str:
+    """foo.jsonl.gz -> foo.json; anything but letters, digits, '-', '_' and '.' is dropped."""
+    stem = Path(name or "").name
+    for suffix in (".gz", ".jsonl", ".ndjson", ".json"):
+        if stem.lower().endswith(suffix):
+            stem = stem[:-len(suffix)]
+    stem = re.sub(r"[^A-Za-z0-9_.-]", "", stem.replace(" ", "_")).strip(".")
+    if not stem:
+        raise HTTPException(status_code=400, detail="A dataset filename is required")
+    return f"{stem}.json"
+
+@router.post("/admin/datasets/{turn_type}")
+@Limiter("dataset_import", limit=1)
+async def import_dataset(
+    turn_type: str,
+    file: UploadFile = File(...),
+    filename: Optional[str] = Form(None),
+    overwrite: bool = Form(False),
+    on_invalid: str = Form("reject", pattern="^(reject|skip|keep)$"),
+    layout: str = Form("auto", pattern="^(auto|single|sharded)$"),
+    shard_size: Optional[int] = Form(None, ge=1),
+    format: str = Form("auto", pattern="^(auto|json|jsonl)$"),
+    current_user: User = Depends(get_current_admin_user)
+):
+    """
+    Create (or with `overwrite`, replace) a dataset from an uploaded JSON array,
+    JSON Lines file, or either gzipped. `format` "auto" goes by the file
+    extension (.jsonl / .ndjson), then by the content. Items are parsed, normalized and
+    validated as they stream in and staged next to the target, which is swapped
+    in atomically; memory use doesn't grow with the upload. `on_invalid` says
+    what happens to items with validation errors: reject the upload, skip
+    them, or keep them.
+    """
+    if turn_type not in TURN_TYPES:
+        raise HTTPException(status_code=400, detail=f"turn_type must be one of: {', '.join(TURN_TYPES)}")
+    name = _import_filename(filename or file.filename)
+    dataset_path = f"{turn_type}/{name}"
+    file_path = BASE_DIR / turn_type / name
+    if dataset_exists(file_path) and not overwrite:
+        raise HTTPException(status_code=409, detail=f"{dataset_path} already exists; set overwrite to replace it")
+    annotate(dataset_path=dataset_path, on_invalid=on_invalid, format=format)
+
+    started = time.perf_counter()
+    file_path.parent.mkdir(parents=True, exist_ok=True)
+    staged = StagedDataset(file_path, layout, shard_size)
+    stats = ImportStats()
+    try:
+        if format == "auto" and re.search(r"\.(jsonl|ndjson)(\.gz)?$", file.filename or "", re.IGNORECASE):
+            format = "jsonl"
+        items = import_items(iter_values(open_upload(file.file), format=format), turn_type, on_invalid, stats)
+        await run_in_threadpool(staged.write, items)
+
+        def install():
+            with dataset_lock(file_path):
+                # Another import (or a merge creating the file) may have won the race
+                if dataset_exists(file_path) and not overwrite:
+                    raise HTTPException(status_code=409,
+                                        detail=f"{dataset_path} already exists; set overwrite to replace it")
+                return staged.install()
+
+        # The lock is a blocking flock: wait for it off the event loop
+        stored_layout = await run_in_threadpool(install)
+    except (ImportFormatError, UnicodeDecodeError, OSError, EOFError) as e:
+        staged.discard()
+        raise HTTPException(status_code=400, detail=f"Could not import {file.filename}: {e}")
+    except BaseException:
+        staged.discard()
+        raise
+
+    # The listing picks the file up by itself; record the validation results
+    # as the dataset's audit so the report is current right away
+    report = stats.report()
+    audit = {
+        "dataset_path": dataset_path,
+        "revision": dataset_revision(file_path),
+        "items": report["items"],
+        "violations": report["violations"],
+        "counts": report["counts"],
+        "truncated": report["truncated"],
+        "checked_at": datetime.utcnow(),
+        "duration_ms": round((time.perf_counter() - started) * 1000, 1),
+        "source": "import",
+    }
+    validation_reports_collection.replace_one({"dataset_path": dataset_path}, audit, upsert=True)
+    publish_dataset_updated(dataset_path)
+    annotate(items=report["items"], skipped=report["skipped"], bytes=staged.bytes)
+    return {
+        "status": "success",
+        "dataset_path": dataset_path,
+        "layout": stored_layout,
+        "items_read": report["items_read"],
+        "items": report["items"],
+        "skipped": report["skipped"],
+        "skipped_items": report["skipped_items"][:100],
+        "violation_counts": report["counts"],
+        "bytes": staged.bytes,
+        "duration_ms": audit["duration_ms"],
+    }
+
+def fork_length(fork_query) -> int:
+    """Item count of a fork, computed server side without transferring its content."""
+    result = list(user_datasets_collection.aggregate([
+        {"$match": fork_query},
+        {"$project": {"total": {"$size": "$content"}}},
+    ]))
+    return result[0]["total"] if result else 0
+
 @router.post("/datasets/{turn_type}/{filename}")
+@Limiter("fork_save", limit=ADMISSION_CAPACITY, priority=INTERACTIVE)
 async def save_dataset_fork(
     turn_type: str, 
     filename: str, 
     data: DatasetContent,
     current_user: User = Depends(get_current_active_user)
 ):
-    # ALWAYS save to user's fork in DB
+    # ALWAYS save to user's fork in DB. Concurrent autosaves are coalesced
+    # (see utils/write_behind.py); `seq` is the fork's revision once persisted.
     dataset_path = f"{turn_type}/{filename}"
-    
-    user_datasets_collection.update_one(
-        {
-            "username": current_user.username,
-            "original_path": dataset_path
-        },
-        {
-            "$set": {
-                "content": data.content,
-                "updated_at": datetime.utcnow()
-            }
-        },
-        upsert=True
-    )
-            
-    return {"status": "success", "message": "Saved to your personal fork"}
+    annotate(dataset_path=dataset_path, items=len(data.content))
 
-from datetime import datetime
+    # A new fork records the main dataset it starts from, for three-way merges
+    file_path = BASE_DIR / turn_type / filename
+    # In a thread: a new fork's base capture runs git, and writes go to Mongo
+    try:
+        seq, persisted = await run_in_threadpool(fork_buffer.save, current_user.username, dataset_path, data.content,
+                                                 on_create=lambda: capture_base(file_path))
+    except ForkWriteError as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    annotate(seq=seq, persisted=persisted)
+    return {"status": "success", "message": "Saved to your personal fork", "seq": seq, "persisted": persisted}
+
+@router.post("/datasets/{turn_type}/{filename}/flush")
+async def flush_dataset_fork(
+    turn_type: str,
+    filename: str,
+    current_user: User = Depends(get_current_active_user)
+):
+    """Write any buffered save of the user's fork to the database now."""
+    dataset_path = f"{turn_type}/{filename}"
+    fork_buffer.flush(current_user.username, dataset_path)
+    fork_meta = user_datasets_collection.find_one(
+        {"username": current_user.username, "original_path": dataset_path}, {"revision": 1}
+    )
+    if not fork_meta:
+        raise HTTPException(status_code=404, detail="Fork not found")
+    return {"status": "success", "seq": fork_meta.get("revision", 0)}
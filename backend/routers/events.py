@@ -0,0 +1,55 @@
+import asyncio
+import json
+from typing import Optional
+from fastapi import APIRouter, HTTPException, Request, status
+from fastapi.responses import StreamingResponse
+from auth import user_for_token
+from utils.events import bus
+
+router = APIRouter()
+
+# Comment lines keep proxies from closing an idle stream
+HEARTBEAT_SECONDS = 15
+
+
+def _format(event) -> str:
+    payload = {k: event[k] for k in ("type", "data", "created_at")}
+    return f"id: {event['id']}\nevent: {event['type']}\ndata: {json.dumps(payload, default=str)}\n\n"
+
+
+@router.get("/events")
+async def stream_events(request: Request, token: Optional[str] = None):
+    """
+    Server-Sent Events stream of the events visible to the current user.
+    EventSource can't send headers, so the token may also be passed as ?token=.
+    """
+    if token is None:
+        auth_header = request.headers.get("Authorization", "")
+        if auth_header.lower().startswith("bearer "):
+            token = auth_header[7:].strip()
+    user = user_for_token(token) if token else None
+    if user is None:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Could not validate credentials")
+
+    subscription = bus.subscribe(user.username, user.role)
+
+    async def stream():
+        try:
+            # Tells the client the stream is live, so it can refresh anything
+            # it may have missed while disconnected
+            yield "event: ready\ndata: {}\n\n"
+            while not await request.is_disconnected():
+                try:
+                    event = await subscription.get(timeout=HEARTBEAT_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ": keep-alive\n\n"
+                    continue
+                yield _format(event)
+        finally:
+            subscription.close()
+
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
@@ -1,10 +1,11 @@
-from fastapi import APIRouter, Depends, HTTPException, status, BackgroundTasks
+from fastapi import APIRouter, Depends, HTTPException, Query, status
 from fastapi.security import OAuth2PasswordRequestForm
 from typing import List
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
+from pymongo import ReturnDocument
+from pymongo.errors import BulkWriteError
 from datetime import timedelta, datetime
 import secrets
-import os
 from auth import (
     get_current_active_user,
     get_current_admin_user,
@@ -12,13 +13,40 @@ from auth import (
     ACCESS_TOKEN_EXPIRE_MINUTES
 )
 from database import users_collection, invitation_codes_collection, pull_requests_collection
-from models import User, UserCreate, Token, UserInDB, InvitationCode
+from models import User, UserCreate, Token, UserInDB, InvitationCode, UserSummary
+from settings import get_settings
 from utils.email_utils import send_verification_email, send_login_otp_email
+from utils.email_outbox import outbox
+from utils.fork_gc import collector as fork_gc
+from utils import leaderboard
+from utils.serialization import projection, lean_rows, lean_response
 
 router = APIRouter()
 
-MASTER_ADMIN_CODE = os.getenv("MASTER_ADMIN_CODE")
-ALLOWED_EMAIL_DOMAINS = os.getenv("ALLOWED_EMAIL_DOMAINS", "").split(",")
+# Upper bound on the entries a single bulk request may touch
+BULK_MAX_ITEMS = get_settings().bulk_max_items
+# Usernames per `$in` query, keeps each command well under Mongo's document size limit
+BULK_CHUNK_SIZE = 1000
+
+def _chunks(items, size=BULK_CHUNK_SIZE):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+def _unique_names(usernames: List[str]) -> List[str]:
+    """Dedupes while keeping request order, so results line up with what was sent."""
+    names = list(dict.fromkeys(usernames))
+    if len(names) > BULK_MAX_ITEMS:
+        raise HTTPException(status_code=400, detail=f"At most {BULK_MAX_ITEMS} users per request")
+    return names
+
+def _existing_usernames(names: List[str]) -> set:
+    existing = set()
+    for chunk in _chunks(names):
+        existing.update(u["username"] for u in users_collection.find({"username": {"$in": chunk}}, {"username": 1}))
+    return existing
+
+MASTER_ADMIN_CODE = get_settings().master_admin_code
+ALLOWED_EMAIL_DOMAINS = get_settings().allowed_email_domains.split(",")
 
 def validate_email_domain(email: str):
     domain = email.split("@")[-1]
@@ -33,7 +61,7 @@ class LoginVerify(BaseModel):
     code: str
 
 @router.post("/auth/login-request")
-async def request_login_otp(request: LoginRequest, background_tasks: BackgroundTasks):
+async def request_login_otp(request: LoginRequest):
     user = users_collection.find_one({"email": request.email})
     if not user:
         # Don't reveal user existence
@@ -48,7 +76,7 @@ async def request_login_otp(request: LoginRequest, background_tasks: BackgroundT
         {"$set": {"otp_code": otp_code, "otp_created_at": datetime.utcnow()}}
     )
     
-    background_tasks.add_task(send_login_otp_email, request.email, otp_code)
+    send_login_otp_email(request.email, otp_code)
     return {"message": "If an account exists, a login code has been sent."}
 
 @router.post("/auth/login-verify", response_model=Token)
@@ -77,7 +105,7 @@ async def verify_login_otp(request: LoginVerify):
     return {"access_token": access_token, "token_type": "bearer"}
 
 @router.post("/auth/register", response_model=User)
-async def register_user(user: UserCreate, background_tasks: BackgroundTasks):
+async def register_user(user: UserCreate):
     # 1. Validate Email Domain
     validate_email_domain(user.email)
 
@@ -91,7 +119,7 @@ async def register_user(user: UserCreate, background_tasks: BackgroundTasks):
                 {"username": user.username},
                 {"$set": {"verification_code": verification_code, "email": user.email, "full_name": user.full_name}}
             )
-            background_tasks.add_task(send_verification_email, user.email, verification_code)
+            send_verification_email(user.email, verification_code)
             return User(**existing_user_username)
         else:
             raise HTTPException(status_code=400, detail="Username already registered")
@@ -105,7 +133,7 @@ async def register_user(user: UserCreate, background_tasks: BackgroundTasks):
                 {"email": user.email},
                 {"$set": {"verification_code": verification_code, "username": user.username, "full_name": user.full_name}}
             )
-            background_tasks.add_task(send_verification_email, user.email, verification_code)
+            send_verification_email(user.email, verification_code)
             return User(**existing_user_email)
         else:
             raise HTTPException(status_code=400, detail="Email already registered")
@@ -115,24 +143,26 @@ async def register_user(user: UserCreate, background_tasks: BackgroundTasks):
     if user.invitation_code == MASTER_ADMIN_CODE:
         role = "admin"
     else:
-        # Atomic check and update to prevent race conditions
-        # Also check for expiration
-        invite = invitation_codes_collection.find_one({"code": user.invitation_code})
-        
-        if not invite:
-            raise HTTPException(status_code=400, detail="Invalid invitation code")
-            
-        if invite.get("is_used"):
-             raise HTTPException(status_code=400, detail="Invitation code already used")
-             
-        if invite.get("expires_at") and datetime.utcnow() > invite.get("expires_at"):
-             raise HTTPException(status_code=400, detail="Invitation code expired")
-
-        invitation_codes_collection.update_one(
-            {"code": user.invitation_code},
-            {"$set": {"is_used": True, "used_by": user.username}}
+        # Check and redeem in one atomic round trip, so two registrations can't
+        # both use the same code. Redeemed codes drop expires_at so the TTL index
+        # keeps them as a record of who used them.
+        invite = invitation_codes_collection.find_one_and_update(
+            {"code": user.invitation_code, "is_used": False, "expires_at": {"$gt": datetime.utcnow()}},
+            {"$set": {"is_used": True, "used_by": user.username, "used_at": datetime.utcnow()},
+             "$unset": {"expires_at": ""}},
+            return_document=ReturnDocument.AFTER
         )
 
+        if not invite:
+            # Only failed redemptions pay for a second lookup, to explain why
+            existing = invitation_codes_collection.find_one({"code": user.invitation_code}, {"is_used": 1})
+            if not existing:
+                # Expired codes are purged by the TTL index within a minute or so
+                raise HTTPException(status_code=400, detail="Invalid or expired invitation code")
+            if existing.get("is_used"):
+                raise HTTPException(status_code=400, detail="Invitation code already used")
+            raise HTTPException(status_code=400, detail="Invitation code expired")
+
     # 4. Create User (Inactive)
     verification_code = secrets.token_hex(3).upper() # 6 chars
     
@@ -151,7 +181,7 @@ async def register_user(user: UserCreate, background_tasks: BackgroundTasks):
     created_user["_id"] = str(created_user["_id"])
     
     # 5. Send Verification Email
-    background_tasks.add_task(send_verification_email, user.email, verification_code)
+    send_verification_email(user.email, verification_code)
     
     return User(**created_user)
 
@@ -236,24 +266,40 @@ async def read_users_me(current_user: User = Depends(get_current_active_user)):
     }
     return current_user
 
-@router.get("/users", response_model=List[User])
+# Fields of the admin user list, with the defaults User would fill in
+USER_LIST_FIELDS = {
+    "_id": None,
+    "username": None,
+    "email": None,
+    "full_name": None,
+    "role": "user",
+    "is_active": False,
+    "email_verified": False,
+    "allowed_datasets": [],
+    "sample_stats": {"accepted": 0, "rejected": 0},
+}
+
+@router.get("/users", response_model=List[UserSummary])
 async def read_users(current_user: User = Depends(get_current_admin_user)):
-    users = []
-    for user_data in users_collection.find():
-        user_data["_id"] = str(user_data["_id"])
-        
-        # Calculate stats
-        username = user_data.get("username")
-        total_prs = pull_requests_collection.count_documents({"username": username})
-        merged_prs = pull_requests_collection.count_documents({"username": username, "status": "merged"})
-        
-        user_data["contribution_stats"] = {
-            "total_prs": total_prs,
-            "merged_prs": merged_prs
+    users = lean_rows(users_collection.find({}, projection(USER_LIST_FIELDS)), USER_LIST_FIELDS)
+
+    # PR counts for every user in one aggregation rather than two queries per user
+    counts = {
+        row["_id"]: row for row in pull_requests_collection.aggregate([
+            {"$group": {
+                "_id": "$username",
+                "total": {"$sum": 1},
+                "merged": {"$sum": {"$cond": [{"$eq": ["$status", "merged"]}, 1, 0]}}
+            }}
+        ])
+    }
+    for user in users:
+        stats = counts.get(user["username"], {})
+        user["contribution_stats"] = {
+            "total_prs": stats.get("total", 0),
+            "merged_prs": stats.get("merged", 0)
         }
-        
-        users.append(User(**user_data))
-    return users
+    return lean_response(users)
 
 @router.delete("/users/{username}")
 async def delete_user(username: str, current_user: User = Depends(get_current_admin_user)):
@@ -263,9 +309,34 @@ async def delete_user(username: str, current_user: User = Depends(get_current_ad
     result = users_collection.delete_one({"username": username})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="User not found")
-    
+    # Their forks and pull requests are removed in the background
+    fork_gc.purge_users([username])
     return {"status": "success", "message": f"User {username} deleted"}
 
+class BulkDeleteRequest(BaseModel):
+    usernames: List[str]
+
+@router.post("/users/bulk-delete")
+async def bulk_delete_users(request: BulkDeleteRequest, current_user: User = Depends(get_current_admin_user)):
+    """Delete many users at once; one `delete_many` per chunk of usernames."""
+    names = _unique_names(request.usernames)
+    existing = _existing_usernames(names)
+    targets = [n for n in names if n in existing and n != current_user.username]
+    deleted = 0
+    for chunk in _chunks(targets):
+        deleted += users_collection.delete_many({"username": {"$in": chunk}}).deleted_count
+    fork_gc.purge_users(targets)
+
+    results = []
+    for name in names:
+        if name == current_user.username:
+            results.append({"username": name, "status": "error", "detail": "Cannot delete your own account"})
+        elif name not in existing:
+            results.append({"username": name, "status": "error", "detail": "User not found"})
+        else:
+            results.append({"username": name, "status": "deleted"})
+    return {"deleted": deleted, "results": results}
+
 # Invitation Management
 @router.post("/admin/invites", response_model=InvitationCode)
 async def generate_invite(current_user: User = Depends(get_current_admin_user)):
@@ -281,6 +352,41 @@ async def generate_invite(current_user: User = Depends(get_current_admin_user)):
     invitation_codes_collection.insert_one(invite_data)
     return InvitationCode(**invite_data)
 
+class BulkInviteRequest(BaseModel):
+    count: int = Field(..., ge=1)
+
+@router.post("/admin/invites/bulk", response_model=List[InvitationCode])
+async def generate_invites(request: BulkInviteRequest, current_user: User = Depends(get_current_admin_user)):
+    """Generate `count` invitation codes with a single `insert_many`."""
+    if request.count > BULK_MAX_ITEMS:
+        raise HTTPException(status_code=400, detail=f"At most {BULK_MAX_ITEMS} codes per request")
+    now = datetime.utcnow()
+    expires_at = now + timedelta(minutes=15)
+    created = []
+    pending = request.count
+    # Codes are random, so a collision with an existing one is possible but rare;
+    # retry just the codes that collided (the unique index rejects them)
+    for _ in range(3):
+        batch = [{
+            "code": secrets.token_hex(4).upper(),
+            "created_by": current_user.username,
+            "is_used": False,
+            "created_at": now,
+            "expires_at": expires_at
+        } for _ in range(pending)]
+        failed = set()
+        try:
+            invitation_codes_collection.insert_many(batch, ordered=False)
+        except BulkWriteError as e:
+            failed = {err["index"] for err in e.details.get("writeErrors", [])}
+        created.extend(doc for i, doc in enumerate(batch) if i not in failed)
+        pending = len(failed)
+        if not pending:
+            break
+    if pending:
+        raise HTTPException(status_code=500, detail=f"Could only generate {len(created)} of {request.count} codes")
+    return [InvitationCode(**inv) for inv in created]
+
 @router.delete("/admin/invites/{code}")
 async def delete_invite(code: str, current_user: User = Depends(get_current_admin_user)):
     result = invitation_codes_collection.delete_one({"code": code})
@@ -288,15 +394,46 @@ async def delete_invite(code: str, current_user: User = Depends(get_current_admi
         raise HTTPException(status_code=404, detail="Invitation code not found")
     return {"status": "success", "message": "Invitation code deleted"}
 
+INVITE_LIST_FIELDS = {
+    "code": None,
+    "created_by": None,
+    "is_used": False,
+    "used_by": None,
+    "created_at": None,
+    "expires_at": None,
+}
+
 @router.get("/admin/invites", response_model=List[InvitationCode])
-async def list_invites(current_user: User = Depends(get_current_admin_user)):
-    invites = []
-    for inv in invitation_codes_collection.find().sort("created_at", -1):
-        if "_id" in inv:
-            del inv["_id"] # Model doesn't have ID for now
-        invites.append(InvitationCode(**inv))
-    return invites
-    return invites
+async def list_invites(
+    offset: int = Query(0, ge=0),
+    limit: int = Query(100, ge=1, le=1000),
+    current_user: User = Depends(get_current_admin_user)
+):
+    """Newest invitation codes first, a page at a time; the total is in X-Total-Count."""
+    cursor = invitation_codes_collection.find({}, projection(INVITE_LIST_FIELDS)).sort("created_at", -1).skip(offset).limit(limit)
+    invites = lean_rows(cursor, INVITE_LIST_FIELDS)
+    return lean_response(invites, headers={"X-Total-Count": str(invitation_codes_collection.count_documents({}))})
+
+@router.get("/admin/email/stats")
+async def email_outbox_stats(current_user: User = Depends(get_current_admin_user)):
+    return outbox.stats()
+
+@router.get("/users/leaderboard")
+async def get_leaderboard(
+    window: int = Query(30, description="Days: 7, 30 or 90"),
+    metric: str = Query("accepted", pattern="^(accepted|rejected|merged_prs)$"),
+    limit: int = Query(20, ge=1, le=100),
+    current_user: User = Depends(get_current_active_user)
+):
+    """Top contributors over the last `window` days, from precomputed totals (see utils/leaderboard.py)."""
+    if window not in leaderboard.WINDOWS:
+        raise HTTPException(status_code=400, detail=f"window must be one of {', '.join(map(str, leaderboard.WINDOWS))}")
+    return {
+        "window": window,
+        "metric": metric,
+        "entries": leaderboard.top(window, metric, limit),
+        "me": leaderboard.totals_of(current_user.username, window),
+    }
 
 @router.get("/users/{username}/stats", response_model=User)
 async def get_user_stats(username: str, current_user: User = Depends(get_current_admin_user)):
@@ -383,3 +520,43 @@ async def update_user_permissions(
         raise HTTPException(status_code=404, detail="User not found")
         
     return {"status": "success", "message": "Permissions updated"}
+
+class BulkPermissionsUpdate(BaseModel):
+    usernames: List[str]
+    grant: List[str] = []
+    revoke: List[str] = []
+
+@router.post("/users/permissions/bulk")
+async def bulk_update_permissions(
+    update: BulkPermissionsUpdate,
+    current_user: User = Depends(get_current_admin_user)
+):
+    """
+    Grant and/or revoke datasets for many users with one `update_many` per
+    chunk of usernames. Granting is idempotent (`$addToSet`).
+    """
+    if not update.grant and not update.revoke:
+        raise HTTPException(status_code=400, detail="Nothing to grant or revoke")
+    if set(update.grant) & set(update.revoke):
+        raise HTTPException(status_code=400, detail="A dataset cannot be both granted and revoked")
+    names = _unique_names(update.usernames)
+    existing = _existing_usernames(names)
+
+    # Mongo rejects $addToSet and $pull on the same field in one update,
+    # so a request doing both takes two passes
+    operations = []
+    if update.grant:
+        operations.append({"$addToSet": {"allowed_datasets": {"$each": update.grant}}})
+    if update.revoke:
+        operations.append({"$pull": {"allowed_datasets": {"$in": update.revoke}}})
+    targets = [n for n in names if n in existing]
+    for chunk in _chunks(targets):
+        for operation in operations:
+            users_collection.update_many({"username": {"$in": chunk}}, operation)
+
+    results = [
+        {"username": name, "status": "updated"} if name in existing
+        else {"username": name, "status": "error", "detail": "User not found"}
+        for name in names
+    ]
+    return {"updated": len(targets), "results": results}
@@ -1,15 +1,27 @@
-from fastapi import APIRouter, HTTPException, Depends, status
-from typing import List
+from fastapi import APIRouter, HTTPException, Depends, Query, status, Request, Response
+from typing import List, Optional
 from datetime import datetime
 from auth import get_current_active_user, get_current_admin_user
-from database import pull_requests_collection, user_datasets_collection
+from database import pull_requests_collection, user_datasets_collection, users_collection
 from models import User, PullRequest, UserDataset
 from pydantic import BaseModel
-from pathlib import Path
-import json
+from utils import git_utils
+from utils.dataset_io import (
+    load_dataset, save_dataset, open_dataset, dataset_exists, dataset_revision, invalidate_files
+)
+from utils.tracing import span, annotate
+from utils.locks import dataset_lock
+from utils.events import bus
+from utils.write_behind import fork_buffer
+from utils.fork_base import load_base, fork_changes, three_way_merge, rebase, MissingBaseError
+from utils.http_cache import make_etag, is_not_modified, not_modified, set_cache_headers
+from utils.serialization import projection, lean_rows, lean_response
+from utils import leaderboard, review_queue, validation
+from utils.admission import Limiter
+from routers.datasets import fork_revision, publish_dataset_updated
 
 router = APIRouter()
-REPO_ROOT = Path(__file__).parent.parent.parent / "dataset"
+REPO_ROOT = git_utils.DATASET_DIR
 BASE_DIR = REPO_ROOT / "dataset" if (REPO_ROOT / "dataset").exists() else REPO_ROOT
 
 @router.post("/workflow/pr", response_model=PullRequest)
@@ -19,6 +31,7 @@ async def create_pull_request(
     current_user: User = Depends(get_current_active_user)
 ):
     # Check if user has a fork
+    fork_buffer.flush(current_user.username, dataset_path)
     user_dataset = user_datasets_collection.find_one({
         "username": current_user.username,
         "original_path": dataset_path
@@ -48,9 +61,30 @@ async def create_pull_request(
     result = pull_requests_collection.insert_one(pr_data)
     created_pr = pull_requests_collection.find_one({"_id": result.inserted_id})
     created_pr["_id"] = str(created_pr["_id"])
-    
+
+    bus.publish("pr.opened", _pr_event_data(created_pr), users=[current_user.username], roles=["admin"])
     return PullRequest(**created_pr)
 
+def _pr_event_data(pr, **extra):
+    return {"pr_id": str(pr["_id"]), "username": pr["username"], "dataset_path": pr["dataset_path"], **extra}
+
+def _publish_merge(event_type, pr, **extra):
+    """Tell the PR author and admins, and everyone who can open the dataset that it changed."""
+    bus.publish(event_type, _pr_event_data(pr, **extra), users=[pr["username"]], roles=["admin"])
+    publish_dataset_updated(pr["dataset_path"])
+
+PR_LIST_FIELDS = {
+    "_id": None,
+    "username": None,
+    "dataset_path": None,
+    "status": "open",
+    "created_at": None,
+    "closed_at": None,
+    "description": None,
+    "accepted_count": 0,
+    "rejected_count": 0,
+}
+
 @router.get("/workflow/prs", response_model=List[PullRequest])
 async def list_pull_requests(current_user: User = Depends(get_current_active_user)):
     query = {}
@@ -59,15 +93,17 @@ async def list_pull_requests(current_user: User = Depends(get_current_active_use
     # Actually, usually users want to see their own PR status.
     # Admin needs to see all 'open' PRs.
     
-    prs = []
-    cursor = pull_requests_collection.find().sort("created_at", -1)
-    for pr in cursor:
-        pr["_id"] = str(pr["_id"])
-        prs.append(PullRequest(**pr))
-    return prs
+    cursor = pull_requests_collection.find({}, projection(PR_LIST_FIELDS)).sort("created_at", -1)
+    return lean_response(lean_rows(cursor, PR_LIST_FIELDS))
 
 @router.post("/workflow/prs/{pr_id}/merge")
-async def merge_pull_request(pr_id: str, current_user: User = Depends(get_current_admin_user)):
+@Limiter("pr_merge")
+def merge_pull_request(
+    pr_id: str,
+    overwrite_conflicts: bool = False,
+    allow_invalid: bool = False,
+    current_user: User = Depends(get_current_admin_user)
+):
     from bson import ObjectId
     
     pr = pull_requests_collection.find_one({"_id": ObjectId(pr_id)})
@@ -78,6 +114,7 @@ async def merge_pull_request(pr_id: str, current_user: User = Depends(get_curren
         raise HTTPException(status_code=400, detail="PR is not open")
         
     # Get user's fork content
+    fork_buffer.flush(pr["username"], pr["dataset_path"])
     user_dataset = user_datasets_collection.find_one({
         "username": pr["username"],
         "original_path": pr["dataset_path"]
@@ -88,28 +125,83 @@ async def merge_pull_request(pr_id: str, current_user: User = Depends(get_curren
         
     # Write to disk
     file_path = BASE_DIR / pr["dataset_path"]
-    try:
-        with open(file_path, 'w', encoding='utf-8') as f:
-            json.dump(user_dataset["content"], f, ensure_ascii=False, indent=2)
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Failed to write to disk: {str(e)}")
-        
-    # Update PR status
-    pull_requests_collection.update_one(
-        {"_id": ObjectId(pr_id)},
-        {"$set": {"status": "merged"}}
-    )
-    
-    # Optional: Delete user fork after merge? Or keep it?
-    # GitHub keeps the branch. Let's keep it.
-    
+    with dataset_lock(file_path):
+        # Another worker may have merged this PR while we waited for the lock
+        if not pull_requests_collection.find_one({"_id": ObjectId(pr_id), "status": "open"}, {"_id": 1}):
+            raise HTTPException(status_code=409, detail="PR was already processed")
+        try:
+            base = load_base(user_dataset)
+        except MissingBaseError as e:
+            # Falling back to the legacy path would replace main wholesale
+            raise HTTPException(
+                status_code=409,
+                detail=f"Can't merge: {e}. Process the PR with the items to accept instead."
+            )
+        if base is None:
+            # Fork predates base tracking: it replaces main wholesale
+            merged_content = user_dataset["content"]
+            main_view = open_dataset(file_path)
+            if main_view is None:
+                if dataset_exists(file_path):
+                    raise HTTPException(status_code=500, detail="Failed to read dataset")
+                main_view = []
+            applied = [i for i in range(len(merged_content))
+                       if i >= len(main_view) or not main_view.same_as(i, merged_content[i])]
+            conflicts = []
+        else:
+            fork_content = user_dataset["content"]
+            merged_content = load_dataset(file_path)
+            with span("pr.merge", dataset_path=pr["dataset_path"], three_way=True):
+                applied, conflicts = three_way_merge(base, fork_content, merged_content,
+                                                     fork_changes(base, fork_content), overwrite_conflicts)
+            if conflicts:
+                raise HTTPException(
+                    status_code=409,
+                    detail=f"{len(conflicts)} item(s) were also changed in main since the fork was created "
+                           f"(indices {conflicts[:20]}). Review them or merge with overwrite_conflicts=true."
+                )
+        _check_merge(pr["dataset_path"], merged_content, applied, allow_invalid)
+        try:
+            save_dataset(file_path, merged_content)
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Failed to write to disk: {str(e)}")
+            
+        # Update PR status
+        pull_requests_collection.update_one(
+            {"_id": ObjectId(pr_id)},
+            {"$set": {"status": "merged", "closed_at": datetime.utcnow(),
+                      "accepted_count": len(applied), "rejected_count": 0}}
+        )
+        # Everything the fork changed is in main now
+        rebase(user_dataset, file_path, rejected={})
+    leaderboard.record(pr["username"], accepted=len(applied), merged_prs=1)
+    
+    # The fork is kept, as GitHub keeps the branch, now based on the merged
+    # main; fork GC drops it once it has been left untouched for a while
+    # (see utils/fork_gc.py).
+    
+    _publish_merge("pr.merged", pr)
     return {"status": "success", "message": "Pull Request merged successfully"}
 
+def _rejected_versions(content, indices):
+    """{index: item hash} of the fork's versions of rejected items (keys are strings for Mongo)."""
+    return {str(i): review_queue.item_hash(content[i] if i < len(content) else None) for i in indices}
+
+def _newly_rejected(user_dataset, rejected):
+    """Indices in `rejected` whose version wasn't rejected already by an earlier PR of the fork."""
+    before = user_dataset.get("rejected") or {}
+    return [int(i) for i, item_hash in rejected.items() if before.get(i) != item_hash]
+
 class ProcessPRRequest(BaseModel):
     accepted_indices: List[int]
+    # Apply accepted items even where main changed them since the fork's base
+    overwrite_conflicts: bool = False
+    # Write accepted items even if they have validation errors
+    allow_invalid: bool = False
 
 @router.post("/workflow/prs/{pr_id}/process")
-async def process_pull_request(
+@Limiter("pr_process")
+def process_pull_request(
     pr_id: str, 
     request: ProcessPRRequest,
     current_user: User = Depends(get_current_admin_user)
@@ -124,6 +216,7 @@ async def process_pull_request(
         raise HTTPException(status_code=400, detail="PR is not open")
         
     # Get user's fork content
+    fork_buffer.flush(pr["username"], pr["dataset_path"])
     user_dataset = user_datasets_collection.find_one({
         "username": pr["username"],
         "original_path": pr["dataset_path"]
@@ -133,143 +226,211 @@ async def process_pull_request(
         raise HTTPException(status_code=404, detail="Fork data not found")
     
     fork_content = user_dataset["content"]
+    annotate(pr_id=pr_id, dataset_path=pr["dataset_path"], fork_items=len(fork_content))
     
     # Get Main Repo Content
     file_path = BASE_DIR / pr["dataset_path"]
-    main_content = []
-    if file_path.exists():
-        try:
-            with open(file_path, 'r', encoding='utf-8') as f:
-                main_content = json.load(f)
-        except:
-            pass # File might be new
-
-    # Merge Logic
-    # We assume main_content and fork_content are aligned by index for simplicity in this version.
-    # A more robust system would use IDs.
-    
-    accepted_count = 0
-    rejected_count = 0
-    
-    # We need to know which items changed to count them correctly
-    # Let's recalculate diff indices to be safe, or trust the admin's indices.
-    # We will trust the admin's accepted_indices.
-    
-    # Create a map of index -> new_item for accepted items
-    accepted_map = {}
-    for idx in request.accepted_indices:
-        if 0 <= idx < len(fork_content):
-            accepted_map[idx] = fork_content[idx]
-            accepted_count += 1
+    with dataset_lock(file_path):
+        # Another worker may have processed this PR while we waited for the lock
+        if not pull_requests_collection.find_one({"_id": ObjectId(pr_id), "status": "open"}, {"_id": 1}):
+            raise HTTPException(status_code=409, detail="PR was already processed")
+        main_content = load_dataset(file_path) # [] if the file is new
+
+        # Merge Logic
+        # We assume main_content and fork_content are aligned by index for simplicity in this version.
+        # A more robust system would use IDs.
+    
+        accepted_count = 0
+        rejected_count = 0
+    
+        # We need to know which items changed to count them correctly
+        # Let's recalculate diff indices to be safe, or trust the admin's indices.
+        # We will trust the admin's accepted_indices.
+    
+        # Forks with a recorded base are merged three-way: only the author's
+        # own edits (fork vs base) count, and main's newer changes are kept.
+        # A fork whose base is missing is processed like one without a base:
+        # only the accepted items are copied over
+        base = load_base(user_dataset, missing_ok=True)
+        changed_count = len(fork_content)
+        rejected_indices = None
+
+        # Create a map of index -> new_item for accepted items
+        with span("pr.merge", dataset_path=pr["dataset_path"], fork_items=len(fork_content),
+                  main_items=len(main_content), accepted=len(request.accepted_indices),
+                  three_way=base is not None):
+            if base is not None:
+                changed = set(fork_changes(base, fork_content))
+                changed_count = len(changed)
+                applied, conflicts = three_way_merge(
+                    base, fork_content, main_content,
+                    [i for i in request.accepted_indices if i in changed], request.overwrite_conflicts
+                )
+                if conflicts:
+                    raise HTTPException(
+                        status_code=409,
+                        detail=f"{len(conflicts)} accepted item(s) were also changed in main since the fork was created "
+                               f"(indices {conflicts[:20]}). Review them or resend with overwrite_conflicts=true."
+                    )
+                accepted_count = len(applied)
+                rejected_indices = sorted(changed - set(applied))
+                _check_merge(pr["dataset_path"], main_content, applied, request.allow_invalid)
+            else:
+                accepted_map = {}
+                for idx in request.accepted_indices:
+                    if 0 <= idx < len(fork_content):
+                        accepted_map[idx] = fork_content[idx]
+                        accepted_count += 1
+                
+                # Apply changes to main_content
+                # If main_content is shorter, extend it
+                if len(main_content) < len(fork_content):
+                    main_content.extend([None] * (len(fork_content) - len(main_content)))
             
-    # Apply changes to main_content
-    # If main_content is shorter, extend it
-    if len(main_content) < len(fork_content):
-        main_content.extend([None] * (len(fork_content) - len(main_content)))
-        
-    for idx, new_item in accepted_map.items():
-        main_content[idx] = new_item
+                _check_merge(pr["dataset_path"], fork_content, list(accepted_map), request.allow_invalid)
+                for idx, new_item in accepted_map.items():
+                    main_content[idx] = new_item
         
-    # Filter out None values if any (from removals that weren't filled?) 
-    # Actually, if we accepted a removal, the item in fork might be null? 
-    # For now, let's assume we just replace content. 
-    # If we want to support "deletion", we need to handle that.
-    # But the current UI just edits items.
+        # Filter out None values if any (from removals that weren't filled?) 
+        # Actually, if we accepted a removal, the item in fork might be null? 
+        # For now, let's assume we just replace content. 
+        # If we want to support "deletion", we need to handle that.
+        # But the current UI just edits items.
     
-    # Write to disk
-    try:
-        with open(file_path, 'w', encoding='utf-8') as f:
-            json.dump(main_content, f, ensure_ascii=False, indent=2)
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Failed to write to disk: {str(e)}")
+        # Write to disk
+        try:
+            save_dataset(file_path, main_content)
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Failed to write to disk: {str(e)}")
         
-    # Update PR status
-    pull_requests_collection.update_one(
-        {"_id": ObjectId(pr_id)},
-        {"$set": {
-            "status": "merged",
-            "accepted_count": accepted_count,
-            "rejected_count": len(fork_content) - accepted_count
-        }}
-    )
+        if rejected_indices is None:
+            rejected_count = changed_count - accepted_count
+            rejected = {}
+        else:
+            # Items rejected before and not edited since were already counted
+            rejected = _rejected_versions(fork_content, rejected_indices)
+            rejected_count = len(_newly_rejected(user_dataset, rejected))
+
+        # Update PR status
+        pull_requests_collection.update_one(
+            {"_id": ObjectId(pr_id)},
+            {"$set": {
+                "status": "merged",
+                "closed_at": datetime.utcnow(),
+                "accepted_count": accepted_count,
+                "rejected_count": rejected_count
+            }}
+        )
+        # Later PRs of the fork are reviewed against main as merged here
+        rebase(user_dataset, file_path, rejected=rejected)
     
     # Update User Stats (Sample Level)
-    # We need to calculate rejected count. 
-    # Rejected = Total Changed Items - Accepted Items
-    # Let's calculate total changed items first
-    total_changed = 0
-    max_len = max(len(main_content), len(fork_content)) # Use original main_content length? No, too late.
-    # Re-read original main content? No.
-    
-    # Let's rely on the diff logic again briefly or just assume the admin reviewed all changes.
-    # Simpler: The frontend sends accepted indices. Any index that WAS changed but NOT in accepted_indices is "rejected".
-    # But we don't know which were changed here easily without re-running diff.
-    
-    # Let's just increment "accepted" for now. 
-    # To get "rejected", we'd need the full list of changes.
-    # Let's do a quick diff here to find total changes.
-    
-    # ... Actually, let's just update accepted count for now to be safe and simple.
-    # Or, we can update the User model to increment.
-    
-    from database import users_collection
     users_collection.update_one(
         {"username": pr["username"]},
-        {"$inc": {
-            "sample_stats.accepted": accepted_count,
-            # "sample_stats.rejected": rejected_count # We'll skip rejected for now or calculate it if we want to be precise
-        }}
+        {"$inc": {"sample_stats.accepted": accepted_count, "sample_stats.rejected": rejected_count}}
     )
     
+    leaderboard.record(pr["username"], accepted=accepted_count, rejected=rejected_count, merged_prs=1)
+    _publish_merge("pr.processed", pr, accepted_count=accepted_count)
     return {"status": "success", "message": f"PR processed. {accepted_count} samples accepted."}
 
 @router.post("/workflow/prs/{pr_id}/reject")
-async def reject_pull_request(pr_id: str, current_user: User = Depends(get_current_admin_user)):
+def reject_pull_request(pr_id: str, current_user: User = Depends(get_current_admin_user)):
     from bson import ObjectId
     
-    pr = pull_requests_collection.find_one({"_id": ObjectId(pr_id)})
+    # Closing is atomic, so a PR processed or rejected concurrently is counted once
+    pr = pull_requests_collection.find_one_and_update(
+        {"_id": ObjectId(pr_id), "status": "open"},
+        {"$set": {"status": "rejected", "closed_at": datetime.utcnow()}}
+    )
     if not pr:
-        raise HTTPException(status_code=404, detail="Pull Request not found")
+        if not pull_requests_collection.find_one({"_id": ObjectId(pr_id)}, {"_id": 1}):
+            raise HTTPException(status_code=404, detail="Pull Request not found")
+        raise HTTPException(status_code=409, detail="PR was already processed")
         
-    pull_requests_collection.update_one(
-        {"_id": ObjectId(pr_id)},
-        {"$set": {"status": "rejected"}}
+    # Every item the fork changes counts as rejected, as of its latest save,
+    # unless that version of it was rejected before
+    fork_buffer.flush(pr["username"], pr["dataset_path"])
+    fork = user_datasets_collection.find_one(
+        {"username": pr["username"], "original_path": pr["dataset_path"]}, {"content": 0}
     )
-    
-    # Count all changes as rejected?
-    # For now, just mark PR as rejected.
-    
+    changes = {"indices": [], "hashes": []}
+    if fork:
+        changes = review_queue.current_changes(fork, fork_revision(fork), BASE_DIR / pr["dataset_path"])
+    rejected = {str(i): h for i, h in zip(changes["indices"], changes["hashes"])}
+    rejected_count = len(_newly_rejected(fork or {}, rejected))
+    if fork:
+        user_datasets_collection.update_one({"_id": fork["_id"]}, {"$set": {"rejected": rejected}})
+    pull_requests_collection.update_one({"_id": pr["_id"]}, {"$set": {"rejected_count": rejected_count}})
+    users_collection.update_one({"username": pr["username"]}, {"$inc": {"sample_stats.rejected": rejected_count}})
+    leaderboard.record(pr["username"], rejected=rejected_count)
+
+    bus.publish("pr.rejected", _pr_event_data(pr), users=[pr["username"]], roles=["admin"])
     return {"status": "success", "message": "Pull Request rejected"}
 
 @router.get("/workflow/prs/{pr_id}/diff")
-async def get_pr_diff(pr_id: str, current_user: User = Depends(get_current_admin_user)):
+@Limiter("pr_diff")
+def get_pr_diff(
+    pr_id: str,
+    request: Request,
+    response: Response,
+    current_user: User = Depends(get_current_admin_user)
+):
     from bson import ObjectId
-    import difflib
     
     pr = pull_requests_collection.find_one({"_id": ObjectId(pr_id)})
     if not pr:
         raise HTTPException(status_code=404, detail="Pull Request not found")
         
-    # Get User Fork
-    user_dataset = user_datasets_collection.find_one({
+    fork_query = {
         "username": pr["username"],
         "original_path": pr["dataset_path"]
-    })
+    }
+    file_path = BASE_DIR / pr["dataset_path"]
+
+    fork_buffer.flush(pr["username"], pr["dataset_path"])
+    # The diff only changes when the fork or the main file does
+    fork_meta = user_datasets_collection.find_one(fork_query, {"content": 0})
+    if not fork_meta:
+        raise HTTPException(status_code=404, detail="Fork data not found")
+    etag = make_etag("diff", fork_meta["_id"], fork_revision(fork_meta), dataset_revision(file_path))
+    if is_not_modified(request, etag):
+        return not_modified(etag)
+
+    # Get User Fork
+    user_dataset = user_datasets_collection.find_one(fork_query)
     
     if not user_dataset:
         raise HTTPException(status_code=404, detail="Fork data not found")
         
     fork_content = user_dataset["content"]
+    annotate(pr_id=pr_id, dataset_path=pr["dataset_path"], fork_items=len(fork_content))
     
-    # Get Main Repo Content
-    file_path = BASE_DIR / pr["dataset_path"]
-    main_content = []
-    if file_path.exists():
-        try:
-            with open(file_path, 'r', encoding='utf-8') as f:
-                main_content = json.load(f)
-        except:
-            pass # File might be new
+    # Get Main Repo Content, as a random access view over its binary sidecar
+    main_view = open_dataset(file_path) or [] # [] if the file is new
+    main_len = len(main_view)
+
+    base = load_base(user_dataset, missing_ok=True)
+    if base is not None:
+        # Review only the author's own edits (fork vs the main it was forked
+        # from), flagging those that main has changed differently since.
+        diffs = []
+        with span("pr.diff", dataset_path=pr["dataset_path"], fork_items=len(fork_content),
+                  base_items=len(base), main_items=main_len, three_way=True) as diff_span:
+            for i in fork_changes(base, fork_content):
+                item_base = base[i] if i < len(base) else None
+                item_fork = fork_content[i] if i < len(fork_content) else None
+                entry = _diff_entry(i, item_base, item_fork)
+                if i < main_len:
+                    moved = not main_view.same_as(i, item_base) if item_base is not None else True
+                    if moved and (item_fork is None or not main_view.same_as(i, item_fork)):
+                        entry["conflict"] = True
+                        entry["main_content"] = main_view[i]
+                diffs.append(entry)
+            diff_span.set_attribute("changes", len(diffs))
+        set_cache_headers(response, etag)
+        return {"diffs": diffs, "total_changes": len(diffs), "base_commit": user_dataset.get("base_commit"),
+                "conflicts": sum(1 for d in diffs if d.get("conflict"))}
             
     # Calculate Diff
     # We will assume list of dicts.
@@ -278,41 +439,121 @@ async def get_pr_diff(pr_id: str, current_user: User = Depends(get_current_admin
     
     diffs = []
     
-    max_len = max(len(main_content), len(fork_content))
+    max_len = max(main_len, len(fork_content))
     
-    for i in range(max_len):
-        item_main = main_content[i] if i < len(main_content) else None
-        item_fork = fork_content[i] if i < len(fork_content) else None
-        
-        if item_main != item_fork:
-            if item_main is None:
-                diffs.append({"index": i, "type": "added", "content": item_fork})
-            elif item_fork is None:
-                diffs.append({"index": i, "type": "removed", "content": item_main})
-            else:
-                # Modified
-                diffs.append({
-                    "index": i, 
-                    "type": "modified", 
-                    "old_content": item_main,
-                    "new_content": item_fork
-                })
+    with span("pr.diff", dataset_path=pr["dataset_path"], fork_items=len(fork_content),
+              main_items=main_len) as diff_span:
+        for i in range(max_len):
+            item_fork = fork_content[i] if i < len(fork_content) else None
+            # Unchanged items are compared as encoded bytes and never decoded
+            if i < main_len and item_fork is not None and main_view.same_as(i, item_fork):
+                continue
+            item_main = main_view[i] if i < main_len else None
+            
+            if item_main != item_fork:
+                diffs.append(_diff_entry(i, item_main, item_fork))
+        diff_span.set_attribute("changes", len(diffs))
                 
+    set_cache_headers(response, etag)
     return {"diffs": diffs, "total_changes": len(diffs)}
 
+@fork_buffer.on_written
+def index_fork_changes(username, dataset_path, content, seq):
+    """
+    Keeps the review queue's conflict index and the fork's validation current
+    as forks are saved, with one read and one write per save.
+    """
+    query = {"username": username, "original_path": dataset_path, "revision": seq}
+    fork = user_datasets_collection.find_one(query, {"content": 0})
+    if fork is None:
+        return  # Already superseded by a newer write
+    changes = review_queue.changes_after_write(fork, content, seq, BASE_DIR / dataset_path)
+    with span("validation.fork", dataset_path=dataset_path) as validate_span:
+        result = validation.validate_changed(content, changes, fork.get("validation"),
+                                             validation.turn_type_of(dataset_path))
+        validate_span.set_attributes(checked=result.pop("checked"), violations=len(result["violations"]))
+    result["revision"] = seq
+    # Conditional, so a slow listener can't overwrite the entries of a newer write
+    stored = user_datasets_collection.update_one(query, {"$set": {"changes": changes, "validation": result}})
+    if stored.matched_count:
+        review_queue.remember(fork, changes, content)
+
+def _check_merge(dataset_path, content, indices, allow_invalid):
+    """Refuse to write items with validation errors to main, unless `allow_invalid`."""
+    violations = validation.validate_items(content, indices, validation.turn_type_of(dataset_path))
+    errors = [v for v in violations if v["severity"] == "error"]
+    if errors and not allow_invalid:
+        listed = "; ".join(f"item {v['index']} {v['path']}: {v['message']}" for v in errors[:10])
+        raise HTTPException(
+            status_code=422,
+            detail=f"{len(errors)} validation error(s) ({listed}). "
+                   f"Fix them in the fork or resend with allow_invalid=true."
+        )
+
+@router.get("/workflow/review-queue")
+@Limiter("review_queue")
+def get_review_queue(
+    dataset_path: Optional[str] = None,
+    current_user: User = Depends(get_current_admin_user)
+):
+    """
+    Open PRs grouped by dataset, with the item positions only one PR changes
+    (safe to accept together) split from those several PRs change differently.
+    Built from the per-fork change index; only forks whose index is stale are diffed.
+    """
+    query = {"status": "open"}
+    if dataset_path:
+        query["dataset_path"] = dataset_path
+    prs_by_dataset = {}
+    for pr in pull_requests_collection.find(query, projection(PR_LIST_FIELDS)).sort("created_at", 1):
+        prs_by_dataset.setdefault(pr["dataset_path"], []).append(pr)
+
+    datasets = []
+    for path, prs in sorted(prs_by_dataset.items()):
+        file_path = BASE_DIR / path
+        for pr in prs:
+            fork_buffer.flush(pr["username"], path)
+        forks = {
+            fork["username"]: fork for fork in user_datasets_collection.find(
+                {"original_path": path, "username": {"$in": [pr["username"] for pr in prs]}},
+                {"content": 0}
+            )
+        }
+        changes_by_pr = {}
+        with span("pr.review_queue", dataset_path=path, prs=len(prs)):
+            for pr in prs:
+                fork = forks.get(pr["username"])
+                if fork is not None:
+                    changes_by_pr[pr["_id"]] = review_queue.current_changes(fork, fork_revision(fork), file_path)
+            queue = review_queue.build_queue(prs, changes_by_pr)
+        datasets.append({"dataset_path": path, **queue})
+    return lean_response({"datasets": datasets})
+
+def _diff_entry(index, old_item, new_item):
+    if old_item is None:
+        return {"index": index, "type": "added", "content": new_item}
+    if new_item is None:
+        return {"index": index, "type": "removed", "content": old_item}
+    # Modified
+    return {
+        "index": index,
+        "type": "modified",
+        "old_content": old_item,
+        "new_content": new_item
+    }
+
 # Git Integration Endpoints
-from utils import git_utils
 
-@router.on_event("startup")
-async def startup_git():
-    git_utils.init_repo_if_needed()
+@git_utils.on_files_changed
+def invalidate_synced_datasets(paths):
+    invalidate_files([REPO_ROOT / p for p in paths if p.endswith(".json")])
 
 @router.get("/workflow/git/config")
-async def get_git_config(current_user: User = Depends(get_current_admin_user)):
+def get_git_config(current_user: User = Depends(get_current_admin_user)):
     return {"remote_url": git_utils.get_remote_url()}
 
 @router.post("/workflow/git/config")
-async def set_git_config(
+def set_git_config(
     data: dict,
     current_user: User = Depends(get_current_admin_user)
 ):
@@ -327,17 +568,33 @@ async def set_git_config(
         raise HTTPException(status_code=500, detail=str(e))
 
 @router.post("/workflow/git/sync")
-async def git_sync(current_user: User = Depends(get_current_admin_user)):
+def git_sync(
+    mode: Optional[str] = Query(None, pattern="^(fast|full)$"),
+    current_user: User = Depends(get_current_admin_user)
+):
+    try:
+        result = git_utils.git_sync(mode)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    changed = result["changed_files"]
+    # Changed paths include datasets most users can't open
+    bus.publish("git.synced", {"by": current_user.username, "changed_files": changed[:1000]}, roles=["admin"])
+    return {"status": "success", "message": f"Synced successfully, {len(changed)} file(s) changed",
+            "output": result["output"], "changed_files": changed}
+
+@router.post("/workflow/git/maintenance")
+def git_maintenance(current_user: User = Depends(get_current_admin_user)):
     try:
-        output = git_utils.git_pull()
-        return {"status": "success", "message": "Synced successfully", "output": output}
+        output = git_utils.git_maintenance(force=True)
+        return {"status": "success", "message": "Repository maintenance done", "output": output}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @router.post("/workflow/git/push")
-async def git_push_changes(current_user: User = Depends(get_current_admin_user)):
+def git_push_changes(current_user: User = Depends(get_current_admin_user)):
     try:
         output = git_utils.git_push()
+        bus.publish("git.pushed", {"by": current_user.username}, roles=["admin"])
         return {"status": "success", "message": "Pushed successfully", "output": output}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -0,0 +1,139 @@
+"""
+Application settings.
+
+Every setting is read from the environment (and backend/.env, loaded once
+here) into one typed, immutable Settings object. A field's environment
+variable is its name in upper case.
+Modules keep their own constants (e.g. auth.SECRET_KEY) but take the values
+from get_settings(), so importing a module never reads the environment.
+"""
+import os
+import typing
+from dataclasses import dataclass, fields
+from functools import lru_cache
+from pathlib import Path
+from typing import Optional
+
+BACKEND_DIR = Path(__file__).resolve().parent
+
+
+@dataclass(frozen=True)
+class Settings:
+    # Database
+    mongodb_url: str = "mongodb://localhost:27017"
+    db_name: str = "polythink_studio"
+
+    # Auth and accounts
+    secret_key: Optional[str] = None
+    algorithm: str = "HS256"
+    access_token_expire_minutes: int = 30
+    master_admin_code: Optional[str] = None
+    allowed_email_domains: str = ""
+    bulk_max_items: int = 5000
+    metrics_token: Optional[str] = None
+
+    # Dataset repository and on-disk caches
+    dataset_repo_dir: Path = BACKEND_DIR.parent / "dataset"
+    dataset_cache_dir: Path = BACKEND_DIR / ".dataset_cache"
+    dataset_shard_size: int = 1000
+    lock_dir: Path = BACKEND_DIR / ".locks"
+    git_sync_mode: str = "fast"  # fast | full
+    git_fetch_depth: int = 1
+    git_fetch_filter: str = ""
+    git_maintenance_interval_hours: float = 24
+    column_cache_datasets: int = 8
+
+    # Server
+    web_concurrency: int = 1  # uvicorn worker processes (see DEPLOY.md)
+
+    # Forks
+    fork_flush_seconds: float = 0
+    fork_base_cache_mb: float = 256
+    review_cache_items: int = 200_000
+    fork_gc_interval_hours: float = 24
+    fork_gc_merged_days: float = 14
+    fork_gc_stale_days: float = 180
+    fork_gc_batch_size: int = 100
+    fork_gc_compact: bool = False
+
+    # Validation
+    validation_max_message_chars: int = 100_000
+    validation_max_item_bytes: int = 1024 * 1024
+    validation_workers: int = min(4, os.cpu_count() or 1)
+    validation_chunk_size: int = 5000
+
+    # Admission control (see utils/admission.py). Every limit is per worker:
+    # the server as a whole admits WEB_CONCURRENCY times as many requests
+    admission_capacity: int = 16
+    admission_reserved: int = 4
+    admission_heavy_limit: int = 2
+    admission_queue_size: int = 16
+    admission_queue_timeout: float = 30
+
+    # Server-push events
+    event_backend: str = "local"  # local | mongo
+    event_queue_size: int = 100
+    event_collection_bytes: int = 16 * 1024 * 1024
+
+    # Email
+    smtp_server: Optional[str] = None
+    smtp_port: int = 587
+    smtp_username: Optional[str] = None
+    smtp_password: Optional[str] = None
+    smtp_use_tls: bool = True
+    sender_email: Optional[str] = None
+    sender_name: Optional[str] = None
+    email_batch_size: int = 20
+    email_max_retries: int = 5
+    email_retry_backoff: float = 2.0
+    email_idle_timeout: float = 60
+
+    # Observability
+    trace_sample_rate: float = 0
+    trace_exporter: str = "file"  # file | otlp
+    trace_file: str = "traces.jsonl"
+    trace_otlp_endpoint: str = "http://localhost:4318/v1/traces"
+    trace_service_name: str = "polythink-studio-backend"
+    profile_dir: Path = BACKEND_DIR / "profiles"
+    profile_interval_ms: float = 2
+    profile_keep: int = 50
+
+    @classmethod
+    def from_env(cls, environ=None) -> "Settings":
+        environ = os.environ if environ is None else environ
+        hints = typing.get_type_hints(cls)
+        values = {}
+        for f in fields(cls):
+            raw = environ.get(f.name.upper())
+            if raw is not None:
+                values[f.name] = _convert(f.name, raw, hints[f.name])
+        return cls(**values)
+
+
+def _convert(name, raw, hint):
+    if typing.get_origin(hint) is typing.Union:
+        # Optional[str]: an empty value means unset
+        if raw == "":
+            return None
+        hint = next(arg for arg in typing.get_args(hint) if arg is not type(None))
+    try:
+        if hint is bool:
+            return raw.strip().lower() in ("1", "true", "yes", "on")
+        if hint is int:
+            return int(float(raw)) if "." in raw else int(raw)
+        if hint is float:
+            return float(raw)
+        if hint is Path:
+            return Path(raw)
+        return raw
+    except ValueError:
+        raise ValueError(f"Invalid value for {name.upper()}: {raw!r}") from None
+
+
+@lru_cache(maxsize=None)
+def get_settings() -> Settings:
+    """The process-wide settings, read on first use."""
+    from dotenv import load_dotenv
+
+    load_dotenv(BACKEND_DIR / ".env")
+    return Settings.from_env()
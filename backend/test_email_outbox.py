@@ -0,0 +1,113 @@
+"""
+Email outbox against a local SMTP server (aiosmtpd) and an in-memory Mongo
+(mongomock). Run with `pytest test_email_outbox.py`.
+"""
+import os
+import socket
+import time
+
+import pytest
+
+pytest.importorskip("aiosmtpd")
+pytest.importorskip("mongomock")
+os.environ.setdefault("MONGODB_URL", "mongomock://")
+os.environ.setdefault("SECRET_KEY", "test")
+
+from aiosmtpd.controller import Controller
+from database import get_db
+from utils.email_outbox import EmailOutbox, FAILED
+from utils.email_utils import build_message
+
+
+class Recorder:
+    def __init__(self):
+        self.messages = []
+        self.sessions = set()
+
+    async def handle_DATA(self, server, session, envelope):
+        self.messages.append((envelope.rcpt_tos[0], envelope.content))
+        self.sessions.add(id(session))
+        return "250 OK"
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.02)
+    return condition()
+
+
+@pytest.fixture
+def collection(request):
+    collection = get_db()[f"email_outbox_{request.node.name}"]
+    yield collection
+    collection.drop()
+
+
+@pytest.fixture
+def smtp():
+    recorder = Recorder()
+    controller = Controller(recorder, hostname="127.0.0.1", port=free_port())
+    controller.start()
+    yield controller, recorder
+    controller.stop()
+
+
+def make_outbox(collection, port, **kwargs):
+    return EmailOutbox(host="127.0.0.1", port=port, username=None, password=None, sender="studio@example.com",
+                       use_tls=False, collection=collection, **kwargs)
+
+
+def test_burst_is_sent_over_one_connection(collection, smtp):
+    controller, recorder = smtp
+    outbox = make_outbox(collection, controller.port)
+    try:
+        for i in range(30):
+            outbox.enqueue(f"user{i}@example.com", build_message(f"user{i}@example.com", "Code", "<p>123456</p>"),
+                           kind="login_otp")
+        assert wait_for(lambda: len(recorder.messages) == 30)
+        assert wait_for(lambda: collection.count_documents({}) == 0)
+        stats = outbox.stats()
+        assert stats["sent"] == 30
+        assert stats["connections_opened"] == 1
+        assert len(recorder.sessions) == 1
+    finally:
+        outbox.stop()
+
+
+def test_messages_queued_before_a_restart_are_sent(collection, smtp):
+    controller, recorder = smtp
+    # Stored by a process that stopped before sending it
+    stopped = make_outbox(collection, controller.port)
+    stopped.start = lambda: None
+    stopped.enqueue("late@example.com", "Subject: hi\r\n\r\nhi", kind="verification")
+    assert collection.count_documents({}) == 1
+
+    outbox = make_outbox(collection, controller.port)
+    outbox.start()
+    try:
+        assert wait_for(lambda: [to for to, _ in recorder.messages] == ["late@example.com"])
+        assert wait_for(lambda: collection.count_documents({}) == 0)
+    finally:
+        outbox.stop()
+
+
+def test_failed_sends_are_retried_then_given_up(collection):
+    outbox = make_outbox(collection, free_port(), retry_backoff=0.05, max_retries=2)
+    try:
+        outbox.enqueue("nobody@example.com", "Subject: hi\r\n\r\nhi")
+        assert wait_for(lambda: collection.count_documents({"status": FAILED}) == 1)
+        message = collection.find_one()
+        assert message["attempts"] == 3
+        assert outbox.stats()["retried"] == 2
+        assert outbox.stats()["queued"] == 0
+    finally:
+        outbox.stop()
@@ -0,0 +1,233 @@
+"""
+Admission control for expensive endpoints.
+
+A limited endpoint runs at most `limit` requests at once; up to `queue_size`
+more wait for a slot, in arrival order. Past that, or after waiting
+ADMISSION_QUEUE_TIMEOUT seconds, the request gets 429 with a Retry-After
+estimated from the endpoint's recent service times.
+
+Every limiter also takes a slot from one per-process pool of
+ADMISSION_CAPACITY. Heavy endpoints (PR diffs and merges, audits, imports)
+only get a pool slot while ADMISSION_RESERVED slots stay free, and freed
+slots go to waiting interactive requests (dataset loads, autosaves) before
+any heavy one, so annotators keep being served while admins' jobs queue.
+
+The limits are per process. With several workers (WEB_CONCURRENCY), the
+server admits up to that many times the configured limits, so size them for
+one worker's share of the host.
+
+Synchronous handlers of limited endpoints run in the threadpool, so a long
+diff or merge doesn't hold up the event loop either (request profiles follow
+them there).
+"""
+import asyncio
+import functools
+import heapq
+import itertools
+import math
+import threading
+import time
+from fastapi import HTTPException
+from starlette.concurrency import run_in_threadpool
+from settings import get_settings
+from utils.metrics import registry
+from utils.profiling import follow_current_thread
+
+settings = get_settings()
+ADMISSION_CAPACITY = settings.admission_capacity
+ADMISSION_RESERVED = settings.admission_reserved
+ADMISSION_QUEUE_SIZE = settings.admission_queue_size
+ADMISSION_QUEUE_TIMEOUT = settings.admission_queue_timeout
+HEAVY_LIMIT = settings.admission_heavy_limit
+
+INTERACTIVE, HEAVY = 0, 1
+
+admission_rejections = registry.counter(
+    "admission_rejected_total", "Requests refused with 429 by admission control.", ("endpoint", "reason")
+)
+admission_wait = registry.histogram(
+    "admission_wait_seconds", "Time admitted requests spent queued for a slot.", ("endpoint",)
+)
+
+
+class _Waiter:
+    __slots__ = ("limiter", "loop", "future", "state")
+
+    def __init__(self, limiter, loop, future):
+        self.limiter = limiter
+        self.loop = loop
+        self.future = future
+        self.state = "waiting"  # waiting | admitted | gone
+
+
+def _wake(future):
+    if not future.done():
+        future.set_result(None)
+
+
+class AdmissionPool:
+    """Slots shared by all limiters of a process, with room held back for interactive requests."""
+
+    def __init__(self, capacity=ADMISSION_CAPACITY, reserved=ADMISSION_RESERVED):
+        self.capacity = max(1, capacity)
+        self.reserved = max(0, min(reserved, self.capacity - 1))
+        self.active = 0
+        self.limiters = []
+        self._waiters = []  # heap of (priority, arrival, waiter)
+        self._arrivals = itertools.count()
+        self._lock = threading.Lock()
+
+    def _has_room(self, priority):
+        free = self.capacity - self.active
+        return free > (self.reserved if priority == HEAVY else 0)
+
+    def _dispatch(self):
+        """Admit waiters, interactive first, while there is room. Called with the lock held."""
+        skipped = []
+        while self._waiters:
+            entry = self._waiters[0]
+            priority, _, waiter = entry
+            if waiter.state != "waiting":
+                heapq.heappop(self._waiters)
+                continue
+            if not self._has_room(priority):
+                break  # Everything left is of the same or lower priority
+            heapq.heappop(self._waiters)
+            limiter = waiter.limiter
+            if limiter.active >= limiter.limit:
+                skipped.append(entry)  # Its endpoint is busy; don't hold up the others
+                continue
+            waiter.state = "admitted"
+            limiter.waiting -= 1
+            limiter.active += 1
+            self.active += 1
+            waiter.loop.call_soon_threadsafe(_wake, waiter.future)
+        for entry in skipped:
+            heapq.heappush(self._waiters, entry)
+
+    async def acquire(self, limiter):
+        """Wait for a slot for `limiter`; returns the seconds spent queued."""
+        with self._lock:
+            if limiter.active < limiter.limit and self._has_room(limiter.priority):
+                limiter.active += 1
+                self.active += 1
+                return 0.0
+            if limiter.waiting >= limiter.queue_size:
+                raise limiter.reject("queue_full")
+            loop = asyncio.get_running_loop()
+            waiter = _Waiter(limiter, loop, loop.create_future())
+            heapq.heappush(self._waiters, (limiter.priority, next(self._arrivals), waiter))
+            limiter.waiting += 1
+
+        started = time.perf_counter()
+        try:
+            await asyncio.wait_for(waiter.future, limiter.timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            with self._lock:
+                admitted = waiter.state == "admitted"
+                if not admitted:
+                    waiter.state = "gone"
+                    limiter.waiting -= 1
+            if admitted:
+                # Given a slot just as we stopped waiting: hand it on
+                self.release(limiter)
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            raise limiter.reject("timeout")
+        return time.perf_counter() - started
+
+    def release(self, limiter):
+        with self._lock:
+            limiter.active -= 1
+            self.active -= 1
+            self._dispatch()
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "capacity": self.capacity,
+                "reserved": self.reserved,
+                "active": self.active,
+                "endpoints": [limiter.snapshot() for limiter in self.limiters],
+            }
+
+
+pool = AdmissionPool()
+
+
+class Limiter:
+    """
+    Concurrency limit of one endpoint. Used as a decorator, below the route
+    decorator:
+
+        @router.get("/workflow/prs/{pr_id}/diff")
+        @Limiter("pr_diff", limit=2)
+        def get_pr_diff(...): ...
+    """
+
+    def __init__(self, name, limit=HEAVY_LIMIT, priority=HEAVY, queue_size=ADMISSION_QUEUE_SIZE,
+                 timeout=ADMISSION_QUEUE_TIMEOUT, pool=pool):
+        self.name = name
+        self.limit = max(1, limit)
+        self.priority = priority
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.pool = pool
+        self.active = 0
+        self.waiting = 0
+        # Moving average of handler run time, for Retry-After
+        self.service_seconds = 1.0
+        pool.limiters.append(self)
+
+    def reject(self, reason):
+        admission_rejections.inc(endpoint=self.name, reason=reason)
+        # Time for the queue ahead to drain through the endpoint's slots
+        retry_after = self.service_seconds * (self.waiting + 1) / self.limit
+        return HTTPException(
+            status_code=429,
+            detail=f"Too many {self.name.replace('_', ' ')} requests in progress, retry shortly",
+            headers={"Retry-After": str(min(60, max(1, math.ceil(retry_after))))},
+        )
+
+    def snapshot(self):
+        return {
+            "endpoint": self.name,
+            "priority": "interactive" if self.priority == INTERACTIVE else "heavy",
+            "limit": self.limit,
+            "active": self.active,
+            "queued": self.waiting,
+            "queue_size": self.queue_size,
+            "service_ms": round(self.service_seconds * 1000, 1),
+        }
+
+    def __call__(self, handler):
+        is_async = asyncio.iscoroutinefunction(handler)
+
+        def run(args, kwargs):
+            follow_current_thread()
+            return handler(*args, **kwargs)
+
+        @functools.wraps(handler)
+        async def limited(*args, **kwargs):
+            waited = await self.pool.acquire(self)
+            admission_wait.observe(waited, endpoint=self.name)
+            started = time.perf_counter()
+            try:
+                if is_async:
+                    return await handler(*args, **kwargs)
+                return await run_in_threadpool(run, args, kwargs)
+            finally:
+                self.service_seconds = 0.8 * self.service_seconds + 0.2 * (time.perf_counter() - started)
+                self.pool.release(self)
+
+        return limited
+
+
+def _by_endpoint(attribute):
+    return lambda: {(limiter.name,): getattr(limiter, attribute) for limiter in pool.limiters}
+
+
+registry.gauge("admission_queue_depth", "Requests waiting for an admission slot.", ("endpoint",),
+               callback=_by_endpoint("waiting"))
+registry.gauge("admission_in_flight", "Requests holding an admission slot.", ("endpoint",),
+               callback=_by_endpoint("active"))
@@ -0,0 +1,541 @@
+"""
+Reading and writing dataset files.
+
+A dataset is addressed by its logical path, e.g. dataset/single-turn/foo.json,
+and is stored in one of two layouts:
+
+    single file   foo.json                   one JSON array
+    sharded       foo.shards/manifest.json   item count and shard list
+                  foo.shards/00000.json      items [0, shard_size)
+                  foo.shards/00001.json      items [shard_size, 2 * shard_size) ...
+
+Every shard but the last holds exactly `shard_size` items, so item i lives
+in shard i // shard_size. Saving a sharded dataset only rewrites the shards
+whose items changed, which keeps merges (and their git deltas) small.
+Callers never need to know which layout a dataset uses.
+"""
+import hashlib
+import json
+import fnmatch
+import os
+import shutil
+import tempfile
+import time
+from pathlib import Path
+from settings import get_settings
+from utils.metrics import dataset_parse_duration, dataset_bytes_read, dataset_bytes_written
+from utils.tracing import span
+from utils import sidecar
+from utils.http_cache import file_revision, forget_revision
+from utils import git_utils
+
+
+class DatasetReadError(Exception):
+    """A dataset exists but (part of) it can't be read."""
+
+
+class _ContentView(list):
+    """Fallback for open_dataset when no sidecar could be built."""
+
+    def same_as(self, index, item):
+        return self[index] == item
+
+
+def _parse_and_index(file_path: Path):
+    """Parse the JSON source and (re)build its sidecar. Returns (content, reader or None)."""
+    stat = os.stat(file_path)
+    with span("dataset.read", path=str(file_path)) as read_span:
+        with open(file_path, 'rb') as f:
+            raw = f.read()
+        read_span.set_attribute("bytes", len(raw))
+    dataset_bytes_read.inc(len(raw))
+    with span("json.loads", bytes=len(raw)) as parse_span, dataset_parse_duration.time(operation="load"):
+        content = json.loads(raw)
+        parse_span.set_attribute("items", len(content))
+
+    reader = None
+    try:
+        with span("sidecar.build", items=len(content)), dataset_parse_duration.time(operation="sidecar_build"):
+            sidecar.build_sidecar(file_path, content, hashlib.sha1(raw).digest(), stat)
+        reader = sidecar.open_sidecar(file_path)
+    except Exception as e:
+        # The sidecar is only an accelerator; fall back to the parsed JSON
+        print(f"Failed to build sidecar for {file_path}: {e}")
+    return content, reader
+
+
+def open_dataset(file_path: Path):
+    """
+    Random access view (len, [i], [a:b], raw(i), same_as(i, item)) over a dataset.
+    Backed by memory-mapped sidecars, items are decoded only on access.
+    Returns None if the dataset doesn't exist or can't be read.
+    """
+    if is_sharded(file_path):
+        manifest = read_manifest(file_path)
+        if manifest is None:
+            return None
+        views = [_open_file(path) for path in shard_paths(file_path, manifest)]
+        if any(v is None for v in views):
+            return None
+        return ShardedView(views, manifest["shard_size"])
+    return _open_file(file_path)
+
+
+def _open_file(file_path: Path):
+    if not file_path.exists():
+        return None
+    try:
+        reader = sidecar.open_sidecar(file_path)
+        if reader is None:
+            content, reader = _parse_and_index(file_path)
+            if reader is None:
+                return _ContentView(content)
+        return reader
+    except Exception as e:
+        print(f"Failed to open dataset {file_path}: {e}")
+        return None
+
+
+def load_dataset(file_path: Path):
+    """
+    Load a dataset from disk. Returns [] if it doesn't exist (e.g. a brand new
+    dataset), and raises DatasetReadError if it exists but can't be read: a
+    caller that saved what it got would otherwise truncate or shift main.
+    """
+    if is_sharded(file_path):
+        manifest = read_manifest(file_path)
+        if manifest is None:
+            raise DatasetReadError(f"Failed to read the shard manifest of {file_path}")
+        content = []
+        for path in shard_paths(file_path, manifest):
+            if not path.exists():
+                raise DatasetReadError(f"Shard {path.name} of {file_path} is missing")
+            content.extend(_load_file(path))
+        return content
+    return _load_file(file_path)
+
+
+def _load_file(file_path: Path):
+    if not file_path.exists():
+        return []
+    try:
+        reader = sidecar.open_sidecar(file_path)
+        if reader is None:
+            content, _ = _parse_and_index(file_path)
+            return content
+        with span("sidecar.load", items=len(reader)), dataset_parse_duration.time(operation="sidecar_load"):
+            content = reader.read_all()
+        dataset_bytes_read.inc(os.path.getsize(reader.path))
+        return content
+    except Exception as e:
+        raise DatasetReadError(f"Failed to load dataset {file_path}: {e}") from e
+
+
+def save_dataset(file_path: Path, content):
+    """
+    Write dataset content to disk in the repo's canonical format (indent=2), refreshing sidecars.
+    Files are replaced atomically so readers in other workers never see a partial write;
+    callers doing read-modify-write must hold utils.locks.dataset_lock(file_path).
+    A sharded dataset only has its changed shards rewritten.
+    """
+    if is_sharded(file_path):
+        _save_sharded(file_path, content)
+    else:
+        _save_file(file_path, content)
+
+
+def _save_file(file_path: Path, content):
+    started = time.perf_counter()
+    with span("json.dumps", items=len(content)) as dump_span:
+        encoded = json.dumps(content, ensure_ascii=False, indent=2).encode('utf-8')
+        dump_span.set_attribute("bytes", len(encoded))
+    dataset_parse_duration.observe(time.perf_counter() - started, operation="dump")
+    with span("dataset.write", path=str(file_path), bytes=len(encoded)):
+        _write_atomic(file_path, encoded)
+    dataset_bytes_written.inc(len(encoded))
+
+    try:
+        with span("sidecar.build", items=len(content)):
+            sidecar.build_sidecar(file_path, content, hashlib.sha1(encoded).digest(), os.stat(file_path))
+    except Exception as e:
+        sidecar.remove_sidecar(file_path)
+        print(f"Failed to build sidecar for {file_path}: {e}")
+
+
+def _write_atomic(file_path: Path, data: bytes):
+    fd, tmp_name = tempfile.mkstemp(dir=file_path.parent, prefix=f".{file_path.name}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.chmod(tmp_name, 0o644)
+        os.replace(tmp_name, file_path)
+    except BaseException:
+        if os.path.exists(tmp_name):
+            os.unlink(tmp_name)
+        raise
+
+
+# --- Sharded layout ---
+
+MANIFEST_NAME = "manifest.json"
+MANIFEST_FORMAT = "polythink-shards"
+DEFAULT_SHARD_SIZE = get_settings().dataset_shard_size
+
+
+def shard_dir(file_path: Path) -> Path:
+    return file_path.with_name(f"{file_path.stem}.shards")
+
+
+def is_sharded(file_path: Path) -> bool:
+    return not file_path.exists() and (shard_dir(file_path) / MANIFEST_NAME).exists()
+
+
+def dataset_exists(file_path: Path) -> bool:
+    return file_path.exists() or is_sharded(file_path)
+
+
+def read_manifest(file_path: Path):
+    try:
+        with open(shard_dir(file_path) / MANIFEST_NAME, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"Failed to read shard manifest for {file_path}: {e}")
+        return None
+    if manifest.get("format") != MANIFEST_FORMAT:
+        return None
+    return manifest
+
+
+def shard_paths(file_path: Path, manifest):
+    directory = shard_dir(file_path)
+    return [directory / shard["file"] for shard in manifest["shards"]]
+
+
+def dataset_files(file_path: Path):
+    """The files a dataset is stored in, for listing sizes and computing revisions."""
+    if is_sharded(file_path):
+        manifest = read_manifest(file_path)
+        directory = shard_dir(file_path)
+        return [directory / MANIFEST_NAME] + (shard_paths(file_path, manifest) if manifest else [])
+    return [file_path] if file_path.exists() else []
+
+
+def _write_manifest(file_path: Path, shard_size, counts):
+    manifest = {
+        "format": MANIFEST_FORMAT,
+        "version": 1,
+        "shard_size": shard_size,
+        "count": sum(counts),
+        "shards": [{"file": f"{i:05d}.json", "count": n} for i, n in enumerate(counts)],
+    }
+    _write_atomic(shard_dir(file_path) / MANIFEST_NAME, json.dumps(manifest, indent=2).encode('utf-8'))
+    return manifest
+
+
+def _save_sharded(file_path: Path, content, shard_size=None):
+    manifest = read_manifest(file_path) if is_sharded(file_path) else None
+    shard_size = shard_size or (manifest or {}).get("shard_size") or DEFAULT_SHARD_SIZE
+    directory = shard_dir(file_path)
+    directory.mkdir(parents=True, exist_ok=True)
+    old_paths = shard_paths(file_path, manifest) if manifest else []
+
+    counts = []
+    rewritten = 0
+    with span("dataset.save_sharded", path=str(file_path), items=len(content)) as save_span:
+        for i, start in enumerate(range(0, len(content), shard_size)):
+            chunk = content[start:start + shard_size]
+            path = directory / f"{i:05d}.json"
+            counts.append(len(chunk))
+            if i < len(old_paths) and old_paths[i] == path and _shard_unchanged(path, chunk):
+                continue
+            _save_file(path, chunk)
+            rewritten += 1
+        save_span.set_attributes(shards=len(counts), rewritten=rewritten)
+
+    if manifest is None or manifest["shard_size"] != shard_size or [s["count"] for s in manifest["shards"]] != counts:
+        _write_manifest(file_path, shard_size, counts)
+    # Shards past the new end (the dataset shrank)
+    for path in old_paths[len(counts):]:
+        path.unlink(missing_ok=True)
+        sidecar.remove_sidecar(path)
+
+
+def _shard_unchanged(path: Path, chunk) -> bool:
+    view = _open_file(path)
+    if view is None or len(view) != len(chunk):
+        return False
+    return all(view.same_as(i, item) for i, item in enumerate(chunk))
+
+
+def convert_layout(file_path: Path, layout: str, shard_size=None):
+    """
+    Switch a dataset between the "single" and "sharded" layouts, keeping its content.
+    Callers must hold utils.locks.dataset_lock(file_path).
+    """
+    if layout not in ("single", "sharded"):
+        raise ValueError(f"Unknown dataset layout: {layout}")
+    content = load_dataset(file_path)
+    if layout == "sharded":
+        if is_sharded(file_path):
+            if shard_size in (None, read_manifest(file_path)["shard_size"]):
+                return
+            # Re-shard from scratch so every shard gets the new size
+            _remove_shards(file_path)
+        _save_sharded(file_path, content, shard_size or DEFAULT_SHARD_SIZE)
+        if file_path.exists():
+            file_path.unlink()
+            sidecar.remove_sidecar(file_path)
+    elif is_sharded(file_path):
+        # Write the file first: once it exists it takes precedence over the shards
+        _save_file(file_path, content)
+        _remove_shards(file_path)
+
+
+def _remove_shards(file_path: Path):
+    directory = shard_dir(file_path)
+    for path in directory.glob("*.json"):
+        sidecar.remove_sidecar(path)
+        path.unlink()
+    directory.rmdir()
+
+
+class ShardedView:
+    """open_dataset view over a sharded dataset; indexes into per-shard views."""
+
+    def __init__(self, views, shard_size):
+        self.views = views
+        self.shard_size = shard_size
+        self.count = sum(len(v) for v in views)
+
+    def __len__(self):
+        return self.count
+
+    def _locate(self, index):
+        if index < 0:
+            index += self.count
+        if not 0 <= index < self.count:
+            raise IndexError(index)
+        return self.views[index // self.shard_size], index % self.shard_size
+
+    def raw(self, index):
+        view, local = self._locate(index)
+        return view.raw(local)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(self.count))]
+        view, local = self._locate(index)
+        return view[local]
+
+    def __iter__(self):
+        for view in self.views:
+            yield from view
+
+    def same_as(self, index, item):
+        view, local = self._locate(index)
+        return view.same_as(local, item)
+
+    def read_all(self):
+        return [item for view in self.views for item in view]
+
+
+def dataset_revision(file_path: Path) -> str:
+    """Content hash of a dataset in either layout, or "missing". Used for ETags."""
+    files = dataset_files(file_path)
+    if not files:
+        return "missing"
+    if len(files) == 1:
+        return file_revision(files[0])
+    return hashlib.sha1("\x1f".join(file_revision(f) for f in files).encode('utf-8')).hexdigest()
+
+
+def invalidate_files(file_paths):
+    """Drop cached revisions and sidecars for files changed behind our back (e.g. by a git sync)."""
+    for file_path in file_paths:
+        forget_revision(file_path)
+        sidecar.remove_sidecar(file_path)
+
+
+# --- Streaming imports ---
+
+# Names of the files and directories that saves and imports write next to a
+# dataset before moving them into place
+STAGING_PATTERNS = (".*.tmp", ".*.import.*/", ".*.old.*/")
+# Staging left untouched this long belongs to a process that died
+STAGING_ORPHAN_SECONDS = 3600
+
+
+def _is_staging(name, is_dir):
+    return any(
+        pattern.endswith("/") == is_dir and fnmatch.fnmatchcase(name, pattern.rstrip("/"))
+        for pattern in STAGING_PATTERNS
+    )
+
+
+def clean_staging(root: Path, max_age=STAGING_ORPHAN_SECONDS):
+    """
+    Keep staging out of git commits, and remove staging under `root` that
+    an interrupted save or import left behind. Returns how many were removed.
+    """
+    git_utils.exclude_paths(STAGING_PATTERNS)
+    removed = 0
+    now = time.time()
+    for directory, dirs, files in os.walk(root):
+        dirs[:] = [name for name in dirs if name != ".git"]
+        orphans = [(name, True) for name in dirs if _is_staging(name, True)]
+        orphans += [(name, False) for name in files if _is_staging(name, False)]
+        for name, is_dir in orphans:
+            path = Path(directory) / name
+            try:
+                if now - path.stat().st_mtime < max_age:
+                    continue
+                if is_dir:
+                    shutil.rmtree(path)
+                    dirs.remove(name)
+                else:
+                    path.unlink()
+                removed += 1
+            except FileNotFoundError:
+                pass
+    if removed:
+        print(f"Removed {removed} interrupted dataset writes under {root}")
+    return removed
+
+
+class StagedDataset:
+    """
+    A dataset written from a stream of items into a staging directory next
+    to its final location, one shard_size chunk in memory at a time.
+    `install()` moves it into place; callers must hold
+    utils.locks.dataset_lock(file_path) for that step only.
+    Layout "auto" picks sharded once there is more than one shard of items.
+    """
+
+    def __init__(self, file_path: Path, layout="auto", shard_size=None):
+        if layout not in ("auto", "single", "sharded"):
+            raise ValueError(f"Unknown dataset layout: {layout}")
+        self.file_path = file_path
+        self.layout = layout
+        self.shard_size = shard_size or DEFAULT_SHARD_SIZE
+        self.directory = Path(tempfile.mkdtemp(dir=file_path.parent, prefix=f".{file_path.stem}.import."))
+        self.counts = []
+        self.bytes = 0
+        # The first chunk's sidecar is built at install, once the layout (and so its final path) is known
+        self._first = None
+
+    def write(self, items):
+        """Consume an iterable of items. Returns the item count."""
+        chunk = []
+        with span("dataset.stage", path=str(self.file_path)) as stage_span:
+            for item in items:
+                chunk.append(item)
+                if len(chunk) == self.shard_size:
+                    self._write_shard(chunk)
+                    chunk = []
+            if chunk or not self.counts:
+                self._write_shard(chunk)
+            stage_span.set_attributes(items=sum(self.counts), shards=len(self.counts), bytes=self.bytes)
+        return sum(self.counts)
+
+    def _write_shard(self, chunk):
+        name = f"{len(self.counts):05d}.json"
+        path = self.directory / name
+        encoded = json.dumps(chunk, ensure_ascii=False, indent=2).encode('utf-8')
+        with open(path, 'wb') as f:
+            f.write(encoded)
+        os.chmod(path, 0o644)
+        self.counts.append(len(chunk))
+        self.bytes += len(encoded)
+        dataset_bytes_written.inc(len(encoded))
+        if len(self.counts) == 1:
+            self._first = (chunk, hashlib.sha1(encoded).digest())
+        elif self.layout != "single":
+            # Renames keep mtime and size, so the sidecar stays valid once
+            # the shard is moved to where it will live
+            self._build_sidecar(shard_dir(self.file_path) / name, path, chunk, hashlib.sha1(encoded).digest())
+
+    def _build_sidecar(self, final, staged, chunk, digest):
+        try:
+            sidecar.build_sidecar(final, chunk, digest, os.stat(staged))
+        except Exception as e:
+            sidecar.remove_sidecar(final)
+            print(f"Failed to build sidecar for {final}: {e}")
+
+    def final_layout(self):
+        if self.layout == "auto":
+            return "sharded" if len(self.counts) > 1 else "single"
+        return self.layout
+
+    def install(self):
+        """Replace whatever is stored at file_path with the staged items. Returns the layout used."""
+        layout = self.final_layout()
+        old_files = dataset_files(self.file_path)
+        if layout == "single":
+            staged = self.directory / "00000.json"
+            if len(self.counts) > 1:
+                staged = self._concatenate()
+            else:
+                self._build_sidecar(self.file_path, staged, *self._first)
+            os.replace(staged, self.file_path)
+            if shard_dir(self.file_path).exists():
+                _remove_shards(self.file_path)
+        else:
+            target = shard_dir(self.file_path)
+            self._build_sidecar(target / "00000.json", self.directory / "00000.json", *self._first)
+            manifest = {
+                "format": MANIFEST_FORMAT,
+                "version": 1,
+                "shard_size": self.shard_size,
+                "count": sum(self.counts),
+                "shards": [{"file": f"{i:05d}.json", "count": n} for i, n in enumerate(self.counts)],
+            }
+            _write_atomic(self.directory / MANIFEST_NAME, json.dumps(manifest, indent=2).encode('utf-8'))
+            previous = None
+            if target.exists():
+                previous = target.with_name(f".{target.name}.old.{os.getpid()}")
+                os.replace(target, previous)
+            os.replace(self.directory, target)
+            # A single file takes precedence over shards, so it goes last
+            if self.file_path.exists():
+                self.file_path.unlink()
+                sidecar.remove_sidecar(self.file_path)
+            if previous is not None:
+                for path in previous.glob("*.json"):
+                    path.unlink()
+                previous.rmdir()
+        # Cached revisions and sidecars of the files that were replaced
+        new_files = set(dataset_files(self.file_path))
+        for path in old_files:
+            forget_revision(path)
+            if path not in new_files:
+                sidecar.remove_sidecar(path)
+        self.discard()
+        return layout
+
+    def _concatenate(self):
+        """One canonical JSON array from the staged shards, streamed shard by shard."""
+        target = self.directory / "combined.json"
+        empty = True
+        with open(target, 'wb') as out:
+            out.write(b"[\n")
+            for i in range(len(self.counts)):
+                with open(self.directory / f"{i:05d}.json", 'rb') as f:
+                    # Each shard is "[\n  item,\n  item\n]"; keep what's between the brackets
+                    body = f.read()[2:-2]
+                if not body:
+                    continue
+                if not empty:
+                    out.write(b",\n")
+                out.write(body)
+                empty = False
+            out.write(b"\n]")
+        if empty:
+            target.write_bytes(b"[]")
+        os.chmod(target, 0o644)
+        return target
+
+    def discard(self):
+        if self.directory.exists():
+            for path in self.directory.iterdir():
+                path.unlink()
+            self.directory.rmdir()
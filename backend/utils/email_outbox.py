@@ -0,0 +1,307 @@
+"""
+Outbound email.
+
+Messages are rendered by the caller and stored in the email_outbox
+collection, so they survive restarts and any worker can deliver them:
+
+    {to_email, body, kind, attempts, due_at, claimed_until, claim, created_at, last_error}
+
+Each process runs one sender thread. It claims a batch of due messages for
+EMAIL_CLAIM_SECONDS, sends them over one SMTP connection that it reuses
+until it has been idle for EMAIL_IDLE_TIMEOUT seconds (a burst of OTP mails
+costs one connect + STARTTLS + login), and deletes what was sent. Failed
+sends are rescheduled with exponential backoff; messages that exhaust their
+retries stay in the collection as failed. A sender that dies mid-batch
+leaves its claim to expire, after which another worker sends the batch
+again, so delivery is at least once.
+"""
+import smtplib
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+from pymongo.errors import PyMongoError
+from database import email_outbox_collection
+from settings import get_settings
+from utils.metrics import registry, smtp_send_duration
+
+settings = get_settings()
+SMTP_SERVER = settings.smtp_server
+SMTP_PORT = settings.smtp_port
+SMTP_USERNAME = settings.smtp_username
+SMTP_PASSWORD = settings.smtp_password
+SENDER_EMAIL = settings.sender_email
+# Local stand-ins (aiosmtpd, mailhog, ...) usually don't speak STARTTLS
+SMTP_USE_TLS = settings.smtp_use_tls
+
+EMAIL_BATCH_SIZE = settings.email_batch_size
+EMAIL_MAX_RETRIES = settings.email_max_retries
+EMAIL_RETRY_BACKOFF = settings.email_retry_backoff
+EMAIL_IDLE_TIMEOUT = settings.email_idle_timeout
+# How long a claimed batch is reserved for the sender that claimed it
+EMAIL_CLAIM_SECONDS = 120
+# Longest the sender sleeps before looking for messages queued by other workers
+EMAIL_POLL_SECONDS = 5
+
+QUEUED = "queued"
+FAILED = "failed"
+
+
+class EmailOutbox:
+    """
+    Mongo-backed outbox drained by one sender thread per process. `enqueue`
+    only inserts a document and wakes the local sender.
+    """
+
+    def __init__(
+        self,
+        host=SMTP_SERVER,
+        port=SMTP_PORT,
+        username=SMTP_USERNAME,
+        password=SMTP_PASSWORD,
+        sender=SENDER_EMAIL,
+        use_tls=SMTP_USE_TLS,
+        batch_size=EMAIL_BATCH_SIZE,
+        max_retries=EMAIL_MAX_RETRIES,
+        retry_backoff=EMAIL_RETRY_BACKOFF,
+        idle_timeout=EMAIL_IDLE_TIMEOUT,
+        poll_seconds=EMAIL_POLL_SECONDS,
+        collection=email_outbox_collection,
+    ):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.sender = sender
+        self.use_tls = use_tls
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.idle_timeout = idle_timeout
+        self.poll_seconds = poll_seconds
+        self.collection = collection
+
+        self._server = None
+        self._last_used = 0.0
+        self._thread = None
+        self._wake = threading.Event()
+        self._stopping = threading.Event()
+        self._lock = threading.Lock()
+
+        # Counters of this process
+        self._stats = {
+            "enqueued": 0,
+            "sent": 0,
+            "failed": 0,
+            "retried": 0,
+            "dropped": 0,
+            "batches": 0,
+            "connections_opened": 0,
+            "send_seconds_total": 0.0,
+            "last_error": None,
+        }
+
+    # --- Public API ---
+
+    def enqueue(self, to_email: str, body: str, kind: str = "email"):
+        """Store a rendered message for delivery. Never blocks on SMTP."""
+        if not self.host:
+            print(f"SMTP_SERVER not configured, dropping {kind} email to {to_email}")
+            self._bump("dropped")
+            return
+        now = datetime.utcnow()
+        self.collection.insert_one({
+            "to_email": to_email,
+            "body": body,
+            "kind": kind,
+            "status": QUEUED,
+            "attempts": 0,
+            "due_at": now,
+            "claimed_until": None,
+            "created_at": now,
+        })
+        self._bump("enqueued")
+        self.start()
+        self._wake.set()
+
+    def start(self):
+        """Start the sender, which also delivers what earlier processes left queued."""
+        if not self.host:
+            return
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stopping.clear()
+            self._thread = threading.Thread(target=self._run, name="email-outbox", daemon=True)
+            self._thread.start()
+
+    def counters(self):
+        with self._lock:
+            return dict(self._stats)
+
+    def stats(self):
+        stats = self.counters()
+        stats["queued"] = self.queued_count()
+        stats["pending_retries"] = self.collection.count_documents({"status": QUEUED, "attempts": {"$gt": 0}})
+        stats["connected"] = self._server is not None
+        stats["avg_send_ms"] = (
+            round(stats["send_seconds_total"] / stats["sent"] * 1000, 2) if stats["sent"] else 0.0
+        )
+        return stats
+
+    def queued_count(self):
+        return self.collection.count_documents({"status": QUEUED})
+
+    def stop(self, timeout: float = 10.0):
+        """Send what is due (best effort within `timeout`) and close the connection. The rest stays queued."""
+        if self._thread is None:
+            return
+        self._stopping.set()
+        self._wake.set()
+        self._thread.join(timeout)
+        self._thread = None
+
+    # --- Sender ---
+
+    def _bump(self, key, amount=1):
+        with self._lock:
+            self._stats[key] += amount
+
+    def _ready_query(self, now):
+        return {"status": QUEUED, "due_at": {"$lte": now},
+                "$or": [{"claimed_until": None}, {"claimed_until": {"$lt": now}}]}
+
+    def _claim_batch(self):
+        now = datetime.utcnow()
+        ready = self._ready_query(now)
+        ids = [doc["_id"] for doc in
+               self.collection.find(ready, {"_id": 1}).sort("due_at", 1).limit(self.batch_size)]
+        if not ids:
+            return []
+        claim = uuid.uuid4().hex
+        # Re-checks readiness, so a message another worker claimed in between is skipped
+        self.collection.update_many(
+            {"_id": {"$in": ids}, **ready},
+            {"$set": {"claim": claim, "claimed_until": now + timedelta(seconds=EMAIL_CLAIM_SECONDS)}},
+        )
+        return list(self.collection.find({"_id": {"$in": ids}, "claim": claim}).sort("due_at", 1))
+
+    def _next_wait(self):
+        """Seconds until the next retry is due, at most `poll_seconds`."""
+        if self._stopping.is_set():
+            return 0.0
+        # Messages other workers have claimed are theirs until the claim expires
+        upcoming = self.collection.find_one(
+            {"status": QUEUED, "$or": [{"claimed_until": None}, {"claimed_until": {"$lt": datetime.utcnow()}}]},
+            {"due_at": 1}, sort=[("due_at", 1)],
+        )
+        if upcoming is None:
+            return self.poll_seconds
+        return min(max(0.0, (upcoming["due_at"] - datetime.utcnow()).total_seconds()), self.poll_seconds)
+
+    def _run(self):
+        while True:
+            try:
+                batch = self._claim_batch()
+                if batch:
+                    self._send_batch(batch)
+                    continue
+                if self._stopping.is_set():
+                    break
+                wait = self._next_wait()
+            except PyMongoError as e:
+                print(f"Email outbox can't reach the database: {e}")
+                if self._stopping.is_set():
+                    break
+                wait = self.poll_seconds
+            if self._server is not None:
+                wait = min(wait, max(0.0, self._last_used + self.idle_timeout - time.monotonic()))
+            self._wake.wait(wait)
+            self._wake.clear()
+            if self._server is not None and time.monotonic() - self._last_used >= self.idle_timeout:
+                self._disconnect()
+        self._disconnect()
+
+    def _send_batch(self, batch):
+        self._bump("batches")
+        sent = []
+        for message in batch:
+            started = time.perf_counter()
+            try:
+                self._deliver(message)
+            except Exception as e:
+                smtp_send_duration.observe(time.perf_counter() - started, kind=message["kind"], outcome="error")
+                self._disconnect()
+                self._handle_failure(message, e)
+                continue
+            elapsed = time.perf_counter() - started
+            smtp_send_duration.observe(elapsed, kind=message["kind"], outcome="ok")
+            self._last_used = time.monotonic()
+            sent.append(message["_id"])
+            with self._lock:
+                self._stats["sent"] += 1
+                self._stats["send_seconds_total"] += elapsed
+        if sent:
+            self.collection.delete_many({"_id": {"$in": sent}})
+
+    def _deliver(self, message):
+        try:
+            self._connection().sendmail(self.sender, message["to_email"], message["body"])
+        except smtplib.SMTPServerDisconnected:
+            # Pooled connection went stale, reconnect once before counting a failure
+            self._disconnect()
+            self._connection().sendmail(self.sender, message["to_email"], message["body"])
+
+    def _handle_failure(self, message, error):
+        last_error = f"{type(error).__name__}: {error}"
+        with self._lock:
+            self._stats["last_error"] = last_error
+        attempts = message["attempts"] + 1
+        update = {"attempts": attempts, "last_error": last_error, "claimed_until": None}
+        permanent = isinstance(error, smtplib.SMTPRecipientsRefused)
+        if permanent or attempts > self.max_retries:
+            print(f"Giving up on {message['kind']} email to {message['to_email']} after {attempts} attempts: {error}")
+            update["status"] = FAILED
+            self._bump("failed")
+        else:
+            delay = self.retry_backoff * (2 ** (attempts - 1))
+            print(f"Failed to send {message['kind']} email to {message['to_email']} ({error}), "
+                  f"retrying in {delay:.1f}s")
+            update["due_at"] = datetime.utcnow() + timedelta(seconds=delay)
+            self._bump("retried")
+        self.collection.update_one({"_id": message["_id"]}, {"$set": update})
+
+    def _connection(self):
+        if self._server is None:
+            if self.port == 465:
+                server = smtplib.SMTP_SSL(self.host, self.port, timeout=30)
+            else:
+                server = smtplib.SMTP(self.host, self.port, timeout=30)
+                if self.use_tls:
+                    server.starttls()
+            if self.username:
+                server.login(self.username, self.password)
+            self._server = server
+            self._bump("connections_opened")
+        return self._server
+
+    def _disconnect(self):
+        if self._server is None:
+            return
+        try:
+            self._server.quit()
+        except Exception:
+            pass
+        self._server = None
+
+
+outbox = EmailOutbox()
+
+registry.gauge(
+    "email_outbox_queued", "Emails waiting in the outbox, from every worker (including scheduled retries).",
+    callback=lambda: outbox.queued_count(),
+)
+registry.gauge(
+    "email_outbox_messages", "Outbox delivery counters since process start.", ("state",),
+    callback=lambda: {(state,): outbox.counters()[state] for state in ("sent", "failed", "retried", "dropped")},
+)
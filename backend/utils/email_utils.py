@@ -1,17 +1,20 @@
-import smtplib
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
-import os
-from dotenv import load_dotenv
+from settings import get_settings
+from utils.email_outbox import outbox
 
-load_dotenv()
+SENDER_EMAIL = get_settings().sender_email
+SENDER_NAME = get_settings().sender_name
 
-SMTP_SERVER = os.getenv("SMTP_SERVER")
-SMTP_PORT = int(os.getenv("SMTP_PORT", 587))
-SMTP_USERNAME = os.getenv("SMTP_USERNAME")
-SMTP_PASSWORD = os.getenv("SMTP_PASSWORD")
-SENDER_EMAIL = os.getenv("SENDER_EMAIL")
-SENDER_NAME = os.getenv("SENDER_NAME")
+def build_message(to_email: str, subject: str, html_content: str) -> str:
+    """Render an HTML email into the wire format queued on the outbox."""
+    msg = MIMEMultipart()
+    msg["From"] = f"{SENDER_NAME} <{SENDER_EMAIL}>"
+    msg["To"] = to_email
+    msg["Subject"] = subject
+    
+    msg.attach(MIMEText(html_content, "html"))
+    return msg.as_string()
 
 def send_verification_email(to_email: str, code: str):
     """Send verification code via email."""
@@ -36,25 +39,9 @@ def send_verification_email(to_email: str, code: str):
     </html>
     """
     
-    msg = MIMEMultipart()
-    msg["From"] = f"{SENDER_NAME} <{SENDER_EMAIL}>"
-    msg["To"] = to_email
-    msg["Subject"] = subject
-    
-    msg.attach(MIMEText(html_content, "html"))
-    
-    try:
-        print(f"Attempting to send email to {to_email}...")
-        server = smtplib.SMTP(SMTP_SERVER, SMTP_PORT)
-        server.starttls()
-        server.login(SMTP_USERNAME, SMTP_PASSWORD)
-        server.sendmail(SENDER_EMAIL, to_email, msg.as_string())
-        server.quit()
-        print(f"Email sent successfully to {to_email}")
-        return True
-    except Exception as e:
-        print(f"Failed to send email to {to_email}: {str(e)}")
-        raise e
+    # Delivery happens on the outbox worker over a pooled SMTP connection
+    outbox.enqueue(to_email, build_message(to_email, subject, html_content), kind="verification")
+    return True
 
 def send_reset_email(to_email: str, code: str):
     """Send password reset code via email."""
@@ -79,29 +66,12 @@ def send_reset_email(to_email: str, code: str):
     </html>
     """
     
-    msg = MIMEMultipart()
-    msg["From"] = f"{SENDER_NAME} <{SENDER_EMAIL}>"
-    msg["To"] = to_email
-    msg["Subject"] = subject
-    
-    msg.attach(MIMEText(html_content, "html"))
-    
-    try:
-        print(f"Attempting to send reset email to {to_email}...")
-        server = smtplib.SMTP(SMTP_SERVER, SMTP_PORT)
-        server.starttls()
-        server.login(SMTP_USERNAME, SMTP_PASSWORD)
-        server.sendmail(SENDER_EMAIL, to_email, msg.as_string())
-        server.quit()
-        print(f"Reset email sent successfully to {to_email}")
-        return True
-    except Exception as e:
-        print(f"Failed to send reset email to {to_email}: {str(e)}")
-        raise e
+    outbox.enqueue(to_email, build_message(to_email, subject, html_content), kind="reset")
+    return True
 
 def send_login_otp_email(to_email: str, code: str):
     """Sends a login OTP email."""
-    print(f"Sending LOGIN OTP email to {to_email} with code {code}") # Log for debugging
+    print(f"Queueing LOGIN OTP email to {to_email}") # Log for debugging
     
     html_content = f"""
     <html>
@@ -122,26 +92,5 @@ def send_login_otp_email(to_email: str, code: str):
     </html>
     """
     
-    message = MIMEMultipart()
-    message["From"] = f"{SENDER_NAME} <{SENDER_EMAIL}>"
-    message["To"] = to_email
-    message["Subject"] = "Your Login Code - PolyThink Studio"
-    
-    message.attach(MIMEText(html_content, "html"))
-    
-    try:
-        print(f"Attempting to send login OTP to {to_email}...")
-        
-        if SMTP_PORT == 465:
-            server = smtplib.SMTP_SSL(SMTP_SERVER, SMTP_PORT)
-        else:
-            server = smtplib.SMTP(SMTP_SERVER, SMTP_PORT)
-            server.starttls()
-            
-        server.login(SMTP_USERNAME, SMTP_PASSWORD)
-        server.sendmail(SENDER_EMAIL, to_email, message.as_string())
-        server.quit()
-        print(f"Login OTP email sent successfully to {to_email}")
-    except Exception as e:
-        print(f"Failed to send login OTP email: {e}")
-        raise e
+    subject = "Your Login Code - PolyThink Studio"
+    outbox.enqueue(to_email, build_message(to_email, subject, html_content), kind="login_otp")
@@ -0,0 +1,176 @@
+"""
+Server-push events (PR opened / merged / rejected, fork saved, git sync, ...).
+
+Publishers call `bus.publish(type, data, users=..., roles=...)`. An event is
+delivered to subscribers whose username is in `users` or whose role is in
+`roles`; with neither set it goes to everyone.
+
+The bus fans events out to the subscribers of this process. With several
+workers set EVENT_BACKEND=mongo: events are then written to a capped
+collection and every worker tails it, so a subscriber sees events published
+by any worker.
+"""
+import asyncio
+import itertools
+import threading
+import time
+import uuid
+from datetime import datetime
+from settings import get_settings
+from utils.metrics import registry
+
+settings = get_settings()
+EVENT_BACKEND = settings.event_backend  # local | mongo
+EVENT_QUEUE_SIZE = settings.event_queue_size
+EVENT_COLLECTION_BYTES = settings.event_collection_bytes
+
+
+class Subscription:
+    """One connected client. Events are queued on the client's event loop."""
+
+    def __init__(self, bus, username, role):
+        self.bus = bus
+        self.username = username
+        self.role = role
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue(maxsize=EVENT_QUEUE_SIZE)
+        self.dropped = 0
+
+    def wants(self, event):
+        users, roles = event.get("users"), event.get("roles")
+        if users is None and roles is None:
+            return True
+        return self.username in (users or ()) or self.role in (roles or ())
+
+    def _offer(self, event):
+        # Runs on the subscriber's loop. A client that stops reading loses
+        # its oldest events rather than growing the queue without bound.
+        if self.queue.full():
+            self.queue.get_nowait()
+            self.dropped += 1
+        self.queue.put_nowait(event)
+
+    async def get(self, timeout):
+        return await asyncio.wait_for(self.queue.get(), timeout)
+
+    def close(self):
+        self.bus.unsubscribe(self)
+
+
+class LocalBackend:
+    """Delivers events to subscribers in this process only."""
+
+    def __init__(self, deliver):
+        self.deliver = deliver
+        self._ids = itertools.count(1)
+        self._prefix = uuid.uuid4().hex[:8]
+
+    def publish(self, event):
+        event["id"] = f"{self._prefix}-{next(self._ids)}"
+        self.deliver(event)
+
+
+class MongoBackend:
+    """
+    Shares events between workers through a capped collection. Each process
+    tails it from a background thread and delivers what it reads, including
+    its own events, so every event is delivered exactly once per process.
+    Needs a real MongoDB server (tailable cursors).
+    """
+
+    def __init__(self, deliver):
+        from database import db
+        self.deliver = deliver
+        if "events" not in db.list_collection_names():
+            try:
+                db.create_collection("events", capped=True, size=EVENT_COLLECTION_BYTES)
+            except Exception:
+                pass  # created concurrently by another worker
+        self.collection = db["events"]
+        self._thread = threading.Thread(target=self._tail, name="event-tail", daemon=True)
+        self._thread.start()
+
+    def publish(self, event):
+        self.collection.insert_one(dict(event))
+
+    def _tail(self):
+        from pymongo import CursorType
+        last = self.collection.find_one(sort=[("$natural", -1)])
+        last_id = last["_id"] if last else None
+        while True:
+            query = {"_id": {"$gt": last_id}} if last_id is not None else {}
+            try:
+                cursor = self.collection.find(query, cursor_type=CursorType.TAILABLE_AWAIT)
+                while cursor.alive:
+                    for doc in cursor:
+                        last_id = doc["_id"]
+                        doc["id"] = str(doc.pop("_id"))
+                        self.deliver(doc)
+            except Exception as e:
+                print(f"Event tail failed: {e}")
+            time.sleep(1)
+
+
+class EventBus:
+    def __init__(self, backend=EVENT_BACKEND):
+        self.backend_name = backend
+        self._backend = None
+        self._subscriptions = set()
+        self._lock = threading.Lock()
+        self.published = registry.counter("events_published_total", "Server-push events published.", ("type",))
+
+    @property
+    def backend(self):
+        # Created lazily so importing this module never touches the database
+        if self._backend is None:
+            with self._lock:
+                if self._backend is None:
+                    backend_cls = MongoBackend if self.backend_name == "mongo" else LocalBackend
+                    self._backend = backend_cls(self._deliver)
+        return self._backend
+
+    def subscribe(self, username, role) -> Subscription:
+        subscription = Subscription(self, username, role)
+        with self._lock:
+            self._subscriptions.add(subscription)
+        self.backend  # start tailing before the first event can be missed
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscriptions.discard(subscription)
+
+    def subscriber_count(self):
+        return len(self._subscriptions)
+
+    def publish(self, type, data=None, users=None, roles=None):
+        """Publish an event. Never raises: notifications must not fail the request that caused them."""
+        event = {
+            "type": type,
+            "data": data or {},
+            "users": list(users) if users is not None else None,
+            "roles": list(roles) if roles is not None else None,
+            "created_at": datetime.utcnow().isoformat(),
+        }
+        try:
+            self.backend.publish(event)
+            self.published.inc(type=type)
+        except Exception as e:
+            print(f"Failed to publish event {type}: {e}")
+
+    def _deliver(self, event):
+        with self._lock:
+            targets = [s for s in self._subscriptions if s.wants(event)]
+        for subscription in targets:
+            try:
+                subscription.loop.call_soon_threadsafe(subscription._offer, event)
+            except RuntimeError:
+                self.unsubscribe(subscription)  # its loop is gone
+
+
+bus = EventBus()
+
+registry.gauge(
+    "events_subscribers", "Connected server-push event clients in this process.",
+    callback=lambda: bus.subscriber_count(),
+)
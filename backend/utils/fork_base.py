@@ -0,0 +1,161 @@
+"""
+Base revisions of forks, and three-way merging of fork edits into main.
+
+When a fork is first saved we store the main dataset as it was at that
+moment in git's object database (`git hash-object -w`, one blob per file or
+shard) and keep the blob ids on the fork. A PR is then reviewed as
+fork-vs-base, so changes other people merged into main since the fork was
+taken don't show up as the author's edits, and accepted items are merged
+three-way into whatever main is now.
+
+Once a fork's PR is merged, its base moves forward to main as merged
+(`rebase`), so merged items stop counting as the fork's edits and editing
+them again doesn't conflict with the fork's own earlier merge.
+
+Base blobs never change, so decoded bases are cached by blob id. Forks saved
+before this existed have no base and keep the old fork-vs-main behaviour.
+"""
+import json
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from database import user_datasets_collection
+from settings import get_settings
+from utils import git_utils
+from utils.dataset_io import is_sharded, read_manifest, shard_paths
+from utils.tracing import span
+
+BASE_CACHE_BYTES = int(get_settings().fork_base_cache_mb * 1024 * 1024)
+
+
+def capture_base(file_path: Path) -> dict:
+    """Fields recording the current on-disk state of a main dataset as a fork's base."""
+    if is_sharded(file_path):
+        manifest = read_manifest(file_path)
+        files = shard_paths(file_path, manifest) if manifest else []
+    else:
+        files = [file_path] if file_path.exists() else []
+    with span("fork.capture_base", files=len(files)):
+        blobs = [git_utils.hash_object(f) for f in files]
+        for blob in blobs:
+            git_utils.pin_object(blob)
+    return {"base_commit": git_utils.head_commit(), "base_blobs": blobs}
+
+
+def release_blobs(blobs) -> int:
+    """Unpin base blobs that no fork refers to anymore. Returns how many were released."""
+    released = 0
+    for blob in set(blobs):
+        if user_datasets_collection.find_one({"base_blobs": blob}, {"_id": 1}) is None:
+            git_utils.unpin_object(blob)
+            released += 1
+    return released
+
+
+def rebase(user_dataset, file_path: Path, **fields):
+    """
+    Move a fork's base to main as it is now, after the fork's PR was merged
+    into it (callers hold the dataset lock). `fields` are set on the fork too.
+    The change index is dropped, as it was taken against the old base.
+    """
+    fields.update(capture_base(file_path))
+    user_datasets_collection.update_one({"_id": user_dataset["_id"]},
+                                        {"$set": fields, "$unset": {"changes": ""}})
+    release_blobs(set(user_dataset.get("base_blobs", [])) - set(fields["base_blobs"]))
+
+
+def has_base(user_dataset) -> bool:
+    return "base_blobs" in user_dataset
+
+
+class _BlobCache:
+    """LRU of decoded blob contents, bounded by the blobs' encoded size."""
+
+    def __init__(self, max_bytes=BASE_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self._items = OrderedDict()  # blob id -> (size, items)
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, blob):
+        with self._lock:
+            entry = self._items.get(blob)
+            if entry is not None:
+                self._items.move_to_end(blob)
+                return entry[1]
+        raw = git_utils.cat_file.read(blob)
+        items = json.loads(raw)
+        with self._lock:
+            if blob not in self._items and len(raw) <= self.max_bytes:
+                self._items[blob] = (len(raw), items)
+                self._bytes += len(raw)
+                while self._bytes > self.max_bytes:
+                    _, (size, _) = self._items.popitem(last=False)
+                    self._bytes -= size
+        return items
+
+
+_blob_cache = _BlobCache()
+
+
+class MissingBaseError(Exception):
+    """A fork's base blob is gone from the object database (e.g. the repo was re-cloned)."""
+
+
+def load_base(user_dataset, missing_ok=False):
+    """
+    The fork's base content (a list of items), or None for forks without a
+    recorded base. Raises MissingBaseError if a base blob can't be read,
+    unless `missing_ok`, in which case the fork is treated as having no base.
+    """
+    if not has_base(user_dataset):
+        return None
+    with span("fork.load_base", blobs=len(user_dataset["base_blobs"])):
+        content = []
+        for blob in user_dataset["base_blobs"]:
+            try:
+                content.extend(_blob_cache.get(blob))
+            except KeyError:
+                if missing_ok:
+                    print(f"Base blob {blob} of fork {user_dataset.get('_id')} is missing; comparing with main")
+                    return None
+                raise MissingBaseError(f"the fork's base revision (blob {blob[:12]}) is no longer available")
+    return content
+
+
+def _at(items, index):
+    return items[index] if index < len(items) else None
+
+
+def fork_changes(base, fork, candidates=None):
+    """
+    Indices where the fork differs from its base: edits, additions and
+    removals. Only `candidates` are compared when given.
+    """
+    if candidates is None:
+        candidates = range(max(len(base), len(fork)))
+    return [i for i in candidates if _at(base, i) != _at(fork, i)]
+
+
+def three_way_merge(base, fork, main, indices, overwrite_conflicts=False):
+    """
+    Apply the fork's version of each index in `indices` to `main` (in place).
+    An index conflicts when main changed it since the base to something other
+    than the fork's version; conflicting indices are skipped unless
+    `overwrite_conflicts`. Removals aren't applied (the editor never removes
+    items). Returns (applied, conflicts), both lists of indices.
+    """
+    applied, conflicts = [], []
+    for idx in sorted(set(indices)):
+        theirs = _at(fork, idx)
+        if idx < 0 or theirs is None:
+            continue
+        ours, original = _at(main, idx), _at(base, idx)
+        if ours != theirs and ours != original and not overwrite_conflicts:
+            conflicts.append(idx)
+            continue
+        if idx >= len(main):
+            main.extend([None] * (idx + 1 - len(main)))
+        main[idx] = theirs
+        applied.append(idx)
+    return applied, conflicts
@@ -0,0 +1,403 @@
+"""
+Garbage collection of forks.
+
+Forks are kept after their PR is merged (as GitHub keeps the branch), so
+without cleanup user_datasets only grows. A collection run looks at forks
+that have no open PR and no buffered save:
+
+    merged   the fork's last PR was merged over FORK_GC_MERGED_DAYS ago and
+             the fork hasn't been saved since
+    stale    the fork hasn't been saved for FORK_GC_STALE_DAYS
+
+A candidate whose content is identical to main is dropped. Anything else is
+archived first: its content is gzipped into fork_archive together with the
+user, path, revision and base commit. Deletes are conditional on the fork's
+revision, so a save that lands during the run keeps the fork. Base blobs no
+remaining fork uses are unpinned, so `git gc` can reclaim them.
+
+Deleting a user purges their forks, archives, pull requests and leaderboard
+entries the same way. Deleted users are recorded in deleted_users until
+their purge is done, so a purge interrupted by a restart is picked up again:
+workers claim entries for PURGE_LEASE_MINUTES, and every collection run
+drains what is left.
+
+All of this runs on one background thread: scheduled runs at most once every
+FORK_GC_INTERVAL_HOURS across workers, and user purges as they are recorded.
+Forks are scanned in batches without their content, and only candidates are
+read in full. Each run's report (forks dropped / archived, bytes reclaimed)
+is stored in gc_runs.
+"""
+import gzip
+import json
+import threading
+import time
+from datetime import datetime, timedelta
+import bson
+from pymongo.errors import BulkWriteError, DuplicateKeyError, PyMongoError
+from database import (
+    user_datasets_collection, pull_requests_collection, fork_archive_collection,
+    gc_runs_collection, scheduled_jobs_collection, deleted_users_collection, get_db
+)
+from settings import get_settings
+from utils import leaderboard
+from utils.dataset_io import open_dataset
+from utils.fork_base import release_blobs
+from utils.metrics import registry
+from utils.tracing import span
+from utils.write_behind import fork_buffer
+
+settings = get_settings()
+# Hours between scheduled runs; 0 disables them (runs can still be started by an admin)
+FORK_GC_INTERVAL_HOURS = settings.fork_gc_interval_hours
+FORK_GC_MERGED_DAYS = settings.fork_gc_merged_days
+FORK_GC_STALE_DAYS = settings.fork_gc_stale_days
+FORK_GC_BATCH_SIZE = settings.fork_gc_batch_size
+# Run Mongo's `compact` on user_datasets after a run that removed forks
+FORK_GC_COMPACT = settings.fork_gc_compact
+# Pause between batches, so a long run leaves room for request handling
+BATCH_PAUSE_SECONDS = 0.05
+# A claimed purge not finished within this long is retried by any worker
+PURGE_LEASE_MINUTES = 10
+
+# Fork fields the candidate scan needs
+FORK_META = {"content": 0, "changes": 0, "validation": 0}
+
+gc_forks = registry.counter("fork_gc_forks_total", "Forks removed by fork GC, by action.", ("action",))
+gc_reclaimed = registry.counter(
+    "fork_gc_reclaimed_bytes_total", "Bytes of fork and PR documents removed by fork GC, net of archives."
+)
+
+# Serializes runs and purges within a process
+_run_lock = threading.Lock()
+
+
+class GCReport:
+    def __init__(self, kind, dry_run=False):
+        self.kind = kind
+        self.dry_run = dry_run
+        self.started_at = datetime.utcnow()
+        self._started = time.perf_counter()
+        self.scanned = 0
+        self.actions = {"dropped": 0, "archived": 0}
+        self.prs_removed = 0
+        self.pins_released = 0
+        self.bytes_removed = 0
+        self.archive_bytes = 0
+        self.candidates = []  # Dry runs list what they would remove
+        self.errors = []
+
+    def removed(self, doc, action, archive_bytes=0):
+        size = len(bson.encode(doc))
+        self.actions[action] += 1
+        self.bytes_removed += size
+        self.archive_bytes += archive_bytes
+        if not self.dry_run:
+            gc_forks.inc(action=action)
+            gc_reclaimed.inc(max(0, size - archive_bytes))
+
+    def result(self):
+        report = {
+            "kind": self.kind,
+            "dry_run": self.dry_run,
+            "started_at": self.started_at,
+            "duration_ms": round((time.perf_counter() - self._started) * 1000, 1),
+            "forks_scanned": self.scanned,
+            "forks_dropped": self.actions["dropped"],
+            "forks_archived": self.actions["archived"],
+            "prs_removed": self.prs_removed,
+            "pins_released": self.pins_released,
+            "bytes_removed": self.bytes_removed,
+            "archive_bytes": self.archive_bytes,
+            "bytes_reclaimed": self.bytes_removed - self.archive_bytes,
+            "errors": self.errors[:100],
+        }
+        if self.dry_run:
+            report["candidates"] = self.candidates[:1000]
+        return report
+
+
+def _version_query(fork):
+    """Matches the fork only while it is unchanged (legacy forks are versioned by updated_at)."""
+    if fork.get("revision"):
+        return {"_id": fork["_id"], "revision": fork["revision"]}
+    return {"_id": fork["_id"], "updated_at": fork.get("updated_at")}
+
+
+def _closed_at(pr):
+    # PRs closed before closed_at was recorded fall back to their creation time
+    return pr.get("closed_at") or pr.get("created_at")
+
+
+def _reason(fork, prs, merged_cutoff, stale_cutoff):
+    """Why a fork can be collected ("merged" / "stale"), or None to keep it."""
+    if any(pr["status"] == "open" for pr in prs):
+        return None
+    # Only sees this worker's saves; a save on another worker that finds the
+    # fork deleted recreates it with a fresh base (see utils/write_behind.py)
+    if fork_buffer.has_pending(fork["username"], fork["original_path"]):
+        return None
+    updated_at = fork.get("updated_at")
+    closed = [pr for pr in prs if _closed_at(pr) is not None]
+    if closed:
+        last = max(closed, key=_closed_at)
+        closed_at = _closed_at(last)
+        if last["status"] == "merged" and closed_at < merged_cutoff and updated_at <= closed_at:
+            return "merged"
+    if updated_at < stale_cutoff:
+        return "stale"
+    return None
+
+
+def _same_as_main(content, file_path):
+    view = open_dataset(file_path)
+    if view is None or len(view) != len(content):
+        return False
+    return all(view.same_as(i, item) for i, item in enumerate(content))
+
+
+def _release_bases(blobs, report):
+    report.pins_released += release_blobs(blobs)
+
+
+def _collect_fork(meta, reason, prs, base_dir, report):
+    fork = user_datasets_collection.find_one(_version_query(meta))
+    if fork is None:
+        return  # Saved since the scan
+    path = fork["original_path"]
+    action = "dropped" if _same_as_main(fork["content"], base_dir / path) else "archived"
+    if report.dry_run:
+        report.removed(fork, action)
+        report.candidates.append({"username": fork["username"], "dataset_path": path,
+                                  "reason": reason, "action": action})
+        return
+
+    archive_id = None
+    archive_bytes = 0
+    if action == "archived":
+        content_gz = gzip.compress(json.dumps(fork["content"], ensure_ascii=False).encode("utf-8"))
+        archive_bytes = len(content_gz)
+        archive_id = fork_archive_collection.insert_one({
+            "username": fork["username"],
+            "original_path": path,
+            "reason": reason,
+            "revision": fork.get("revision"),
+            "updated_at": fork.get("updated_at"),
+            "base_commit": fork.get("base_commit"),
+            "pr_ids": [pr["_id"] for pr in prs],
+            "items": len(fork["content"]),
+            "content_gz": bson.Binary(content_gz),
+            "archived_at": datetime.utcnow(),
+        }).inserted_id
+    if user_datasets_collection.delete_one(_version_query(fork)).deleted_count == 0:
+        if archive_id is not None:
+            fork_archive_collection.delete_one({"_id": archive_id})
+        return
+    report.removed(fork, action, archive_bytes)
+    _release_bases(fork.get("base_blobs", []), report)
+
+
+def collect(base_dir, dry_run=False, now=None):
+    """
+    One GC pass over all forks. `base_dir` is where main datasets live.
+    With `dry_run`, reports what would be removed without changing anything.
+    """
+    now = now or datetime.utcnow()
+    merged_cutoff = now - timedelta(days=FORK_GC_MERGED_DAYS)
+    stale_cutoff = now - timedelta(days=FORK_GC_STALE_DAYS)
+    report = GCReport("collect", dry_run)
+    if not dry_run:
+        drain_purges()
+    with _run_lock, span("fork_gc.collect", dry_run=dry_run):
+        last_id = None
+        while True:
+            query = {"updated_at": {"$lt": max(merged_cutoff, stale_cutoff)}}
+            if last_id is not None:
+                query["_id"] = {"$gt": last_id}
+            batch = list(user_datasets_collection.find(query, FORK_META).sort("_id", 1).limit(FORK_GC_BATCH_SIZE))
+            if not batch:
+                break
+            last_id = batch[-1]["_id"]
+            report.scanned += len(batch)
+
+            prs_by_fork = {}
+            for pr in pull_requests_collection.find(
+                {"username": {"$in": list({fork["username"] for fork in batch})}},
+                {"username": 1, "dataset_path": 1, "status": 1, "created_at": 1, "closed_at": 1}
+            ):
+                prs_by_fork.setdefault((pr["username"], pr["dataset_path"]), []).append(pr)
+
+            for meta in batch:
+                prs = prs_by_fork.get((meta["username"], meta["original_path"]), [])
+                reason = _reason(meta, prs, merged_cutoff, stale_cutoff)
+                if reason is None:
+                    continue
+                try:
+                    _collect_fork(meta, reason, prs, base_dir, report)
+                except Exception as e:
+                    report.errors.append(f"{meta['username']}/{meta['original_path']}: {e}")
+            time.sleep(BATCH_PAUSE_SECONDS)
+
+        result = report.result()
+        if not dry_run and FORK_GC_COMPACT and result["forks_dropped"] + result["forks_archived"]:
+            try:
+                get_db().command("compact", "user_datasets")
+                result["compacted"] = True
+            except PyMongoError as e:
+                result["compacted"] = False
+                result["errors"].append(f"compact: {e}")
+    if not dry_run:
+        _store(result)
+    return result
+
+
+def purge_users(usernames):
+    """Remove everything deleted users leave behind: forks, archived forks, pull requests and contributions."""
+    report = GCReport("user_purge")
+    with _run_lock, span("fork_gc.purge_users", users=len(usernames)):
+        blobs = []
+        for username in usernames:
+            fork_buffer.discard_user(username)
+            for fork in user_datasets_collection.find({"username": username}):
+                blobs.extend(fork.get("base_blobs", []))
+                report.scanned += 1
+                if user_datasets_collection.delete_one({"_id": fork["_id"]}).deleted_count:
+                    report.removed(fork, "dropped")
+            for archived in fork_archive_collection.find({"username": username}, {"_id": 1, "content_gz": 1}):
+                report.bytes_removed += len(bson.encode(archived))
+            fork_archive_collection.delete_many({"username": username})
+            for pr in pull_requests_collection.find({"username": username}):
+                report.bytes_removed += len(bson.encode(pr))
+            report.prs_removed += pull_requests_collection.delete_many({"username": username}).deleted_count
+            leaderboard.forget(username)
+        _release_bases(blobs, report)
+        result = report.result()
+        result["usernames"] = list(usernames)[:100]
+    _store(result)
+    return result
+
+
+def record_purges(usernames):
+    """Record deleted users whose leftovers must be purged."""
+    now = datetime.utcnow()
+    try:
+        deleted_users_collection.insert_many(
+            [{"_id": username, "deleted_at": now, "claimed_until": None} for username in usernames], ordered=False
+        )
+    except BulkWriteError as e:
+        # Users already waiting for a purge keep their entry
+        if any(err.get("code") != 11000 for err in e.details.get("writeErrors", [])):
+            raise
+
+
+def _claim_purges(limit):
+    """Usernames of recorded purges nobody is working on, claimed for PURGE_LEASE_MINUTES."""
+    now = datetime.utcnow()
+    usernames = []
+    while len(usernames) < limit:
+        entry = deleted_users_collection.find_one_and_update(
+            {"$or": [{"claimed_until": None}, {"claimed_until": {"$lt": now}}]},
+            {"$set": {"claimed_until": now + timedelta(minutes=PURGE_LEASE_MINUTES)}},
+            sort=[("deleted_at", 1)],
+        )
+        if entry is None:
+            break
+        usernames.append(entry["_id"])
+    return usernames
+
+
+def drain_purges():
+    """Purge every recorded deleted user that no worker has claimed. Returns how many were purged."""
+    purged = 0
+    while True:
+        usernames = _claim_purges(FORK_GC_BATCH_SIZE)
+        if not usernames:
+            return purged
+        purge_users(usernames)
+        deleted_users_collection.delete_many({"_id": {"$in": usernames}})
+        purged += len(usernames)
+
+
+def pending_purges():
+    return deleted_users_collection.count_documents({})
+
+
+def _store(result):
+    summary = ", ".join(f"{key} {result[key]}" for key in
+                        ("forks_dropped", "forks_archived", "prs_removed", "pins_released", "bytes_reclaimed"))
+    print(f"Fork GC ({result['kind']}) took {result['duration_ms']:.0f}ms: {summary}")
+    try:
+        gc_runs_collection.insert_one(dict(result))
+    except PyMongoError as e:
+        print(f"Failed to store fork GC report: {e}")
+
+
+class ForkCollector:
+    """Runs scheduled collections and recorded user purges on one background thread."""
+
+    def __init__(self, interval_hours=FORK_GC_INTERVAL_HOURS):
+        self.interval_hours = interval_hours
+        self.base_dir = None
+        self._wake = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self, base_dir):
+        """
+        Start scheduled runs over the datasets in `base_dir`, and the purges
+        left over from before a restart. Safe to call in every worker.
+        """
+        self.base_dir = base_dir
+        self._ensure_started()
+
+    def purge_users(self, usernames):
+        """Record the cleanup of deleted users; it runs in the background."""
+        if usernames:
+            record_purges(usernames)
+            self._wake.set()
+            self._ensure_started()
+
+    def pending_count(self):
+        return pending_purges()
+
+    def _claim_run(self, now):
+        """Take the next scheduled run, unless another worker already has it."""
+        try:
+            scheduled_jobs_collection.find_one_and_update(
+                {"_id": "fork_gc", "next_run": {"$lte": now}},
+                {"$set": {"next_run": now + timedelta(hours=self.interval_hours)}},
+                upsert=True,
+            )
+            return True
+        except DuplicateKeyError:
+            return False  # Not due yet
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="fork-gc", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        # Check often enough that one worker picks a run (or an abandoned purge) up soon after it is due
+        check_every = min(self.interval_hours * 3600, 3600) if self.interval_hours > 0 else 3600
+        next_check = time.monotonic()
+        while True:
+            woken = self._wake.wait(max(0.0, next_check - time.monotonic()))
+            self._wake.clear()
+            try:
+                drain_purges()
+                if not woken and self.interval_hours > 0 and self.base_dir is not None \
+                        and self._claim_run(datetime.utcnow()):
+                    collect(self.base_dir)
+            except Exception as e:
+                print(f"Fork GC failed: {e}")
+            if time.monotonic() >= next_check:
+                next_check = time.monotonic() + check_every
+
+
+collector = ForkCollector()
+
+registry.gauge(
+    "fork_gc_purges_pending", "Deleted users whose forks and PRs are waiting for cleanup.",
+    callback=lambda: collector.pending_count(),
+)
@@ -1,11 +1,34 @@
 import subprocess
-import os
-from pathlib import Path
+import threading
+import time
+from settings import get_settings
+from utils.metrics import git_command_duration
+from utils.tracing import span
+from utils.locks import git_lock
 
-DATASET_DIR = Path(__file__).parent.parent.parent / "dataset"
+settings = get_settings()
+DATASET_DIR = settings.dataset_repo_dir
+
+# "fast": one fetch of main only, then fast-forward (see git_sync_fast)
+# "full": the original fetch + pull + checkout fallback
+GIT_SYNC_MODE = settings.git_sync_mode
+# History depth for the first fetch into an empty repo, and for every fetch
+# into a repo that is already shallow. 0 fetches full history.
+GIT_FETCH_DEPTH = settings.git_fetch_depth
+# Optional partial clone filter, e.g. "blob:none" (blobs are then fetched on demand)
+GIT_FETCH_FILTER = settings.git_fetch_filter
+# Hours between background `git maintenance` runs; 0 disables them
+GIT_MAINTENANCE_INTERVAL_HOURS = settings.git_maintenance_interval_hours
+
+# Called with the repo-relative paths that changed after a sync
+_change_listeners = []
 
 def run_git_command(args, cwd=DATASET_DIR):
-    """Run a git command in the dataset directory."""
+    """Run a git command in the dataset directory, holding the cross-process git lock."""
+    with git_lock():
+        return _run_git_command(args, cwd)
+
+def _run_git_command(args, cwd):
     if not DATASET_DIR.exists():
         DATASET_DIR.mkdir(parents=True, exist_ok=True)
     
@@ -16,28 +39,50 @@ def run_git_command(args, cwd=DATASET_DIR):
         subprocess.run(["git", "config", "user.email", "admin@polythink.studio"], cwd=str(cwd), check=True, capture_output=True)
         subprocess.run(["git", "config", "user.name", "PolyThink Admin"], cwd=str(cwd), check=True, capture_output=True)
 
+    started = time.perf_counter()
+    outcome = "ok"
     try:
-        result = subprocess.run(
-            ["git"] + args,
-            cwd=str(cwd),
-            capture_output=True,
-            text=True,
-            check=True
-        )
+        with span(f"git {args[0] if args else ''}", args=" ".join(args)):
+            result = subprocess.run(
+                ["git"] + args,
+                cwd=str(cwd),
+                capture_output=True,
+                text=True,
+                check=True
+            )
         return result.stdout.strip()
     except subprocess.CalledProcessError as e:
+        outcome = "error"
         raise Exception(f"Git command failed: {e.stderr}")
+    finally:
+        git_command_duration.observe(time.perf_counter() - started, command=args[0] if args else "", outcome=outcome)
 
 def init_repo_if_needed():
-    """Initialize git repo if .git doesn't exist."""
-    if not (DATASET_DIR / ".git").exists():
-        run_git_command(["init"])
-        # Configure user for commits
-        run_git_command(["config", "user.email", "admin@polythink.studio"])
-        run_git_command(["config", "user.name", "PolyThink Admin"])
-        return "Initialized new git repository"
+    """Initialize git repo if .git doesn't exist. Safe to call from every worker at startup."""
+    with git_lock():
+        if not (DATASET_DIR / ".git").exists():
+            run_git_command(["init"])
+            # Configure user for commits
+            run_git_command(["config", "user.email", "admin@polythink.studio"])
+            run_git_command(["config", "user.name", "PolyThink Admin"])
+            return "Initialized new git repository"
     return "Repository already initialized"
 
+def exclude_paths(patterns):
+    """Keep untracked files matching `patterns` out of `git add .`, without touching .gitignore."""
+    exclude = DATASET_DIR / ".git" / "info" / "exclude"
+    with git_lock():
+        if not (DATASET_DIR / ".git").exists():
+            return
+        existing = exclude.read_text().splitlines() if exclude.exists() else []
+        missing = [pattern for pattern in patterns if pattern not in existing]
+        if missing:
+            exclude.parent.mkdir(parents=True, exist_ok=True)
+            with open(exclude, "a") as f:
+                if existing and existing[-1]:
+                    f.write("\n")
+                f.write("".join(f"{pattern}\n" for pattern in missing))
+
 def get_remote_url():
     """Get the 'origin' remote URL."""
     try:
@@ -47,6 +92,10 @@ def get_remote_url():
 
 def set_remote_url(url):
     """Set the 'origin' remote URL."""
+    with git_lock():
+        _set_remote_url(url)
+
+def _set_remote_url(url):
     try:
         run_git_command(["remote", "get-url", "origin"])
         # Remote exists, set-url
@@ -57,6 +106,10 @@ def set_remote_url(url):
 
 def git_pull():
     """Pull from origin main."""
+    with git_lock():
+        return _git_pull()
+
+def _git_pull():
     # Fetch first
     run_git_command(["fetch", "origin"])
     # Reset hard to origin/main to force sync (be careful!)
@@ -79,6 +132,10 @@ def git_pull():
 
 def git_push():
     """Commit all changes and push to origin main."""
+    with git_lock():
+        return _git_push()
+
+def _git_push():
     run_git_command(["add", "."])
     
     status = run_git_command(["status", "--porcelain"])
@@ -103,3 +160,205 @@ def git_push():
 def git_status():
     """Get status."""
     return run_git_command(["status", "-s"])
+
+def on_files_changed(listener):
+    """Register `listener(paths)` to be called with repo-relative paths changed by a sync."""
+    _change_listeners.append(listener)
+    return listener
+
+def _notify_changed(paths):
+    for listener in _change_listeners:
+        try:
+            listener(paths)
+        except Exception as e:
+            print(f"Change listener {listener.__name__} failed: {e}")
+
+def _rev_parse(ref):
+    try:
+        return run_git_command(["rev-parse", "--verify", "--quiet", f"{ref}^{{commit}}"])
+    except Exception:
+        return None
+
+def git_sync(mode=None):
+    """Sync with origin main using GIT_SYNC_MODE (or `mode`). Returns {"output", "changed_files"}."""
+    mode = mode or GIT_SYNC_MODE
+    if mode == "full":
+        with git_lock():
+            before = _rev_parse("HEAD")
+            output = _git_pull()
+            after = _rev_parse("HEAD")
+            changed = _changed_files(before, after)
+        _notify_changed(changed)
+        return {"output": output, "changed_files": changed}
+    return git_sync_fast()
+
+def git_sync_fast():
+    """
+    Fetch only origin/main, in a single request and (for new or shallow repos)
+    only GIT_FETCH_DEPTH commits deep, then fast-forward. Never rewrites local
+    commits: if main has diverged from origin the sync fails and nothing changes.
+    """
+    with git_lock():
+        head = _rev_parse("HEAD")
+        tracked = _rev_parse("refs/remotes/origin/main")
+
+        fetch = ["fetch", "--no-tags", "--prune"]
+        shallow = (DATASET_DIR / ".git" / "shallow").exists()
+        if GIT_FETCH_DEPTH > 0 and (head is None or shallow):
+            fetch.append(f"--depth={GIT_FETCH_DEPTH}")
+        if GIT_FETCH_FILTER:
+            fetch.append(f"--filter={GIT_FETCH_FILTER}")
+        fetch += ["origin", "+refs/heads/main:refs/remotes/origin/main"]
+        output = [run_git_command(fetch)]
+        remote = _rev_parse("refs/remotes/origin/main")
+        if remote is None:
+            raise Exception("origin has no main branch")
+
+        if head is None:
+            # Empty repo: check out what we fetched
+            output.append(run_git_command(["checkout", "-B", "main", "refs/remotes/origin/main"]))
+        elif head == remote:
+            output.append("Already up to date.")
+        elif head == tracked:
+            # No local commits since the last sync, so moving main to the new
+            # tip is a fast-forward even if shallow history can't prove it.
+            # --keep refuses to clobber uncommitted edits to changed files.
+            output.append(run_git_command(["reset", "--keep", "refs/remotes/origin/main"]))
+        else:
+            try:
+                output.append(run_git_command(["merge", "--ff-only", "refs/remotes/origin/main"]))
+            except Exception as e:
+                raise Exception(f"Local main has diverged from origin/main; push or resolve it first. {e}")
+
+        changed = _changed_files(head, remote)
+    _notify_changed(changed)
+    return {"output": "\n".join(o for o in output if o), "changed_files": changed}
+
+def _changed_files(before, after):
+    """Repo-relative paths that differ between two commits (all files when `before` is None)."""
+    if after is None or before == after:
+        return []
+    if before is None:
+        listing = run_git_command(["ls-tree", "-r", "--name-only", "-z", after])
+    else:
+        # Comparing trees needs no history between the commits, so this works on shallow repos
+        listing = run_git_command(["diff", "--name-only", "--no-renames", "-z", before, after])
+    return [p for p in listing.split("\0") if p]
+
+def git_maintenance(force=False):
+    """
+    Keep the repo compact (commit-graph, loose objects, incremental repack).
+    Runs at most once per GIT_MAINTENANCE_INTERVAL_HOURS across all workers
+    unless forced. Returns the command output, or None if skipped.
+    """
+    marker = DATASET_DIR / ".git" / "polythink-maintenance"
+    with git_lock():
+        if not (DATASET_DIR / ".git").exists():
+            return None
+        if not force and marker.exists():
+            age_hours = (time.time() - marker.stat().st_mtime) / 3600
+            if age_hours < GIT_MAINTENANCE_INTERVAL_HOURS:
+                return None
+        try:
+            output = run_git_command(["maintenance", "run", "--task=commit-graph", "--task=loose-objects",
+                                      "--task=incremental-repack", "--task=pack-refs"])
+        except Exception:
+            # git < 2.30 has no maintenance command
+            output = run_git_command(["gc", "--auto"])
+        marker.touch()
+        return output
+
+def start_maintenance_scheduler():
+    """Background thread that calls git_maintenance() on schedule. Safe to start in every worker."""
+    if GIT_MAINTENANCE_INTERVAL_HOURS <= 0:
+        return None
+
+    def run():
+        while True:
+            try:
+                git_maintenance()
+            except Exception as e:
+                print(f"Git maintenance failed: {e}")
+            # Wake up often enough that one worker picks it up soon after it is due
+            time.sleep(min(GIT_MAINTENANCE_INTERVAL_HOURS * 3600, 3600))
+
+    thread = threading.Thread(target=run, name="git-maintenance", daemon=True)
+    thread.start()
+    return thread
+
+# --- Object access ---
+
+def hash_object(file_path):
+    """Store a file's current content in the object database and return its blob id."""
+    return run_git_command(["hash-object", "-w", "--", str(file_path)])
+
+def pin_object(object_id):
+    """Keep an object that no commit references (e.g. a fork's base) safe from gc."""
+    run_git_command(["update-ref", f"refs/polythink/pins/{object_id}", object_id])
+
+def unpin_object(object_id):
+    try:
+        run_git_command(["update-ref", "-d", f"refs/polythink/pins/{object_id}"])
+    except Exception:
+        pass
+
+def head_commit():
+    return _rev_parse("HEAD")
+
+class CatFileBatch:
+    """
+    One long-lived `git cat-file --batch` process for reading objects by id,
+    instead of spawning git per read. Requests are serialized; the process is
+    restarted if it dies.
+    """
+
+    def __init__(self, cwd=DATASET_DIR):
+        self.cwd = cwd
+        self._process = None
+        self._lock = threading.Lock()
+
+    def _ensure_process(self):
+        if self._process is None or self._process.poll() is not None:
+            self._process = subprocess.Popen(
+                ["git", "cat-file", "--batch"], cwd=str(self.cwd),
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+            )
+        return self._process
+
+    def read(self, object_id: str) -> bytes:
+        """Raw content of an object. Raises KeyError if it doesn't exist."""
+        started = time.perf_counter()
+        outcome = "ok"
+        try:
+            with self._lock, span("git cat-file", object=object_id):
+                process = self._ensure_process()
+                try:
+                    process.stdin.write(object_id.encode("ascii") + b"\n")
+                    process.stdin.flush()
+                    header = process.stdout.readline().decode("ascii").split()
+                    if len(header) != 3:
+                        # "<id> missing" (or the process died)
+                        raise KeyError(object_id)
+                    size = int(header[2])
+                    data = process.stdout.read(size)
+                    process.stdout.read(1)  # trailing newline
+                    return data
+                except (BrokenPipeError, ValueError):
+                    self.close()
+                    raise
+        except BaseException:
+            outcome = "error"
+            raise
+        finally:
+            git_command_duration.observe(time.perf_counter() - started, command="cat-file", outcome=outcome)
+
+    def close(self):
+        if self._process is not None:
+            try:
+                self._process.stdin.close()
+            except Exception:
+                pass
+            self._process.wait(timeout=5)
+            self._process = None
+
+cat_file = CatFileBatch()
@@ -0,0 +1,77 @@
+import hashlib
+import threading
+from pathlib import Path
+from fastapi import Request, Response
+from utils import sidecar
+
+# path -> (mtime_ns, size, content hash). Hashing only happens when a file changes.
+_revisions = {}
+_revisions_lock = threading.Lock()
+
+
+def file_revision(file_path: Path) -> str:
+    """Content hash of a dataset file, or "missing". Cached per (mtime, size)."""
+    try:
+        stat = file_path.stat()
+    except FileNotFoundError:
+        return "missing"
+
+    key = str(file_path)
+    with _revisions_lock:
+        cached = _revisions.get(key)
+    if cached and cached[0] == stat.st_mtime_ns and cached[1] == stat.st_size:
+        return cached[2]
+
+    # A fresh sidecar already carries the source hash, shared across workers
+    reader = sidecar.open_sidecar(file_path, stat)
+    if reader is not None:
+        with _revisions_lock:
+            _revisions[key] = (stat.st_mtime_ns, stat.st_size, reader.source_sha1)
+        return reader.source_sha1
+
+    digest = hashlib.sha1()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    revision = digest.hexdigest()
+    with _revisions_lock:
+        _revisions[key] = (stat.st_mtime_ns, stat.st_size, revision)
+    return revision
+
+
+def forget_revision(file_path: Path):
+    with _revisions_lock:
+        _revisions.pop(str(file_path), None)
+
+
+def make_etag(*parts) -> str:
+    """
+    ETag from the revision identifiers a response is derived from. Weak, since
+    the same one tags the gzip-compressed and the identity body.
+    """
+    digest = hashlib.sha1("\x1f".join(str(p) for p in parts).encode('utf-8')).hexdigest()
+    return f'W/"{digest[:32]}"'
+
+
+def is_not_modified(request: Request, etag: str) -> bool:
+    header = request.headers.get("If-None-Match")
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    # If-None-Match uses weak comparison, so ignore any W/ prefix
+    candidates = {tag.strip().removeprefix("W/") for tag in header.split(",")}
+    return etag.removeprefix("W/") in candidates
+
+
+def cache_headers(etag: str) -> dict:
+    # Private (responses depend on the user) and always revalidated
+    return {"ETag": etag, "Cache-Control": "private, no-cache"}
+
+
+def not_modified(etag: str) -> Response:
+    return Response(status_code=304, headers=cache_headers(etag))
+
+
+def set_cache_headers(response: Response, etag: str):
+    response.headers.update(cache_headers(etag))
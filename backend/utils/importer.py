@@ -0,0 +1,219 @@
+"""
+Incremental parsing and normalization of uploaded datasets.
+
+Accepts a JSON array of items, JSON Lines (or any sequence of concatenated
+JSON values), either optionally gzip-compressed; see iter_values for how
+the two are told apart. Input is read in fixed-size
+chunks and items are yielded one at a time, so memory stays bounded by the
+chunk size plus the largest item, whatever the upload's size.
+
+Items are normalized to the editor's shape, {"messages": [{"role", "content",
+"thinking"}]}. Also accepted: a bare list of messages, ShareGPT style
+{"conversations": [{"from", "value"}]}, and "reasoning" / "reasoning_content"
+in place of "thinking".
+"""
+import codecs
+import gzip
+import json
+from utils import validation
+
+CHUNK_CHARS = 1024 * 1024
+GZIP_MAGIC = b"\x1f\x8b"
+
+ROLE_ALIASES = {"human": "user", "gpt": "assistant", "model": "assistant", "bot": "assistant"}
+
+
+class ImportFormatError(ValueError):
+    """The upload can't be parsed; the message says where."""
+
+
+def open_upload(binary):
+    """Text stream over an uploaded file object, transparently gunzipping it."""
+    head = binary.read(2)
+    binary.seek(0)
+    if head == GZIP_MAGIC:
+        binary = gzip.GzipFile(fileobj=binary, mode="rb")
+    return codecs.getreader("utf-8-sig")(binary)
+
+
+def iter_values(stream, chunk_chars=CHUNK_CHARS, max_item_chars=None, format="auto"):
+    """
+    Yield the items of a JSON array, or the top-level values of JSON Lines /
+    concatenated JSON, from a text stream. `format` is "json", "jsonl" or
+    "auto": input starting with '[' is then JSON Lines if its first value
+    is followed by a newline and another value (lines that are bare message
+    lists), and an array otherwise.
+    """
+    if format not in ("auto", "json", "jsonl"):
+        raise ValueError(f"Unknown import format: {format}")
+    max_item_chars = max_item_chars or validation.MAX_ITEM_BYTES
+    decoder = json.JSONDecoder()
+    buf, pos, eof, consumed = "", 0, False, 0
+
+    def fill():
+        nonlocal buf, pos, eof, consumed
+        data = stream.read(chunk_chars)
+        if not data:
+            eof = True
+        consumed += pos
+        buf, pos = buf[pos:] + data, 0
+
+    def peek():
+        """Next non-whitespace character, or "" at the end of input."""
+        nonlocal pos
+        while True:
+            while pos < len(buf) and buf[pos] in " \t\r\n":
+                pos += 1
+            if pos < len(buf) or eof:
+                return buf[pos] if pos < len(buf) else ""
+            fill()
+
+    def error(message):
+        return ImportFormatError(f"{message} at character {consumed + pos}")
+
+    def first_value_is_a_line():
+        """Whether the value at pos is followed by a newline and another value. Doesn't move pos."""
+        end = None
+        while end is None:
+            try:
+                _, end = decoder.raw_decode(buf, pos)
+                if end == len(buf) and not eof:
+                    end = None  # may continue in the next chunk
+            except json.JSONDecodeError:
+                if eof:
+                    return False
+            if end is None:
+                if len(buf) - pos > max_item_chars:
+                    return False  # too large for one line: the whole input is an array
+                fill()
+        end -= pos  # fill() moves the buffer, so keep offsets relative to pos
+        newline = False
+        while True:
+            while pos + end < len(buf) and buf[pos + end] in " \t\r\n":
+                newline = newline or buf[pos + end] == "\n"
+                end += 1
+            if pos + end < len(buf):
+                return newline
+            if eof:
+                return False
+            fill()
+
+    array = peek() == "[" and (format == "json" or (format == "auto" and not first_value_is_a_line()))
+    if array:
+        pos += 1
+    need_comma = False
+    while True:
+        char = peek()
+        if array:
+            if char == "]":
+                pos += 1
+                if peek():
+                    raise error("Unexpected data after the closing bracket")
+                return
+            if need_comma:
+                if char != ",":
+                    raise error("Expected ',' or ']'")
+                pos += 1
+                need_comma = False
+                char = peek()
+        if char == "":
+            if array:
+                raise error("Unexpected end of input, missing ']'")
+            return
+        try:
+            value, end = decoder.raw_decode(buf, pos)
+            # A value ending exactly at the buffer's end may continue in the next chunk
+            complete = end < len(buf) or eof
+        except json.JSONDecodeError as e:
+            if eof:
+                raise error(f"Invalid JSON ({e.msg})")
+            complete = False
+        if not complete:
+            if len(buf) - pos > max_item_chars:
+                raise error(f"Item larger than {max_item_chars} characters, or malformed")
+            fill()
+            continue
+        pos = end
+        need_comma = array
+        yield value
+
+
+def _message(message):
+    if not isinstance(message, dict):
+        return message  # Left for validation to report
+    role = message.get("role", message.get("from"))
+    role = ROLE_ALIASES.get(role, role)
+    content = message.get("content", message.get("value"))
+    thinking = message.get("thinking", message.get("reasoning", message.get("reasoning_content")))
+    if isinstance(thinking, str) and not thinking.strip():
+        thinking = None
+    return {"role": role, "content": content, "thinking": thinking}
+
+
+def normalize_item(value):
+    """An item in the editor's shape; values that can't be mapped are returned as is."""
+    if isinstance(value, list):
+        messages = value
+    elif isinstance(value, dict) and isinstance(value.get("messages"), list):
+        messages = value["messages"]
+    elif isinstance(value, dict) and isinstance(value.get("conversations"), list):
+        messages = value["conversations"]
+    else:
+        return value
+    return {"messages": [_message(m) for m in messages]}
+
+
+class ImportStats:
+    def __init__(self):
+        self.read = 0
+        self.imported = 0
+        self.violations = []
+        self.counts = {}
+        self.skipped = 0
+        # Items dropped with on_invalid="skip", by position in the upload
+        self.skipped_items = []
+
+    def add(self, violations):
+        for v in violations:
+            self.counts[v["code"]] = self.counts.get(v["code"], 0) + 1
+        room = validation.MAX_REPORTED - len(self.violations)
+        if room > 0:
+            self.violations.extend(violations[:room])
+
+    def report(self):
+        return {
+            "items_read": self.read,
+            "items": self.imported,
+            "skipped": self.skipped,
+            "skipped_items": self.skipped_items,
+            "violations": self.violations,
+            "counts": self.counts,
+            "truncated": sum(self.counts.values()) > len(self.violations),
+        }
+
+
+def import_items(values, turn_type, on_invalid, stats):
+    """
+    Normalize and validate parsed values, yielding the items to store.
+    on_invalid: "reject" raises on the first item with errors, "skip" drops
+    such items, "keep" stores them anyway. Violations are recorded in `stats`
+    by their position in the imported dataset.
+    """
+    for value in values:
+        item = normalize_item(value)
+        violations = validation.validate_item(item, stats.imported, turn_type)
+        stats.read += 1
+        if validation.has_errors(violations):
+            if on_invalid == "reject":
+                first = next(v for v in violations if v["severity"] == "error")
+                where = f" ({first['path']})" if first["path"] else ""
+                raise ImportFormatError(f"Item {stats.read - 1} is invalid{where}: {first['message']}")
+            if on_invalid == "skip":
+                stats.skipped += 1
+                if len(stats.skipped_items) < validation.MAX_REPORTED:
+                    stats.skipped_items.append({"upload_index": stats.read - 1,
+                                                "violations": [v for v in violations if v["severity"] == "error"]})
+                continue
+        stats.add(violations)
+        stats.imported += 1
+        yield item
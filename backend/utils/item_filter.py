@@ -0,0 +1,421 @@
+"""
+Filter expressions over dataset items.
+
+Filters are evaluated against per-dataset columns, one value per item:
+
+    messages                      number of messages
+    turns                         number of user messages
+    chars, thinking_chars         total content / thinking length
+    first_role, last_role         role of the first / last message
+    <role>.count                  messages of that role (system, user, assistant)
+    <role>.chars, <role>.max_chars
+    <role>.thinking_chars, <role>.max_thinking_chars
+    field.<name>                  a top-level scalar field of the items, e.g. field.source
+
+An expression compares columns with values and combines the comparisons:
+
+    assistant.max_thinking_chars > 4000
+    turns > 6 and not first_role == "system"
+    (field.source contains "wiki" or field.lang == "vi") and chars <= 20000
+
+Operators are ==, !=, <, <=, >, >= and `contains` (strings). A comparison is
+evaluated over a whole column at once with numpy, so a filter costs a few
+array operations however many items match.
+
+Columns are built in one pass over the dataset (decoding each item once
+from its sidecar) and cached per dataset revision, in memory and as an .npz
+file next to the sidecars, so other workers and restarts reuse them.
+String fields longer than MAX_STRING_CHARS somewhere in the dataset are
+left out of the columns.
+"""
+import re
+import threading
+from collections import OrderedDict
+import numpy as np
+from settings import get_settings
+from utils import sidecar
+from utils.dataset_io import dataset_revision, open_dataset
+from utils.metrics import dataset_parse_duration
+from utils.tracing import span
+
+COLUMN_CACHE_DATASETS = get_settings().column_cache_datasets
+ROLES = ("system", "user", "assistant")
+MAX_FIELDS = 32
+MAX_STRING_CHARS = 256
+PREVIEW_CHARS = 200
+
+# Stored with the columns; a cache file of another format or revision is rebuilt
+FORMAT = "polythink-columns-1"
+
+
+class FilterError(ValueError):
+    """An expression that can't be parsed or doesn't fit the dataset's columns."""
+
+
+# --- Columns ---
+
+NUMERIC_COLUMNS = ("messages", "turns", "chars", "thinking_chars") + tuple(
+    f"{role}.{stat}" for role in ROLES
+    for stat in ("count", "chars", "max_chars", "thinking_chars", "max_thinking_chars")
+)
+
+
+# Position of each role's (count, chars, max_chars, thinking_chars, max_thinking_chars) in NUMERIC_COLUMNS
+_ROLE_OFFSETS = {role: NUMERIC_COLUMNS.index(f"{role}.count") for role in ROLES}
+
+
+def _item_stats(item):
+    """Derived values of one item: (numeric values in NUMERIC_COLUMNS order, first role, last role)."""
+    stats = [0] * len(NUMERIC_COLUMNS)
+    messages = item.get("messages") if isinstance(item, dict) else None
+    if not isinstance(messages, list):
+        return stats, "", ""
+    stats[0] = len(messages)
+    first = last = None
+    for message in messages:
+        if not isinstance(message, dict):
+            continue
+        role = message.get("role")
+        if first is None:
+            first = role
+        last = role
+        content, thinking = message.get("content"), message.get("thinking")
+        chars = len(content) if isinstance(content, str) else 0
+        thinking = len(thinking) if isinstance(thinking, str) else 0
+        stats[2] += chars
+        stats[3] += thinking
+        offset = _ROLE_OFFSETS.get(role)
+        if offset is not None:
+            stats[offset] += 1
+            stats[offset + 1] += chars
+            if chars > stats[offset + 2]:
+                stats[offset + 2] = chars
+            stats[offset + 3] += thinking
+            if thinking > stats[offset + 4]:
+                stats[offset + 4] = thinking
+    stats[1] = stats[_ROLE_OFFSETS["user"]]  # turns
+    return stats, str(first or ""), str(last or "")
+
+
+def build_columns(items, count):
+    """Columns (name -> numpy array) of `count` items."""
+    rows = []
+    first_role = []
+    last_role = []
+    fields = {}  # name -> {index: value}
+    for i, item in enumerate(items):
+        values, first, last = _item_stats(item)
+        rows.append(values)
+        first_role.append(first)
+        last_role.append(last)
+        if not isinstance(item, dict):
+            continue
+        for name, value in item.items():
+            if name == "messages" or not isinstance(value, (str, int, float, bool)):
+                continue
+            if name not in fields:
+                if len(fields) >= MAX_FIELDS:
+                    continue
+                fields[name] = {}
+            fields[name][i] = value
+
+    table = np.array(rows, dtype=np.int64).reshape(count, len(NUMERIC_COLUMNS))
+    columns = {name: np.ascontiguousarray(table[:, j]) for j, name in enumerate(NUMERIC_COLUMNS)}
+    columns["first_role"] = np.array(first_role, dtype=str) if count else np.array([], dtype="<U1")
+    columns["last_role"] = np.array(last_role, dtype=str) if count else np.array([], dtype="<U1")
+    for name, values in fields.items():
+        if all(isinstance(v, (int, float)) for v in values.values()):
+            # Items without the field get NaN, which no comparison but != matches
+            column = np.full(count, np.nan)
+            column[list(values)] = list(values.values())
+        else:
+            strings = [str(v) for v in values.values()]
+            width = max(map(len, strings))
+            if width > MAX_STRING_CHARS:
+                continue
+            column = np.full(count, "", dtype=f"<U{max(1, width)}")
+            column[list(values)] = strings
+        columns[f"field.{name}"] = column
+    return columns
+
+
+def _cache_path(file_path):
+    return sidecar.sidecar_path(file_path).with_suffix(".cols.npz")
+
+
+def _load_cached(file_path, revision):
+    try:
+        with np.load(_cache_path(file_path), allow_pickle=False) as data:
+            if str(data["__format__"]) != FORMAT or str(data["__revision__"]) != revision:
+                return None
+            return {name: data[name] for name in data.files if not name.startswith("__")}
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def _store(file_path, revision, columns):
+    path = _cache_path(file_path)
+    tmp = path.with_name(f".tmp-{threading.get_ident()}-{path.name}")
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(tmp, "wb") as f:
+            np.savez(f, __format__=np.array(FORMAT), __revision__=np.array(revision), **columns)
+        tmp.replace(path)
+    except OSError as e:
+        # The cache file is only an accelerator
+        print(f"Failed to store columns of {file_path}: {e}")
+        tmp.unlink(missing_ok=True)
+
+
+class ColumnCache:
+    """Columns of the most recently queried datasets, keyed by (source, revision)."""
+
+    def __init__(self, size=COLUMN_CACHE_DATASETS):
+        self.size = size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get(self, key):
+        with self._lock:
+            columns = self._entries.get(key)
+            if columns is not None:
+                self._entries.move_to_end(key)
+            return columns
+
+    def _put(self, key, columns):
+        with self._lock:
+            # Older revisions of the same source are no use anymore
+            for stale in [k for k in self._entries if k[0] == key[0]]:
+                del self._entries[stale]
+            self._entries[key] = columns
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def for_dataset(self, file_path):
+        """(columns, view) of a main dataset, or (None, None) if it doesn't exist."""
+        view = open_dataset(file_path)
+        if view is None:
+            return None, None
+        revision = dataset_revision(file_path)
+        key = (str(file_path), revision)
+        columns = self._get(key)
+        if columns is None:
+            columns = _load_cached(file_path, revision)
+            if columns is None:
+                with span("columns.build", items=len(view)), dataset_parse_duration.time(operation="columns_build"):
+                    columns = build_columns(view, len(view))
+                _store(file_path, revision, columns)
+            self._put(key, columns)
+        return columns, view
+
+    def for_content(self, source, revision, content):
+        """Columns of in-memory items (a fork), cached under `source` and `revision`."""
+        key = (source, revision)
+        columns = self._get(key)
+        if columns is None:
+            with span("columns.build", items=len(content)):
+                columns = build_columns(content, len(content))
+            self._put(key, columns)
+        return columns
+
+
+cache = ColumnCache()
+
+
+# --- Expressions ---
+
+TOKEN = re.compile(r"""
+    \s*(?:
+        (?P<number>-?\d+(?:\.\d+)?(?:[eE][+-]?\d+)?)
+      | (?P<string>"(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*')
+      | (?P<op>==|!=|<=|>=|<|>)
+      | (?P<paren>[()])
+      | (?P<name>[A-Za-z_][\w.]*)
+    )""", re.VERBOSE)
+
+KEYWORDS = {"and", "or", "not", "contains", "true", "false"}
+
+
+def _tokenize(text):
+    tokens = []
+    position = 0
+    text = text.rstrip()
+    while position < len(text):
+        match = TOKEN.match(text, position)
+        if match is None or match.end() == position:
+            raise FilterError(f"Unexpected input at position {position}: {text[position:position + 20]!r}")
+        kind = match.lastgroup
+        value = match.group(kind)
+        if kind == "string":
+            value = re.sub(r"\\(.)", r"\1", value[1:-1])
+        elif kind == "number":
+            value = float(value) if any(c in value for c in ".eE") else int(value)
+        elif kind == "name" and value.lower() in KEYWORDS:
+            kind, value = "keyword", value.lower()
+        tokens.append((kind, value))
+        position = match.end()
+    return tokens
+
+
+class _Parser:
+    """
+    Recursive descent over:
+
+        expr       := term ("or" term)*
+        term       := factor ("and" factor)*
+        factor     := "not" factor | "(" expr ")" | comparison
+        comparison := NAME (OP | "contains") (NUMBER | STRING | "true" | "false")
+
+    producing nested tuples: ("or", a, b), ("and", a, b), ("not", a), ("cmp", name, op, value).
+    """
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.position = 0
+
+    def peek(self):
+        return self.tokens[self.position] if self.position < len(self.tokens) else (None, None)
+
+    def take(self, kind=None, value=None):
+        token = self.peek()
+        if token[0] is None or (kind and token[0] != kind) or (value and token[1] != value):
+            expected = value or kind or "more input"
+            found = "end of filter" if token[0] is None else repr(token[1])
+            raise FilterError(f"Expected {expected}, found {found}")
+        self.position += 1
+        return token
+
+    def parse(self):
+        tree = self.expr()
+        if self.position != len(self.tokens):
+            raise FilterError(f"Unexpected {self.peek()[1]!r}")
+        return tree
+
+    def expr(self):
+        tree = self.term()
+        while self.peek() == ("keyword", "or"):
+            self.take()
+            tree = ("or", tree, self.term())
+        return tree
+
+    def term(self):
+        tree = self.factor()
+        while self.peek() == ("keyword", "and"):
+            self.take()
+            tree = ("and", tree, self.factor())
+        return tree
+
+    def factor(self):
+        if self.peek() == ("keyword", "not"):
+            self.take()
+            return ("not", self.factor())
+        if self.peek() == ("paren", "("):
+            self.take()
+            tree = self.expr()
+            self.take("paren", ")")
+            return tree
+        _, name = self.take("name")
+        if self.peek() == ("keyword", "contains"):
+            op = self.take()[1]
+        else:
+            op = self.take("op")[1]
+        kind, value = self.take()
+        if kind == "keyword" and value in ("true", "false"):
+            value = value == "true"
+        elif kind not in ("number", "string"):
+            raise FilterError(f"Expected a number or string after {name} {op}, found {value!r}")
+        return ("cmp", name, op, value)
+
+
+def parse(text):
+    """Parse a filter expression; raises FilterError."""
+    tokens = _tokenize(text)
+    if not tokens:
+        return None
+    return _Parser(tokens).parse()
+
+
+def referenced_columns(tree):
+    if tree is None:
+        return []
+    if tree[0] == "cmp":
+        return [tree[1]]
+    return [name for child in tree[1:] for name in referenced_columns(child)]
+
+
+COMPARISONS = {
+    "==": np.equal, "!=": np.not_equal,
+    "<": np.less, "<=": np.less_equal, ">": np.greater, ">=": np.greater_equal,
+}
+
+
+def _compare(columns, name, op, value):
+    column = columns.get(name)
+    if column is None:
+        raise FilterError(f"Unknown column {name!r}. Columns: {', '.join(sorted(columns))}")
+    if column.dtype.kind == "U":
+        if not isinstance(value, str):
+            raise FilterError(f"{name} is a string column; compare it with a quoted string")
+        if op == "contains":
+            return np.char.find(column, value) >= 0
+        return COMPARISONS[op](column, value)
+    if isinstance(value, str):
+        raise FilterError(f"{name} is a numeric column; compare it with a number")
+    if op == "contains":
+        raise FilterError(f"contains only applies to string columns, not {name}")
+    return COMPARISONS[op](column, value)
+
+
+def evaluate(tree, columns, count):
+    """Boolean mask of the items matching a parsed expression."""
+    if tree is None:
+        return np.ones(count, dtype=bool)
+    kind = tree[0]
+    if kind == "cmp":
+        return _compare(columns, *tree[1:])
+    if kind == "not":
+        return ~evaluate(tree[1], columns, count)
+    left, right = evaluate(tree[1], columns, count), evaluate(tree[2], columns, count)
+    return left & right if kind == "and" else left | right
+
+
+# --- Queries ---
+
+def preview(item):
+    """A short summary of an item for result lists."""
+    messages = item.get("messages") if isinstance(item, dict) else None
+    messages = messages if isinstance(messages, list) else []
+    text = next((m.get("content") for m in messages
+                 if isinstance(m, dict) and m.get("role") == "user" and isinstance(m.get("content"), str)), "")
+    return {
+        "messages": len(messages),
+        "roles": [m.get("role") for m in messages[:8] if isinstance(m, dict)],
+        "text": text[:PREVIEW_CHARS] + ("…" if len(text) > PREVIEW_CHARS else ""),
+    }
+
+
+def _json_value(value):
+    value = value.item()
+    return None if isinstance(value, float) and np.isnan(value) else value
+
+
+def run_query(columns, items, expression, offset=0, limit=50):
+    """
+    Page of the items matching `expression`: their indices, a preview of each
+    and the values of the columns the expression uses. `items` only needs to
+    support indexing, and only the page's items are decoded.
+    """
+    tree = parse(expression)
+    count = len(items)
+    with span("filter.evaluate", items=count):
+        mask = evaluate(tree, columns, count)
+        matches = np.flatnonzero(mask)
+    page = matches[offset:offset + limit].tolist()
+    shown = list(dict.fromkeys(referenced_columns(tree)))
+    results = []
+    for index in page:
+        entry = {"index": index, **preview(items[index])}
+        if shown:
+            entry["values"] = {name: _json_value(columns[name][index]) for name in shown}
+        results.append(entry)
+    return {"total": len(matches), "items": count, "offset": offset, "limit": limit, "results": results}
@@ -0,0 +1,185 @@
+"""
+Contribution leaderboards.
+
+Every closed PR adds to its author's bucket for that day (UTC) in
+contribution_daily:
+
+    {username, day, accepted, rejected, merged_prs}
+
+and refreshes the author's row in contribution_windows, their totals over
+the last 7, 30 and 90 days:
+
+    {_id: username, as_of: day, d7: {accepted, rejected, merged_prs}, d30: {...}, d90: {...}}
+
+A leaderboard is one indexed sort of contribution_windows, so its cost
+depends on the number of rows returned, not on the number of users.
+Totals slide as days pass: a background thread in each worker rolls rows
+computed before today forward, from the buckets of the users who have a
+row (those active in the last 90 days), at startup and just after every
+UTC midnight. Reads never wait for it; until it is done they see the rows
+as of the previous day.
+
+Buckets of PRs closed before this existed are rebuilt once from
+pull_requests, in the background, the first time a worker starts.
+"""
+import threading
+import time
+from datetime import datetime, timedelta
+from pymongo.errors import DuplicateKeyError
+from database import (
+    contribution_daily_collection, contribution_windows_collection, pull_requests_collection,
+    scheduled_jobs_collection
+)
+from utils.tracing import span
+
+WINDOWS = (7, 30, 90)
+METRICS = ("accepted", "rejected", "merged_prs")
+
+_rolled_day = None  # Last day this process rolled rows forward
+_roll_lock = threading.Lock()
+# Delay after midnight (UTC) before rolling, so late PRs of the day are in
+ROLL_DELAY_SECONDS = 60
+
+
+def _day(at=None):
+    at = at or datetime.utcnow()
+    return datetime(at.year, at.month, at.day)
+
+
+def _totals(buckets, today):
+    totals = {f"d{window}": dict.fromkeys(METRICS, 0) for window in WINDOWS}
+    for bucket in buckets:
+        age = (today - bucket["day"]).days
+        for window in WINDOWS:
+            if 0 <= age < window:
+                for metric in METRICS:
+                    totals[f"d{window}"][metric] += bucket.get(metric, 0)
+    return totals
+
+
+def refresh(username, today=None):
+    """Recompute one user's window totals from their daily buckets."""
+    today = today or _day()
+    since = today - timedelta(days=max(WINDOWS) - 1)
+    buckets = contribution_daily_collection.find({"username": username, "day": {"$gte": since}})
+    totals = _totals(buckets, today)
+    if not any(any(values.values()) for values in totals.values()):
+        contribution_windows_collection.delete_one({"_id": username})
+        return
+    contribution_windows_collection.replace_one({"_id": username}, {"as_of": today, **totals}, upsert=True)
+
+
+def record(username, at=None, **counts):
+    """
+    Add `counts` (accepted / rejected / merged_prs) to the user's bucket for
+    the day of `at`. Best effort: a failure is logged, never raised, so it
+    can't fail the PR action that triggered it.
+    """
+    counts = {metric: n for metric, n in counts.items() if metric in METRICS and n}
+    if not counts:
+        return
+    try:
+        query = {"username": username, "day": _day(at)}
+        try:
+            contribution_daily_collection.update_one(query, {"$inc": counts}, upsert=True)
+        except DuplicateKeyError:
+            # Lost an upsert race on a new bucket; the bucket exists now
+            contribution_daily_collection.update_one(query, {"$inc": counts})
+        refresh(username)
+    except Exception as e:
+        print(f"Failed to record contributions of {username}: {e}")
+
+
+def roll_forward(today=None):
+    """Recompute rows last computed before today, so every window ends today."""
+    global _rolled_day
+    today = today or _day()
+    if _rolled_day == today:
+        return
+    with _roll_lock:
+        if _rolled_day == today:
+            return
+        with span("leaderboard.roll_forward"):
+            for row in contribution_windows_collection.find({"as_of": {"$lt": today}}, {"_id": 1}):
+                refresh(row["_id"], today)
+        _rolled_day = today
+
+
+def start_roller():
+    """Roll rows forward now and after every UTC midnight, on a background thread."""
+    def run():
+        while True:
+            try:
+                roll_forward()
+            except Exception as e:
+                print(f"Leaderboard roll forward failed: {e}")
+            now = datetime.utcnow()
+            next_day = _day(now) + timedelta(days=1, seconds=ROLL_DELAY_SECONDS)
+            time.sleep((next_day - now).total_seconds())
+
+    threading.Thread(target=run, name="leaderboard-roller", daemon=True).start()
+
+
+def top(window, metric, limit=20):
+    """The `limit` users with the highest `metric` over the last `window` days."""
+    key = f"d{window}"
+    field = f"{key}.{metric}"
+    rows = contribution_windows_collection.find({field: {"$gt": 0}}, {key: 1}) \
+        .sort([(field, -1), ("_id", 1)]).limit(limit)
+    return [{"rank": rank, "username": row["_id"], **row[key]} for rank, row in enumerate(rows, 1)]
+
+
+def totals_of(username, window):
+    row = contribution_windows_collection.find_one({"_id": username}, {f"d{window}": 1})
+    return row[f"d{window}"] if row else dict.fromkeys(METRICS, 0)
+
+
+def forget(username):
+    """Remove a deleted user from the leaderboards."""
+    contribution_daily_collection.delete_many({"username": username})
+    contribution_windows_collection.delete_one({"_id": username})
+
+
+def rebuild(today=None):
+    """Recompute the buckets of the last 90 days from closed PRs, and every user's totals."""
+    today = today or _day()
+    since = today - timedelta(days=max(WINDOWS) - 1)
+    buckets = {}
+    with span("leaderboard.rebuild"):
+        for pr in pull_requests_collection.find(
+            {"status": {"$in": ["merged", "rejected"]},
+             "$or": [{"closed_at": {"$gte": since}}, {"closed_at": None, "created_at": {"$gte": since}}]},
+            {"username": 1, "status": 1, "created_at": 1, "closed_at": 1, "accepted_count": 1, "rejected_count": 1}
+        ):
+            bucket = buckets.setdefault((pr["username"], _day(pr.get("closed_at") or pr["created_at"])),
+                                        dict.fromkeys(METRICS, 0))
+            bucket["accepted"] += pr.get("accepted_count") or 0
+            bucket["rejected"] += pr.get("rejected_count") or 0
+            bucket["merged_prs"] += pr["status"] == "merged"
+
+        contribution_daily_collection.delete_many({})
+        if buckets:
+            contribution_daily_collection.insert_many(
+                [{"username": username, "day": day, **counts} for (username, day), counts in buckets.items()]
+            )
+        contribution_windows_collection.delete_many({})
+        for username in {username for username, _ in buckets}:
+            refresh(username, today)
+    return {"users": len({username for username, _ in buckets}), "buckets": len(buckets)}
+
+
+def start_backfill():
+    """Rebuild from existing PRs once per deployment, on a background thread."""
+    def run():
+        try:
+            # Only the first worker to insert the marker rebuilds
+            scheduled_jobs_collection.insert_one({"_id": "leaderboard_backfill", "started_at": datetime.utcnow()})
+        except DuplicateKeyError:
+            return
+        try:
+            print(f"Leaderboard backfill: {rebuild()}")
+        except Exception as e:
+            print(f"Leaderboard backfill failed: {e}")
+            scheduled_jobs_collection.delete_one({"_id": "leaderboard_backfill"})
+
+    threading.Thread(target=run, name="leaderboard-backfill", daemon=True).start()
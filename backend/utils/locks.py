@@ -0,0 +1,66 @@
+"""
+Cross-process locks for running several uvicorn / gunicorn workers.
+
+Each lock is an flock() on a file under LOCK_DIR, so it serializes both
+threads and processes on the same host and is released by the kernel if a
+worker dies while holding it. Locks are re-entrant per thread, which lets a
+compound operation (e.g. git pull = fetch + pull) hold the git lock across
+helpers that take it themselves.
+
+Acquiring blocks the calling thread, so take them from sync handlers or
+run_in_threadpool, never on the event loop: a wait would stall every
+request, and coroutines share the loop's thread, so one would re-enter a
+lock another holds.
+"""
+import fcntl
+import hashlib
+import os
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from settings import get_settings
+from utils.tracing import span
+
+LOCK_DIR = get_settings().lock_dir
+
+_held = threading.local()
+
+
+@contextmanager
+def file_lock(name: str):
+    held = _held.__dict__.setdefault("names", {})
+    if name in held:
+        held[name] += 1
+        try:
+            yield
+        finally:
+            held[name] -= 1
+        return
+
+    LOCK_DIR.mkdir(parents=True, exist_ok=True)
+    fd = os.open(LOCK_DIR / f"{name}.lock", os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        with span("lock.wait", lock=name) as wait_span:
+            started = time.perf_counter()
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            wait_span.set_attribute("wait_ms", round((time.perf_counter() - started) * 1000, 3))
+        held[name] = 1
+        try:
+            yield
+        finally:
+            del held[name]
+            fcntl.flock(fd, fcntl.LOCK_UN)
+    finally:
+        os.close(fd)
+
+
+def git_lock():
+    """Serializes every command against the dataset git repository."""
+    return file_lock("git")
+
+
+def dataset_lock(file_path: Path):
+    """Serializes read-modify-write cycles on one dataset file."""
+    key = hashlib.sha1(str(Path(file_path).resolve()).encode("utf-8")).hexdigest()[:16]
+    return file_lock(f"dataset-{key}")
@@ -0,0 +1,295 @@
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+import uuid
+from contextvars import ContextVar
+from datetime import datetime
+from settings import get_settings
+
+settings = get_settings()
+PROFILE_DIR = settings.profile_dir
+PROFILE_INTERVAL_MS = settings.profile_interval_ms
+PROFILE_KEEP = settings.profile_keep
+PROFILE_TOP_ALLOCATIONS = 30
+
+_current_profile = ContextVar("current_profile", default=None)
+
+
+class SamplingProfiler:
+    """
+    Statistical profiler for a single thread.
+
+    A helper thread samples the target thread's stack every `interval` seconds
+    and charges the elapsed wall time, and the target thread's CPU time over
+    the same interval, to every frame on that stack. The result is a call tree
+    with inclusive wall / CPU time per node and self time on the leaves.
+    """
+
+    def __init__(self, thread_id=None, interval=PROFILE_INTERVAL_MS / 1000):
+        self.interval = interval
+        self.root = self._node("<request>")
+        self.samples = 0
+        self.followed = False
+        self._labels = {}  # code object -> label, formatting is the sampler's main cost
+        self._stop = threading.Event()
+        self._thread = None
+        self._target = self._target_for(thread_id or threading.get_ident())
+
+    @staticmethod
+    def _target_for(thread_id):
+        try:
+            return thread_id, time.pthread_getcpuclockid(thread_id)
+        except (AttributeError, OSError):
+            return thread_id, None  # CPU time unavailable on this platform
+
+    @property
+    def thread_id(self):
+        return self._target[0]
+
+    def follow(self, thread_id):
+        """Sample `thread_id` from now on, e.g. once the request moved to a worker thread."""
+        self._target = self._target_for(thread_id)
+        self.followed = True
+
+    @staticmethod
+    def _node(name):
+        return {"name": name, "wall_ms": 0.0, "cpu_ms": 0.0, "self_wall_ms": 0.0, "self_cpu_ms": 0.0,
+                "samples": 0, "children": {}}
+
+    @staticmethod
+    def _cpu_now(target):
+        return time.clock_gettime(target[1]) if target[1] is not None else 0.0
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="request-profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        return self.call_tree()
+
+    def _run(self):
+        target = self._target
+        last_wall = time.perf_counter()
+        last_cpu = self._cpu_now(target)
+        while not self._stop.wait(self.interval):
+            if self._target is not target:
+                target = self._target
+                last_cpu = self._cpu_now(target)
+            frame = sys._current_frames().get(target[0])
+            now_wall = time.perf_counter()
+            now_cpu = self._cpu_now(target)
+            if frame is not None:
+                self._record(frame, (now_wall - last_wall) * 1000, (now_cpu - last_cpu) * 1000)
+            last_wall, last_cpu = now_wall, now_cpu
+
+    def _record(self, frame, wall_ms, cpu_ms):
+        stack = []
+        labels = self._labels
+        while frame is not None:
+            code = frame.f_code
+            label = labels.get(code)
+            if label is None:
+                label = labels[code] = f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+            stack.append(label)
+            frame = frame.f_back
+        self.samples += 1
+
+        node = self.root
+        node["wall_ms"] += wall_ms
+        node["cpu_ms"] += cpu_ms
+        node["samples"] += 1
+        for name in reversed(stack):
+            child = node["children"].get(name)
+            if child is None:
+                child = node["children"][name] = self._node(name)
+            child["wall_ms"] += wall_ms
+            child["cpu_ms"] += cpu_ms
+            child["samples"] += 1
+            node = child
+        node["self_wall_ms"] += wall_ms
+        node["self_cpu_ms"] += cpu_ms
+
+    def call_tree(self):
+        def finalize(node):
+            children = sorted(node["children"].values(), key=lambda n: n["wall_ms"], reverse=True)
+            return dict(
+                node,
+                wall_ms=round(node["wall_ms"], 3), cpu_ms=round(node["cpu_ms"], 3),
+                self_wall_ms=round(node["self_wall_ms"], 3), self_cpu_ms=round(node["self_cpu_ms"], 3),
+                children=[finalize(c) for c in children],
+            )
+        return finalize(self.root)
+
+
+def follow_current_thread():
+    """Point the profile of the current request, if any, at this thread."""
+    profile = _current_profile.get()
+    if profile is not None:
+        profile._profiler.follow(threading.get_ident())
+
+
+def collapsed_stacks(tree):
+    """Flatten a call tree into 'a;b;c <self wall ms>' lines (flamegraph.pl / speedscope input)."""
+    lines = []
+
+    def walk(node, prefix):
+        path = f"{prefix};{node['name']}" if prefix else node["name"]
+        if node["self_wall_ms"] > 0:
+            lines.append(f"{path} {int(round(node['self_wall_ms'] * 1000))}")  # microseconds
+        for child in node["children"]:
+            walk(child, path)
+
+    walk(tree, "")
+    return "\n".join(lines) + "\n"
+
+
+# Memory profiles in progress, and whether tracemalloc was started for them
+_tracemalloc_lock = threading.Lock()
+_tracemalloc_users = 0
+_tracemalloc_started = False
+
+
+def _acquire_tracemalloc():
+    """Make sure tracemalloc runs; returns True if no other memory profile is running."""
+    global _tracemalloc_users, _tracemalloc_started
+    with _tracemalloc_lock:
+        if _tracemalloc_users == 0 and not tracemalloc.is_tracing():
+            # One frame is enough for per-line statistics and keeps the overhead low
+            tracemalloc.start(1)
+            _tracemalloc_started = True
+        _tracemalloc_users += 1
+        return _tracemalloc_users == 1
+
+
+def _release_tracemalloc():
+    """Stop tracemalloc once the last memory profile is done, unless something else started it."""
+    global _tracemalloc_users, _tracemalloc_started
+    with _tracemalloc_lock:
+        _tracemalloc_users -= 1
+        if _tracemalloc_users == 0 and _tracemalloc_started:
+            tracemalloc.stop()
+            _tracemalloc_started = False
+
+
+class RequestProfile:
+    """
+    Profiles one request: sampled call tree plus, unless `memory` is False,
+    a tracemalloc allocation snapshot. tracemalloc slows allocation-heavy code
+    down by up to an order of magnitude, so wall times of a memory profile are
+    inflated; use a CPU-only profile for timings. Memory profiles may overlap;
+    the peak they report then covers every overlapping request.
+    """
+
+    def __init__(self, method, path, username, memory=True):
+        self.id = uuid.uuid4().hex[:16]
+        self.method = method
+        self.path = path
+        self.username = username
+        self.memory = memory
+        self.started_at = datetime.utcnow()
+
+    def start(self):
+        if self.memory:
+            if _acquire_tracemalloc():
+                tracemalloc.reset_peak()
+            self._baseline = tracemalloc.take_snapshot()
+        self._profiler = SamplingProfiler()
+        self._wall_start = time.perf_counter()
+        self._cpu_start = time.thread_time()
+        self._profiler.start()
+        self._context_token = _current_profile.set(self)
+        return self
+
+    def finish(self, status_code=None):
+        _current_profile.reset(self._context_token)
+        tree = self._profiler.stop()
+        wall_ms = (time.perf_counter() - self._wall_start) * 1000
+        if self._profiler.followed:
+            cpu_ms = tree["cpu_ms"]  # Sampled; the work ran on another thread
+        else:
+            cpu_ms = (time.thread_time() - self._cpu_start) * 1000
+        memory, allocations = self._allocation_report() if self.memory else (None, None)
+
+        self.result = {
+            "id": self.id,
+            "method": self.method,
+            "path": self.path,
+            "username": self.username,
+            "status_code": status_code,
+            "started_at": self.started_at.isoformat(),
+            "wall_ms": round(wall_ms, 3),
+            "cpu_ms": round(cpu_ms, 3),
+            "samples": self._profiler.samples,
+            "sample_interval_ms": self._profiler.interval * 1000,
+            "memory": memory,
+            "allocations": allocations,
+            "call_tree": tree,
+        }
+        save_profile(self.result)
+        return self.result
+
+    def _allocation_report(self):
+        try:
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+        finally:
+            _release_tracemalloc()
+
+        snapshot = snapshot.filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, __file__),
+        ))
+        allocations = [
+            {
+                "location": f"{stat.traceback[0].filename}:{stat.traceback[0].lineno}",
+                "size_kb": round(stat.size / 1024, 2),
+                "size_diff_kb": round(stat.size_diff / 1024, 2),
+                "count_diff": stat.count_diff,
+            }
+            for stat in snapshot.compare_to(self._baseline, "lineno")[:PROFILE_TOP_ALLOCATIONS]
+        ]
+        return {"peak_kb": round(peak / 1024, 2), "current_kb": round(current / 1024, 2)}, allocations
+
+
+# --- Storage ---
+
+def save_profile(result):
+    PROFILE_DIR.mkdir(parents=True, exist_ok=True)
+    with open(PROFILE_DIR / f"{result['id']}.json", "w", encoding="utf-8") as f:
+        json.dump(result, f)
+    # Keep only the most recent PROFILE_KEEP profiles
+    stored = sorted(PROFILE_DIR.glob("*.json"), key=lambda p: p.stat().st_mtime, reverse=True)
+    for old in stored[PROFILE_KEEP:]:
+        old.unlink(missing_ok=True)
+
+
+def list_profiles():
+    if not PROFILE_DIR.exists():
+        return []
+    summaries = []
+    for path in sorted(PROFILE_DIR.glob("*.json"), key=lambda p: p.stat().st_mtime, reverse=True):
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except Exception:
+            continue
+        summaries.append({k: data.get(k) for k in
+                          ("id", "method", "path", "username", "status_code", "started_at", "wall_ms", "cpu_ms")})
+    return summaries
+
+
+def load_profile(profile_id: str):
+    # Ids are hex; anything else could be a path traversal attempt
+    if not profile_id.isalnum():
+        return None
+    path = PROFILE_DIR / f"{profile_id}.json"
+    if not path.exists():
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
@@ -0,0 +1,223 @@
+"""
+Cross-PR review queue.
+
+Each fork document carries a `changes` entry: the item positions the fork
+changes and a hash of its version of each, recorded whenever the fork is
+written. Changes are taken against the fork's base, or against main for
+forks saved before bases were recorded:
+
+    changes: {"revision": <fork revision>, "main_revision": <dataset revision or None>,
+              "indices": [...], "hashes": [...]}
+
+An entry is current while the fork's revision matches (and, for forks without
+a base, the main dataset's revision too), so the queue only diffs forks whose
+entry is missing or stale. After a save the entry is updated incrementally:
+this process remembers the content each entry was computed from, and only
+the positions the save changed, plus those already in the entry, are
+compared again. The queue groups the open PRs of a dataset by the
+positions they touch: positions changed by a single PR (or changed the same
+way by several) form the clean batch, the rest are flagged as conflicts.
+"""
+import hashlib
+import json
+import threading
+from collections import OrderedDict, defaultdict
+from database import user_datasets_collection
+from settings import get_settings
+from utils.dataset_io import open_dataset, dataset_revision
+from utils.fork_base import load_base, fork_changes
+from utils.tracing import span
+
+# Items of fork content kept to update `changes` entries incrementally
+INDEXED_CACHE_ITEMS = get_settings().review_cache_items
+# Positions compared per slice when looking for what a save changed
+COMPARE_BLOCK = 256
+
+
+def item_hash(item):
+    if item is None:
+        return None
+    return hashlib.sha1(json.dumps(item, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+def compute_changes(user_dataset, content, file_path, candidates=None):
+    """
+    The `changes` entry of a fork with the given content (its revision is set
+    by the caller). Only `candidates` are compared when given, so they must
+    include every position that can differ.
+    """
+    # A fork whose base is missing is compared with main, like one without a base
+    base = load_base(user_dataset, missing_ok=True)
+    if base is not None:
+        indices = fork_changes(base, content, candidates)
+        main_revision = None
+    else:
+        # No base: compare against main, as the legacy PR diff does
+        main_revision = dataset_revision(file_path)
+        main_view = open_dataset(file_path) or []
+        main_len = len(main_view)
+        indices = [
+            i for i in (range(max(main_len, len(content))) if candidates is None else candidates)
+            if i >= main_len or i >= len(content) or not main_view.same_as(i, content[i])
+        ]
+    return {
+        "main_revision": main_revision,
+        "indices": indices,
+        "hashes": [item_hash(content[i]) if i < len(content) else None for i in indices],
+    }
+
+
+def is_current(user_dataset, revision, file_path):
+    changes = user_dataset.get("changes")
+    if not changes or changes.get("revision") != revision:
+        return False
+    # Entries taken against main go stale when main changes
+    return changes.get("main_revision") is None or changes["main_revision"] == dataset_revision(file_path)
+
+
+def changed_positions(old, new):
+    """Positions where two item lists differ, comparing a slice at a time."""
+    common = min(len(old), len(new))
+    changed = []
+    for start in range(0, common, COMPARE_BLOCK):
+        end = min(start + COMPARE_BLOCK, common)
+        if old[start:end] != new[start:end]:
+            changed.extend(i for i in range(start, end) if old[i] != new[i])
+    changed.extend(range(common, max(len(old), len(new))))
+    return changed
+
+
+class _IndexedContent:
+    """
+    LRU of the content each fork's `changes` entry was last computed from,
+    bounded by the total number of items kept.
+    """
+
+    def __init__(self, max_items=INDEXED_CACHE_ITEMS):
+        self.max_items = max_items
+        self._entries = OrderedDict()  # (username, path) -> (revision, basis, content)
+        self._items = 0
+        self._lock = threading.Lock()
+
+    def get(self, key, revision, basis):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[:2] != (revision, basis):
+                return None
+            self._entries.move_to_end(key)
+            return entry[2]
+
+    def put(self, key, revision, basis, content):
+        with self._lock:
+            self._discard(key)
+            if len(content) > self.max_items:
+                return
+            self._entries[key] = (revision, basis, content)
+            self._items += len(content)
+            while self._items > self.max_items:
+                _, (_, _, evicted) = self._entries.popitem(last=False)
+                self._items -= len(evicted)
+
+    def _discard(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._items -= len(entry[2])
+
+
+_indexed = _IndexedContent()
+
+
+def _basis(user_dataset, changes):
+    """What a `changes` entry was taken against: the fork's base blobs, or main's revision."""
+    if changes.get("main_revision") is None:
+        return ("base", tuple(user_dataset.get("base_blobs", ())))
+    return ("main", changes["main_revision"])
+
+
+def changes_after_write(user_dataset, content, revision, file_path):
+    """
+    The `changes` entry of a fork (its document without content) just written
+    at `revision`, updated incrementally when this process indexed the previous
+    revision. Store it conditionally on the revision, then call `remember`.
+    """
+    key = (user_dataset["username"], user_dataset["original_path"])
+    with span("review.index_fork", dataset_path=key[1], fork_items=len(content)) as index_span:
+        previous = user_dataset.get("changes")
+        last = None
+        if previous and (previous.get("main_revision") is None
+                         or previous["main_revision"] == dataset_revision(file_path)):
+            last = _indexed.get(key, previous.get("revision"), _basis(user_dataset, previous))
+        candidates = None
+        if last is not None:
+            # Positions this save changed, and those that differed before it
+            candidates = sorted(set(previous["indices"]).union(changed_positions(last, content)))
+        changes = compute_changes(user_dataset, content, file_path, candidates)
+        if candidates is not None and _basis(user_dataset, changes) != _basis(user_dataset, previous):
+            changes = compute_changes(user_dataset, content, file_path)  # Compared against something else now
+            candidates = None
+        index_span.set_attributes(incremental=candidates is not None,
+                                  compared=len(content) if candidates is None else len(candidates))
+    changes["revision"] = revision
+    return changes
+
+
+def remember(user_dataset, changes, content):
+    """Keep the content a stored `changes` entry was computed from, for the next incremental update."""
+    key = (user_dataset["username"], user_dataset["original_path"])
+    _indexed.put(key, changes["revision"], _basis(user_dataset, changes), content)
+
+
+def current_changes(user_dataset_meta, revision, file_path):
+    """A fork's `changes` entry, recomputed (and stored) if missing or stale."""
+    if is_current(user_dataset_meta, revision, file_path):
+        return user_dataset_meta["changes"]
+    user_dataset = user_datasets_collection.find_one({"_id": user_dataset_meta["_id"]})
+    changes = compute_changes(user_dataset, user_dataset["content"], file_path)
+    # Forks saved before revisions existed are versioned by updated_at
+    if user_dataset.get("revision"):
+        query = {"_id": user_dataset["_id"], "revision": user_dataset["revision"]}
+        changes["revision"] = user_dataset["revision"]
+    else:
+        query = {"_id": user_dataset["_id"], "updated_at": user_dataset.get("updated_at")}
+        changes["revision"] = user_dataset.get("updated_at")
+    user_datasets_collection.update_one(query, {"$set": {"changes": changes}})
+    return changes
+
+
+def build_queue(prs, changes_by_pr):
+    """
+    Review queue of one dataset. `prs` are open PR documents oldest first and
+    `changes_by_pr` maps each PR id to its fork's `changes` entry.
+    """
+    touched = defaultdict(dict)  # position -> {pr id: hash of that PR's version}
+    for pr in prs:
+        changes = changes_by_pr.get(pr["_id"], {"indices": [], "hashes": []})
+        for index, item_hash in zip(changes["indices"], changes["hashes"]):
+            touched[index][pr["_id"]] = item_hash
+
+    conflicts = []
+    conflicting = set()
+    for index in sorted(touched):
+        versions = touched[index]
+        if len(versions) > 1 and len(set(versions.values())) > 1:
+            conflicts.append({"index": index, "pr_ids": [str(pr_id) for pr_id in versions]})
+            conflicting.add(index)
+
+    entries = []
+    for pr in prs:
+        indices = changes_by_pr.get(pr["_id"], {"indices": []})["indices"]
+        entries.append({
+            "pr_id": str(pr["_id"]),
+            "username": pr["username"],
+            "created_at": pr.get("created_at"),
+            "description": pr.get("description"),
+            "total_changes": len(indices),
+            # Can be accepted together with every other PR's clean indices
+            "clean_indices": [i for i in indices if i not in conflicting],
+            "conflicting_indices": [i for i in indices if i in conflicting],
+        })
+    return {
+        "prs": entries,
+        "conflicts": conflicts,
+        "clean_changes": sum(len(e["clean_indices"]) for e in entries),
+    }
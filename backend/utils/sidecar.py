@@ -0,0 +1,201 @@
+"""
+Compact binary sidecars for dataset files.
+
+The pretty-printed JSON files in the dataset repo stay the source of truth
+(they are what git versions), but decoding them is the slowest part of every
+read. Next to each one we keep a derived file, outside the repo, laid out as:
+
+    header   64 bytes   magic, version, source mtime/size, item count,
+                        offset of the offset table, sha1 of the source JSON
+    records  ...        per item: u32 length + msgpack encoding of the item
+    table    8 * count  u64 file offset of each record
+
+so item i is one table lookup plus one msgpack decode. A sidecar is only
+trusted while the source file's (mtime, size) match the header; otherwise it
+is rebuilt on the next read.
+
+Readers memory-map the sidecar and decode items only when they are accessed,
+so every worker process shares the same page cache pages instead of holding
+its own decoded copy of a large dataset.
+"""
+import hashlib
+import mmap
+import os
+import struct
+import tempfile
+import threading
+from pathlib import Path
+import msgpack
+from settings import get_settings
+
+SIDECAR_DIR = get_settings().dataset_cache_dir
+
+MAGIC = b"PTSC"
+VERSION = 1
+HEADER = struct.Struct("<4sHHQQQQ20s")
+HEADER_SIZE = 64
+RECORD_LENGTH = struct.Struct("<I")
+OFFSET = struct.Struct("<Q")
+
+
+def sidecar_path(source: Path) -> Path:
+    source = Path(source).resolve()
+    key = hashlib.sha1(str(source).encode("utf-8")).hexdigest()[:16]
+    return SIDECAR_DIR / f"{key}-{source.name}.ptsc"
+
+
+def pack_item(item) -> bytes:
+    return msgpack.packb(item, use_bin_type=True)
+
+
+def build_sidecar(source: Path, content, source_sha1: bytes, stat: os.stat_result):
+    """
+    Write the sidecar for `source` from already-decoded `content`.
+    `stat` must be taken *before* the source was read so a concurrent rewrite
+    leaves a stale (and therefore ignored) sidecar rather than a wrong one.
+    """
+    target = sidecar_path(source)
+    target.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_name = tempfile.mkstemp(dir=target.parent, prefix=".tmp-", suffix=".ptsc")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(b"\0" * HEADER_SIZE)
+            offsets = []
+            position = HEADER_SIZE
+            for item in content:
+                record = pack_item(item)
+                offsets.append(position)
+                f.write(RECORD_LENGTH.pack(len(record)))
+                f.write(record)
+                position += RECORD_LENGTH.size + len(record)
+            table_offset = position
+            f.write(b"".join(OFFSET.pack(o) for o in offsets))
+            f.seek(0)
+            f.write(HEADER.pack(MAGIC, VERSION, 0, stat.st_mtime_ns, stat.st_size,
+                                len(offsets), table_offset, source_sha1))
+        os.replace(tmp_name, target)
+    except Exception:
+        if os.path.exists(tmp_name):
+            os.unlink(tmp_name)
+        raise
+    return target
+
+
+class SidecarReader:
+    """
+    Lazy, read-only sequence over a memory-mapped sidecar file. Indexing
+    decodes a single item (slicing decodes only the slice); nothing is cached
+    on the Python side.
+    """
+
+    def __init__(self, path: Path, mtime_ns: int, size: int, count: int, table_offset: int, source_sha1: bytes):
+        self.path = path
+        self.mtime_ns = mtime_ns
+        self.size = size
+        self.count = count
+        self.table_offset = table_offset
+        self.source_sha1 = source_sha1.hex()
+        with open(path, "rb") as f:
+            # The mapping outlives both the descriptor and a later os.replace()
+            # of the sidecar, so readers in flight never see a half-written file.
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._map)
+
+    def close(self):
+        self._view.release()
+        self._map.close()
+
+    def __len__(self):
+        return self.count
+
+    def _span(self, index: int):
+        (offset,) = OFFSET.unpack_from(self._view, self.table_offset + index * OFFSET.size)
+        (length,) = RECORD_LENGTH.unpack_from(self._view, offset)
+        start = offset + RECORD_LENGTH.size
+        return start, start + length
+
+    def raw(self, index: int) -> bytes:
+        """msgpack bytes of item `index`, without decoding it."""
+        if not 0 <= index < self.count:
+            raise IndexError(index)
+        start, end = self._span(index)
+        return self._view[start:end].tobytes()
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self._decode(i) for i in range(*index.indices(self.count))]
+        if index < 0:
+            index += self.count
+        if not 0 <= index < self.count:
+            raise IndexError(index)
+        return self._decode(index)
+
+    def __iter__(self):
+        for i in range(self.count):
+            yield self._decode(i)
+
+    def _decode(self, index: int):
+        start, end = self._span(index)
+        return msgpack.unpackb(self._view[start:end], raw=False)
+
+    def same_as(self, index: int, item) -> bool:
+        """Whether item `index` equals `item`, comparing encoded bytes before decoding."""
+        raw = self.raw(index)
+        if raw == pack_item(item):
+            return True
+        # Same data with a different key order still counts as equal
+        return msgpack.unpackb(raw, raw=False) == item
+
+    def read_all(self):
+        """Decode every item. Records are contiguous, so this is a single sequential pass."""
+        view = self._view
+        items = []
+        position = HEADER_SIZE
+        for _ in range(self.count):
+            (length,) = RECORD_LENGTH.unpack_from(view, position)
+            position += RECORD_LENGTH.size
+            items.append(msgpack.unpackb(view[position:position + length], raw=False))
+            position += length
+        return items
+
+
+# sidecar path -> open reader, so repeated requests reuse one mapping per file
+_readers = {}
+_readers_lock = threading.Lock()
+
+
+def open_sidecar(source: Path, stat: os.stat_result = None):
+    """Reader for `source`'s sidecar, or None if it is missing or stale."""
+    path = sidecar_path(source)
+    try:
+        if stat is None:
+            stat = os.stat(source)
+        with _readers_lock:
+            reader = _readers.get(path)
+        if reader is not None and reader.mtime_ns == stat.st_mtime_ns and reader.size == stat.st_size:
+            return reader
+        with open(path, "rb") as f:
+            header = f.read(HEADER_SIZE)
+    except FileNotFoundError:
+        return None
+    if len(header) < HEADER.size:
+        return None
+    magic, version, _, mtime_ns, size, count, table_offset, sha1 = HEADER.unpack_from(header)
+    if magic != MAGIC or version != VERSION or mtime_ns != stat.st_mtime_ns or size != stat.st_size:
+        return None
+    reader = SidecarReader(path, mtime_ns, size, count, table_offset, sha1)
+    # A replaced reader is not closed here: a request may still be iterating
+    # it. Its mapping is released once the last reference goes away.
+    with _readers_lock:
+        _readers[path] = reader
+    return reader
+
+
+def remove_sidecar(source: Path):
+    path = sidecar_path(source)
+    with _readers_lock:
+        _readers.pop(path, None)
+    try:
+        path.unlink()
+    except FileNotFoundError:
+        pass
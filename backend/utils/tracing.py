@@ -0,0 +1,268 @@
+import json
+import queue
+import random
+import threading
+import time
+import urllib.request
+from contextlib import contextmanager
+from contextvars import ContextVar
+from settings import get_settings
+
+settings = get_settings()
+
+# Fraction of requests that get traced. 0 disables tracing entirely; a request
+# can still opt in with the X-Trace: 1 header.
+TRACE_SAMPLE_RATE = settings.trace_sample_rate
+TRACE_EXPORTER = settings.trace_exporter  # file | otlp
+TRACE_FILE = settings.trace_file
+TRACE_OTLP_ENDPOINT = settings.trace_otlp_endpoint
+TRACE_SERVICE_NAME = settings.trace_service_name
+
+_current_span = ContextVar("current_span", default=None)
+
+
+class Span:
+    __slots__ = ("trace", "span_id", "parent_id", "name", "start_ns", "end_ns", "attributes", "status", "error")
+
+    def __init__(self, trace, name, parent_id=None, attributes=None):
+        self.trace = trace
+        self.span_id = "%016x" % random.getrandbits(64)
+        self.parent_id = parent_id
+        self.name = name
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.attributes = dict(attributes or {})
+        self.status = "ok"
+        self.error = None
+        trace.spans.append(self)
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def set_attributes(self, **attributes):
+        self.attributes.update(attributes)
+
+    def record_exception(self, exc):
+        self.status = "error"
+        self.error = f"{type(exc).__name__}: {exc}"
+
+    def end(self):
+        if self.end_ns is None:
+            self.end_ns = time.time_ns()
+
+    def to_dict(self):
+        return {
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start_ns": self.start_ns,
+            "duration_ms": round(((self.end_ns or time.time_ns()) - self.start_ns) / 1e6, 3),
+            "attributes": self.attributes,
+            "status": self.status,
+            "error": self.error,
+        }
+
+
+class _NoopSpan:
+    """Returned when the current request isn't sampled, so callers never branch."""
+    span_id = None
+
+    def set_attribute(self, key, value):
+        pass
+
+    def set_attributes(self, **attributes):
+        pass
+
+    def record_exception(self, exc):
+        pass
+
+    def end(self):
+        pass
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+class Trace:
+    def __init__(self):
+        self.trace_id = "%032x" % random.getrandbits(128)
+        self.spans = []
+
+
+def current_span():
+    return _current_span.get()
+
+
+def annotate(**attributes):
+    """Attach attributes to the current span, if the request is being traced."""
+    span = _current_span.get()
+    if span is not None:
+        span.set_attributes(**attributes)
+
+
+def current_trace_id():
+    span = _current_span.get()
+    return span.trace.trace_id if span is not None else None
+
+
+@contextmanager
+def start_trace(name, force=False, **attributes):
+    """Open the root span of a trace, subject to sampling."""
+    if not force and (TRACE_SAMPLE_RATE <= 0 or random.random() >= TRACE_SAMPLE_RATE):
+        yield NOOP_SPAN
+        return
+
+    root = Span(Trace(), name, attributes=attributes)
+    token = _current_span.set(root)
+    try:
+        yield root
+    except BaseException as e:
+        root.record_exception(e)
+        raise
+    finally:
+        root.end()
+        _current_span.reset(token)
+        exporter.submit(root.trace)
+
+
+@contextmanager
+def span(name, **attributes):
+    """Child span of the current span. A no-op outside of a sampled trace."""
+    parent = _current_span.get()
+    if parent is None:
+        yield NOOP_SPAN
+        return
+
+    child = Span(parent.trace, name, parent_id=parent.span_id, attributes=attributes)
+    token = _current_span.set(child)
+    try:
+        yield child
+    except BaseException as e:
+        child.record_exception(e)
+        raise
+    finally:
+        child.end()
+        _current_span.reset(token)
+
+
+def start_span(name, **attributes):
+    """
+    Start a child span without making it current, for callback style
+    instrumentation (e.g. pymongo command events). The caller must end() it.
+    """
+    parent = _current_span.get()
+    if parent is None:
+        return NOOP_SPAN
+    return Span(parent.trace, name, parent_id=parent.span_id, attributes=attributes)
+
+
+# --- Export ---
+
+def trace_to_tree(trace):
+    """Nest a finished trace's spans into a tree (children ordered by start time)."""
+    nodes = {s.span_id: dict(s.to_dict(), children=[]) for s in trace.spans}
+    roots = []
+    for s in sorted(trace.spans, key=lambda s: s.start_ns):
+        node = nodes[s.span_id]
+        parent = nodes.get(s.parent_id)
+        (parent["children"] if parent else roots).append(node)
+    return {"trace_id": trace.trace_id, "spans": roots}
+
+
+def _otlp_value(value):
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def trace_to_otlp(traces):
+    """Encode finished traces as an OTLP/HTTP JSON ExportTraceServiceRequest."""
+    spans = []
+    for trace in traces:
+        for s in trace.spans:
+            otlp_span = {
+                "traceId": trace.trace_id,
+                "spanId": s.span_id,
+                "name": s.name,
+                "kind": 2 if s.parent_id is None else 1,  # SERVER for roots, INTERNAL otherwise
+                "startTimeUnixNano": str(s.start_ns),
+                "endTimeUnixNano": str(s.end_ns or s.start_ns),
+                "attributes": [{"key": k, "value": _otlp_value(v)} for k, v in s.attributes.items()],
+                "status": {"code": 2, "message": s.error} if s.status == "error" else {"code": 1},
+            }
+            if s.parent_id:
+                otlp_span["parentSpanId"] = s.parent_id
+            spans.append(otlp_span)
+    return {
+        "resourceSpans": [{
+            "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": TRACE_SERVICE_NAME}}]},
+            "scopeSpans": [{"scope": {"name": "polythink.tracing"}, "spans": spans}],
+        }]
+    }
+
+
+class TraceExporter:
+    """Exports finished traces from a background thread so requests never wait on I/O."""
+
+    def __init__(self, mode=TRACE_EXPORTER, path=TRACE_FILE, endpoint=TRACE_OTLP_ENDPOINT, batch_size=64):
+        self.mode = mode
+        self.path = path
+        self.endpoint = endpoint
+        self.batch_size = batch_size
+        self._queue = queue.Queue(maxsize=10000)
+        self._thread = None
+        self._lock = threading.Lock()
+        self.dropped = 0
+
+    def submit(self, trace):
+        self._ensure_started()
+        try:
+            self._queue.put_nowait(trace)
+        except queue.Full:
+            # Never let tracing back-pressure the API
+            self.dropped += 1
+
+    def flush(self, timeout=5.0):
+        deadline = time.monotonic() + timeout
+        while not self._queue.empty() and time.monotonic() < deadline:
+            time.sleep(0.05)
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="trace-exporter", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self.export(batch)
+            except Exception as e:
+                print(f"Trace export failed ({self.mode}): {e}")
+
+    def export(self, traces):
+        if self.mode == "otlp":
+            body = json.dumps(trace_to_otlp(traces)).encode("utf-8")
+            request = urllib.request.Request(
+                self.endpoint, data=body, method="POST",
+                headers={"Content-Type": "application/json"},
+            )
+            with urllib.request.urlopen(request, timeout=5):
+                pass
+        else:
+            with open(self.path, "a", encoding="utf-8") as f:
+                for trace in traces:
+                    f.write(json.dumps(trace_to_tree(trace), ensure_ascii=False, default=str) + "\n")
+
+
+exporter = TraceExporter()
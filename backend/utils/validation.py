@@ -0,0 +1,228 @@
+"""
+Validation of dataset items.
+
+An item is {"messages": [{"role", "content", "thinking"}, ...]}. The rules:
+
+    structure      the item is an object with a non-empty "messages" list of
+                   objects; role/content are strings, thinking a string or null
+    role           role is one of system, user, assistant
+    role_order     an optional system message first, then user and assistant
+                   alternating, starting with user and ending with assistant
+    turn_count     single-turn datasets hold exactly one user/assistant exchange
+    empty          content is blank                                  (warning for thinking)
+    size           a message or the whole item is over the size limits
+    thinking       only assistant messages carry thinking            (warning)
+
+Violations are dicts {"index", "severity", "code", "path", "message"}. Errors
+block merging an item into main; warnings are only reported.
+
+Fork saves validate only the items whose content changed since the last
+check (see `validate_changed`). Full-dataset audits split the dataset into
+index ranges checked in a process pool; each worker opens the dataset's
+memory-mapped sidecars itself, so items are never pickled across processes.
+"""
+import json
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from settings import get_settings
+from utils.dataset_io import open_dataset
+from utils.tracing import span
+
+settings = get_settings()
+MAX_MESSAGE_CHARS = settings.validation_max_message_chars
+MAX_ITEM_BYTES = settings.validation_max_item_bytes
+AUDIT_WORKERS = settings.validation_workers
+# Items per audit task; smaller datasets are audited in-process
+AUDIT_CHUNK_SIZE = settings.validation_chunk_size
+# Upper bound on violations kept in a stored report
+MAX_REPORTED = 10_000
+
+ROLES = ("system", "user", "assistant")
+
+
+def _violation(index, code, path, message, severity="error"):
+    return {"index": index, "severity": severity, "code": code, "path": path, "message": message}
+
+
+def validate_item(item, index=None, turn_type=None):
+    """Violations of one item (a list, empty if the item is valid)."""
+    if not isinstance(item, dict) or not isinstance(item.get("messages"), list):
+        return [_violation(index, "structure", "", "Item must be an object with a \"messages\" list")]
+    messages = item["messages"]
+    if not messages:
+        return [_violation(index, "structure", "messages", "Item has no messages")]
+
+    violations = []
+    roles = []
+    for m, message in enumerate(messages):
+        path = f"messages[{m}]"
+        if not isinstance(message, dict):
+            violations.append(_violation(index, "structure", path, "Message must be an object"))
+            roles.append(None)
+            continue
+        role = message.get("role")
+        if role not in ROLES:
+            violations.append(_violation(index, "role", f"{path}.role", f"Unknown role {role!r}"))
+        roles.append(role)
+
+        content = message.get("content")
+        if not isinstance(content, str):
+            violations.append(_violation(index, "structure", f"{path}.content", "Content must be a string"))
+        elif not content.strip():
+            violations.append(_violation(index, "empty", f"{path}.content", "Content is empty"))
+        elif len(content) > MAX_MESSAGE_CHARS:
+            violations.append(_violation(index, "size", f"{path}.content",
+                                         f"Content is {len(content)} characters (limit {MAX_MESSAGE_CHARS})"))
+
+        thinking = message.get("thinking")
+        if thinking is None:
+            continue
+        if not isinstance(thinking, str):
+            violations.append(_violation(index, "structure", f"{path}.thinking", "Thinking must be a string or null"))
+        elif role != "assistant":
+            violations.append(_violation(index, "thinking", f"{path}.thinking",
+                                         "Only assistant messages should have thinking", "warning"))
+        elif not thinking.strip():
+            violations.append(_violation(index, "empty", f"{path}.thinking",
+                                         "Thinking is empty (use null for none)", "warning"))
+        elif len(thinking) > MAX_MESSAGE_CHARS:
+            violations.append(_violation(index, "size", f"{path}.thinking",
+                                         f"Thinking is {len(thinking)} characters (limit {MAX_MESSAGE_CHARS})"))
+
+    violations.extend(_check_order(index, roles, turn_type))
+
+    size = len(json.dumps(item, ensure_ascii=False).encode("utf-8"))
+    if size > MAX_ITEM_BYTES:
+        violations.append(_violation(index, "size", "", f"Item is {size} bytes (limit {MAX_ITEM_BYTES})"))
+    return violations
+
+
+def _check_order(index, roles, turn_type):
+    if any(role not in ROLES for role in roles):
+        return []  # Already reported
+    turns = roles[1:] if roles[0] == "system" else roles
+    for t, role in enumerate(turns):
+        expected = "user" if t % 2 == 0 else "assistant"
+        if role != expected:
+            position = t + len(roles) - len(turns)
+            return [_violation(index, "role_order", f"messages[{position}].role",
+                               f"Expected {expected} but found {role}")]
+    if not turns or turns[-1] != "assistant":
+        return [_violation(index, "role_order", "messages",
+                           "Conversation must end with an assistant message")]
+    if turn_type == "single-turn" and len(turns) != 2:
+        return [_violation(index, "turn_count", "messages",
+                           f"Single-turn item has {len(turns) // 2} exchanges")]
+    return []
+
+
+def has_errors(violations):
+    return any(v["severity"] == "error" for v in violations)
+
+
+def turn_type_of(dataset_path: str):
+    return dataset_path.split("/", 1)[0]
+
+
+def validate_items(content, indices, turn_type=None):
+    """Violations of the items at `indices` (out of range indices are skipped)."""
+    violations = []
+    for i in indices:
+        if 0 <= i < len(content) and content[i] is not None:
+            violations.extend(validate_item(content[i], i, turn_type))
+    return violations
+
+
+def validate_changed(content, changes, previous, turn_type=None):
+    """
+    Incremental check of a fork. `changes` is its review-queue change index
+    (positions and item hashes); `previous` is the last result, as returned
+    here. Only positions whose hash differs from the last check are validated.
+    Returns {"hashes": {index: hash}, "violations": [...]}.
+    """
+    previous = previous or {"hashes": {}, "violations": []}
+    old_hashes = previous.get("hashes", {})
+    kept = {}
+    for v in previous.get("violations", []):
+        kept.setdefault(v["index"], []).append(v)
+
+    hashes, violations, checked = {}, [], 0
+    for index, item_hash in zip(changes["indices"], changes["hashes"]):
+        key = str(index)  # Mongo document keys must be strings
+        hashes[key] = item_hash
+        if item_hash is None:
+            continue
+        if old_hashes.get(key) == item_hash:
+            violations.extend(kept.get(index, []))
+        else:
+            violations.extend(validate_items(content, [index], turn_type))
+            checked += 1
+    return {"hashes": hashes, "violations": violations[:MAX_REPORTED], "checked": checked}
+
+
+# --- Full-dataset audits ---
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            # Not fork: the server's threads may hold locks (Mongo pool, git
+            # cat-file, tracing) that a forked child would inherit held
+            _executor = ProcessPoolExecutor(max_workers=AUDIT_WORKERS,
+                                            mp_context=multiprocessing.get_context("forkserver"))
+        return _executor
+
+
+def shutdown_pool():
+    global _executor
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown(wait=False, cancel_futures=True)
+            _executor = None
+
+
+def _audit_range(file_path, start, stop, turn_type):
+    """Worker: validate items [start, stop) of a dataset."""
+    view = open_dataset(Path(file_path))
+    if view is None:
+        return []
+    violations = []
+    for i in range(start, min(stop, len(view))):
+        violations.extend(validate_item(view[i], i, turn_type))
+    return violations
+
+
+def audit_dataset(file_path: Path, dataset_path: str):
+    """
+    Validate every item of a main dataset. Returns a report
+    {"items", "violations", "counts", "truncated"}; violations are ordered by index.
+    """
+    view = open_dataset(file_path)
+    count = len(view) if view is not None else 0
+    turn_type = turn_type_of(dataset_path)
+    ranges = [(start, start + AUDIT_CHUNK_SIZE) for start in range(0, count, AUDIT_CHUNK_SIZE)]
+    with span("validation.audit", dataset_path=dataset_path, items=count, tasks=len(ranges)) as audit_span:
+        if len(ranges) <= 1 or AUDIT_WORKERS <= 1:
+            violations = _audit_range(str(file_path), 0, count, turn_type)
+        else:
+            executor = _get_executor()
+            futures = [executor.submit(_audit_range, str(file_path), start, stop, turn_type)
+                       for start, stop in ranges]
+            violations = [v for future in futures for v in future.result()]
+        audit_span.set_attribute("violations", len(violations))
+
+    counts = {}
+    for v in violations:
+        counts[v["code"]] = counts.get(v["code"], 0) + 1
+    return {
+        "items": count,
+        "violations": violations[:MAX_REPORTED],
+        "counts": counts,
+        "truncated": len(violations) > MAX_REPORTED,
+    }
@@ -0,0 +1,320 @@
+"""
+Fork autosaves.
+
+The editor autosaves every few seconds, and every save rewrites the whole
+fork document in Mongo. Saves are keyed by (username, dataset path) and
+coalesced per key: while one save of a fork is being written, the saves
+that arrive behind it are merged, and the next write stores only the
+latest. A save is acknowledged once a write containing it has finished, so
+a burst of saves costs one write per round trip, not one per save.
+
+Every write stores a `revision`, and is conditional on the stored revision
+being older, so an out-of-order write can never overwrite newer content.
+Workers don't share sequence numbers: when a write finds a newer revision
+(saved through another worker), it is renumbered after it and retried, so
+the last save to arrive wins, as with a plain update.
+
+FORK_FLUSH_SECONDS > 0 additionally buffers saves in memory and writes
+each fork at most once per interval. Buffered saves live in one process
+and are lost if it dies, so this only applies to single-worker deployments
+(WEB_CONCURRENCY=1); with more workers every save is written through.
+Anything that reads a fork calls `flush()` first. The editor autosaves 2 s
+after the last edit, so saves of one fork rarely overlap and write-through
+costs one write per save; benchmarks/bench_api.py reports the writes behind
+its fork saves for either mode.
+
+Listeners registered with `on_written` (the review index, validation) run
+on a background thread after the write, never under a write lock. When a
+fork is written again before they get to it, they only see the newest
+revision.
+"""
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from pymongo.errors import DuplicateKeyError
+from database import user_datasets_collection
+from settings import get_settings
+from utils.events import bus
+from utils.metrics import registry
+
+settings = get_settings()
+FORK_FLUSH_SECONDS = settings.fork_flush_seconds
+WEB_CONCURRENCY = settings.web_concurrency
+# Times a write is renumbered after a newer stored revision before giving up
+STALE_RETRIES = 3
+
+fork_saves = registry.counter("fork_saves_total", "Fork saves received, by how they were stored.", ("mode",))
+fork_writes = registry.counter("fork_writes_total", "Fork documents written to Mongo, by outcome.", ("outcome",))
+
+
+class ForkWriteError(Exception):
+    """A fork save could not be written to the database."""
+
+
+class ForkDeletedError(ForkWriteError):
+    """The fork was deleted and the save has no way to recreate it."""
+
+
+class _Pending:
+    __slots__ = ("content", "seq", "saves", "first_at", "updated_at", "on_insert", "on_create", "written", "error")
+
+    def __init__(self, content, seq, on_insert=None, on_create=None):
+        self.content = content
+        self.seq = seq
+        self.on_insert = on_insert  # extra fields for a brand new fork document
+        self.on_create = on_create  # makes them, if the fork turns out to be gone when written
+        self.saves = 1
+        self.first_at = time.monotonic()
+        self.updated_at = datetime.utcnow()
+        self.written = None  # revision stored, once written
+        self.error = None
+
+
+class ForkWriteBuffer:
+    def __init__(self, interval=FORK_FLUSH_SECONDS):
+        if interval > 0 and WEB_CONCURRENCY > 1:
+            print(f"FORK_FLUSH_SECONDS={interval} needs a single worker (WEB_CONCURRENCY={WEB_CONCURRENCY}); "
+                  f"writing fork saves through")
+            interval = 0
+        self.interval = interval
+        self._pending = {}  # (username, path) -> _Pending
+        self._seqs = {}  # (username, path) -> last seq assigned by this process
+        self._lock = threading.Lock()
+        # Per key: serializes writes so a fork is never written by two threads at once
+        self._write_locks = {}
+        self._stop = threading.Event()
+        self._thread = None
+        self._listeners = []
+        # (username, path) -> (content, seq) written and not yet passed to the listeners
+        self._to_notify = OrderedDict()
+        self._notify_ready = threading.Condition()
+        self._notifying = False
+        self._notify_thread = None
+
+    def on_written(self, listener):
+        """Register `listener(username, path, content, seq)` to be called after a fork is written."""
+        self._listeners.append(listener)
+        return listener
+
+    def save(self, username, path, content, on_create=None):
+        """
+        Save a fork. Returns (seq, persisted). `on_create()` is called when
+        the fork doesn't exist yet and returns fields to store with it.
+        Written through unless buffering is enabled; raises ForkWriteError
+        if the write fails. Blocks on Mongo (and on git in `on_create`):
+        call it from a thread.
+        """
+        key = (username, path)
+        with self._lock:
+            pending = self._add(key, content, on_create=on_create)
+            known = key in self._seqs
+        if pending is None:
+            # The stored revision only matters the first time this process
+            # saves the fork; after that a stale write is renumbered instead.
+            # Looked up outside the lock, which every save takes.
+            stored = None if known else self._stored_revision(key)
+            on_insert = None
+            if not known and stored is None and on_create is not None:
+                try:
+                    on_insert = on_create()
+                except Exception as e:
+                    print(f"Failed to prepare new fork {username}/{path}: {e}")
+            with self._lock:
+                pending = self._add(key, content, on_insert, on_create)
+                if pending is None:
+                    seq = max(self._seqs.get(key, 0), stored or 0) + 1
+                    pending = self._pending[key] = _Pending(content, seq, on_insert, on_create)
+                    self._seqs[key] = seq
+            seq = pending.seq
+        else:
+            seq = self._seqs[key]
+
+        if self.interval <= 0:
+            fork_saves.inc(mode="write_through")
+            # Writes whatever is pending, unless a write already in progress
+            # took this save along
+            self.flush(username, path)
+            if pending.written is None:
+                raise ForkWriteError(f"Failed to save fork {username}/{path}: {pending.error or 'not written'}")
+            return pending.written, True
+        fork_saves.inc(mode="buffered")
+        self._ensure_started()
+        return seq, False
+
+    def _add(self, key, content, on_insert=None, on_create=None):
+        """Add a save to the one pending for the key; returns it, or None if there is none. Holds _lock."""
+        pending = self._pending.get(key)
+        if pending is None:
+            return None
+        seq = pending.seq + 1
+        pending.content, pending.seq = content, seq
+        pending.on_insert = pending.on_insert or on_insert
+        pending.on_create = on_create or pending.on_create
+        pending.saves += 1
+        pending.updated_at = datetime.utcnow()
+        self._seqs[key] = seq
+        return pending
+
+    def _write_lock(self, key):
+        with self._lock:
+            return self._write_locks.setdefault(key, threading.Lock())
+
+    def flush(self, username, path):
+        """Write the pending save of one fork, if any. Returns the revision written, or None."""
+        key = (username, path)
+        with self._write_lock(key):
+            with self._lock:
+                pending = self._pending.pop(key, None)
+            if pending is None or not self._write(key, pending):
+                return None
+            return pending.written
+
+    def flush_all(self, older_than=None):
+        now = time.monotonic()
+        with self._lock:
+            keys = [k for k, p in self._pending.items() if older_than is None or now - p.first_at >= older_than]
+        for username, path in keys:
+            self.flush(username, path)
+
+    def pending_count(self):
+        return len(self._pending)
+
+    def has_pending(self, username, path):
+        return (username, path) in self._pending
+
+    def discard_user(self, username):
+        """Drop a deleted user's buffered saves so they don't recreate their forks."""
+        with self._lock:
+            keys = [k for k in self._write_locks if k[0] == username]
+        for key in keys:
+            with self._write_lock(key), self._lock:
+                self._pending.pop(key, None)
+                self._seqs.pop(key, None)
+                self._write_locks.pop(key, None)
+
+    def stop(self):
+        """Flush everything; called on shutdown."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=10)
+        self.flush_all()
+        self.wait_listeners(timeout=10)
+
+    def wait_listeners(self, timeout=None):
+        """Wait until the listeners have seen every write so far. Returns False on timeout."""
+        with self._notify_ready:
+            return self._notify_ready.wait_for(lambda: not self._to_notify and not self._notifying, timeout)
+
+    def _stored_revision(self, key):
+        doc = user_datasets_collection.find_one(
+            {"username": key[0], "original_path": key[1]}, {"revision": 1}
+        )
+        # None when the fork doesn't exist yet
+        return doc.get("revision", 0) if doc else None
+
+    def _write(self, key, pending):
+        """Write a pending save, renumbering it after newer stored revisions. Holds the key's write lock."""
+        username, path = key
+        try:
+            for _ in range(STALE_RETRIES):
+                if self._write_once(key, pending):
+                    break
+                stored = self._stored_revision(key)
+                if stored is None:
+                    # Deleted (fork GC, a reset) since this process last wrote it:
+                    # recreate it as a new fork, never as one without a base
+                    if pending.on_create is None:
+                        raise ForkDeletedError("the fork no longer exists")
+                    pending.on_insert = pending.on_create()
+                    continue
+                # The stored fork is newer (saved through another worker)
+                fork_writes.inc(outcome="stale")
+                with self._lock:
+                    pending.seq = max(pending.seq, stored) + 1
+                    self._seqs[key] = max(self._seqs.get(key, 0), pending.seq)
+            else:
+                raise ForkWriteError(f"revision kept moving ahead of {pending.seq}")
+        except Exception as e:
+            fork_writes.inc(outcome="error")
+            print(f"Failed to write fork {username}/{path}: {e}")
+            pending.error = e
+            if self.interval > 0 and not isinstance(e, ForkDeletedError):
+                # Keep the save buffered and retry on the next tick, unless a newer one arrived
+                with self._lock:
+                    self._pending.setdefault(key, pending)
+            return False
+        fork_writes.inc(outcome="written")
+        pending.written = pending.seq
+        if self._listeners:
+            self._notify(key, pending.content, pending.seq)
+        bus.publish("fork.saved", {"username": username, "dataset_path": path, "seq": pending.seq},
+                    users=[username], roles=["admin"])
+        return True
+
+    def _write_once(self, key, pending):
+        """
+        One conditional write; False if the stored revision is already as new,
+        or if the fork doesn't exist and there is nothing to create it with.
+        """
+        username, path = key
+        update = {"$set": {"content": pending.content, "updated_at": pending.updated_at, "revision": pending.seq}}
+        if pending.on_insert:
+            update["$setOnInsert"] = pending.on_insert
+        try:
+            result = user_datasets_collection.update_one(
+                {
+                    "username": username,
+                    "original_path": path,
+                    "$or": [{"revision": {"$lt": pending.seq}}, {"revision": {"$exists": False}}],
+                },
+                update,
+                upsert=pending.on_insert is not None,
+            )
+        except DuplicateKeyError:
+            return False
+        return bool(result.matched_count or result.upserted_id)
+
+    def _notify(self, key, content, seq):
+        with self._notify_ready:
+            # Writes of one fork are serialized, so this replaces an older revision
+            self._to_notify.pop(key, None)
+            self._to_notify[key] = (content, seq)
+            if self._notify_thread is None or not self._notify_thread.is_alive():
+                self._notify_thread = threading.Thread(target=self._run_listeners, name="fork-write-listeners",
+                                                       daemon=True)
+                self._notify_thread.start()
+            self._notify_ready.notify_all()
+
+    def _run_listeners(self):
+        while True:
+            with self._notify_ready:
+                self._notifying = False
+                self._notify_ready.notify_all()
+                self._notify_ready.wait_for(lambda: self._to_notify)
+                (username, path), (content, seq) = self._to_notify.popitem(last=False)
+                self._notifying = True
+            for listener in self._listeners:
+                try:
+                    listener(username, path, content, seq)
+                except Exception as e:
+                    print(f"Fork write listener {listener.__name__} failed: {e}")
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="fork-write-behind", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        tick = min(1.0, max(self.interval / 4, 0.05))
+        while not self._stop.wait(tick):
+            self.flush_all(older_than=self.interval)
+
+
+fork_buffer = ForkWriteBuffer()
+
+registry.gauge(
+    "fork_saves_pending", "Fork saves buffered and not yet written to Mongo.",
+    callback=lambda: fork_buffer.pending_count(),
+)
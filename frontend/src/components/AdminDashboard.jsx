@@ -57,6 +57,14 @@ const AdminDashboard = ({ onLogout }) => {
         if (activeTab === 'repo') loadGitConfig();
     }, [activeTab]);
 
+    // Refresh the PR list when PRs change instead of polling
+    useEffect(() => {
+        if (activeTab !== 'prs') return;
+        return api.subscribeEvents((type) => {
+            if (type === 'ready' || type.startsWith('pr.')) loadPRs();
+        });
+    }, [activeTab]);
+
     const showToast = (message, type = 'success') => {
         setToast({ message, type });
     };
@@ -165,6 +173,35 @@ const AdminDashboard = ({ onLogout }) => {
         }
     };
 
+    // Resolves true if the admin chooses to write anyway
+    const confirmOverride = (err) => new Promise(resolve => {
+        const close = (confirmed) => {
+            setModalConfig(prev => ({ ...prev, isOpen: false }));
+            resolve(confirmed);
+        };
+        setModalConfig({
+            isOpen: true,
+            title: err.override === 'allow_invalid' ? 'Validation Errors' : 'Conflicting Changes',
+            message: err.message,
+            confirmText: err.override === 'allow_invalid' ? 'Write Anyway' : 'Overwrite Main',
+            confirmVariant: 'danger',
+            onConfirm: () => close(true),
+            onCancel: () => close(false)
+        });
+    });
+
+    // Merges and processing stop on validation errors or conflicts with main;
+    // after the admin confirms, they are resent with the override. Returns null if cancelled.
+    const runWithOverrides = async (action, overrides = {}) => {
+        try {
+            return await action(overrides);
+        } catch (err) {
+            if (!err.override || overrides[err.override]) throw err;
+            if (!await confirmOverride(err)) return null;
+            return runWithOverrides(action, { ...overrides, [err.override]: true });
+        }
+    };
+
     const handleMergePR = (prId) => {
         setModalConfig({
             isOpen: true,
@@ -173,10 +210,11 @@ const AdminDashboard = ({ onLogout }) => {
             confirmText: 'Merge',
             confirmVariant: 'success',
             onConfirm: async () => {
+                setModalConfig(prev => ({ ...prev, isOpen: false }));
                 try {
-                    await api.mergePR(prId);
+                    const result = await runWithOverrides(overrides => api.mergePR(prId, overrides));
+                    if (!result) return;
                     loadPRs();
-                    setModalConfig(prev => ({ ...prev, isOpen: false }));
                     showToast("PR Merged Successfully!", 'success');
                 } catch (err) {
                     showToast("Failed to merge PR: " + err.message, 'error');
@@ -285,7 +323,10 @@ const AdminDashboard = ({ onLogout }) => {
             if (!currentPRId) return;
             setLoading(true);
             try {
-                await api.processPR(currentPRId, acceptedIndices);
+                const result = await runWithOverrides(
+                    overrides => api.processPR(currentPRId, acceptedIndices, overrides)
+                );
+                if (!result) return;
                 showToast(`PR Processed. ${acceptedIndices.length} samples accepted.`, 'success');
                 setShowDiffModal(false);
                 loadPRs();
@@ -341,6 +382,9 @@ const AdminDashboard = ({ onLogout }) => {
                                                 className="w-4 h-4 rounded border-gray-600 text-green-500 focus:ring-green-500 bg-[#333]"
                                             />
                                             <span>Item Index: {diff.index} • {diff.type}</span>
+                                            {diff.conflict && (
+                                                <span className="text-yellow-400" title="Main has changed this item since the fork was created">• conflict</span>
+                                            )}
                                         </div>
                                         <span className={acceptedIndices.includes(diff.index) ? "text-green-400" : "text-gray-500"}>
                                             {acceptedIndices.includes(diff.index) ? "ACCEPTED" : "REJECTED"}
@@ -15,6 +15,18 @@ const getHeaders = () => {
     return headers;
 };
 
+// Merges and processing refuse items with validation errors (422) or changes
+// that conflict with main (409); the error names the flag that overrides it.
+const PR_OVERRIDES = ['overwrite_conflicts', 'allow_invalid'];
+
+const prActionError = async (response, fallback) => {
+    const error = await response.json().catch(() => ({}));
+    const err = new Error(error.detail || fallback);
+    err.status = response.status;
+    err.override = PR_OVERRIDES.find(flag => (error.detail || '').includes(`${flag}=true`)) || null;
+    return err;
+};
+
 export const api = {
     login: async (username, password) => {
         const formData = new FormData();
@@ -238,15 +250,14 @@ export const api = {
         return response.json();
     },
 
-    mergePR: async (prId) => {
-        const response = await fetch(`${API_URL}/workflow/prs/${prId}/merge`, {
+    mergePR: async (prId, overrides = {}) => {
+        const params = new URLSearchParams(PR_OVERRIDES.filter(flag => overrides[flag]).map(flag => [flag, 'true']));
+        const query = params.toString() ? `?${params}` : '';
+        const response = await fetch(`${API_URL}/workflow/prs/${prId}/merge${query}`, {
             method: 'POST',
             headers: getHeaders(),
         });
-        if (!response.ok) {
-            const error = await response.json();
-            throw new Error(error.detail || 'Failed to merge PR');
-        }
+        if (!response.ok) throw await prActionError(response, 'Failed to merge PR');
         return response.json();
     },
 
@@ -259,16 +270,17 @@ export const api = {
         return response.json();
     },
 
-    processPR: async (prId, acceptedIndices) => {
+    processPR: async (prId, acceptedIndices, overrides = {}) => {
         const response = await fetch(`${API_URL}/workflow/prs/${prId}/process`, {
             method: 'POST',
             headers: getHeaders(),
-            body: JSON.stringify({ accepted_indices: acceptedIndices }),
+            body: JSON.stringify({
+                accepted_indices: acceptedIndices,
+                overwrite_conflicts: Boolean(overrides.overwrite_conflicts),
+                allow_invalid: Boolean(overrides.allow_invalid),
+            }),
         });
-        if (!response.ok) {
-            const error = await response.json();
-            throw new Error(error.detail || 'Failed to process PR');
-        }
+        if (!response.ok) throw await prActionError(response, 'Failed to process PR');
         return response.json();
     },
 
@@ -316,5 +328,22 @@ export const api = {
             throw new Error(error.detail || 'Failed to push');
         }
         return response.json();
+    },
+
+    // Server-push events (pr.opened, pr.merged, fork.saved, git.synced, ...).
+    // Calls onEvent(type, data); returns a function that closes the stream.
+    subscribeEvents: (onEvent) => {
+        const token = localStorage.getItem('token');
+        if (!token || typeof EventSource === 'undefined') return () => {};
+        const source = new EventSource(`${API_URL}/events?token=${encodeURIComponent(token)}`);
+        const types = ['ready', 'pr.opened', 'pr.merged', 'pr.processed', 'pr.rejected',
+            'fork.saved', 'dataset.updated', 'git.synced', 'git.pushed'];
+        types.forEach((type) => {
+            source.addEventListener(type, (e) => {
+                const payload = JSON.parse(e.data || '{}');
+                onEvent(type, payload.data || {});
+            });
+        });
+        return () => source.close();
     }
 };